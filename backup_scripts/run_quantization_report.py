@@ -0,0 +1,126 @@
+"""
+量化检索评估脚本 - 运行入口
+在合成语料上比较 float32 / float16 / int8（含精确重排）检索的召回率、延迟和内存占用
+"""
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import logging
+
+import numpy as np
+
+sys.path.insert(0, os.getcwd())
+
+from src.handlers.memories.core.rag import BinaryStorage
+
+# 设置日志
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 评估的检索模式：(名称, quantization配置)
+MODES = [
+    ("float32", None),
+    ("float16", {"mode": "float16", "rescore": False}),
+    ("float16+rescore", {"mode": "float16", "rescore": True, "rescore_factor": 4}),
+    ("int8", {"mode": "int8", "rescore": False}),
+    ("int8+rescore", {"mode": "int8", "rescore": True, "rescore_factor": 4}),
+]
+
+def build_corpus(path: str, count: int, dim: int, clusters: int, seed: int) -> np.ndarray:
+    """
+    生成聚簇分布的合成语料，直接写成二进制存储格式
+
+    Returns:
+        np.ndarray: 归一化后的float32向量
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, count)] + 0.6 * rng.normal(size=(count, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    base_path = os.path.splitext(path)[0]
+    with open(base_path + ".records.jsonl", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"op": "header", "dim": dim}) + "\n")
+        for row in range(count):
+            doc = {"id": f"doc_{row}", "content": f"doc {row}", "metadata": {"user_id": "bench"}}
+            f.write(json.dumps({"op": "put", "row": row, "doc": doc}) + "\n")
+    vectors.tofile(base_path + ".vectors.f32")
+    return vectors
+
+def evaluate(storage: BinaryStorage, queries: np.ndarray, exact_ids: list, top_k: int) -> dict:
+    """
+    统计召回率和查询延迟
+    """
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, exact_ids):
+        start = time.perf_counter()
+        results = storage.search(query.tolist(), top_k=top_k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(expected & {doc["id"] for doc in results})
+
+    latencies.sort()
+    return {
+        "recall": hits / (len(queries) * top_k),
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[int(len(latencies) * 0.95)],
+    }
+
+def main():
+    """
+    量化检索评估主入口函数
+    """
+    parser = argparse.ArgumentParser(description="比较不同量化方式的检索召回率和延迟")
+    parser.add_argument("--count", type=int, default=20000, help="合成文档数量")
+    parser.add_argument("--dim", type=int, default=1024, help="向量维度")
+    parser.add_argument("--clusters", type=int, default=200, help="语料聚簇数量")
+    parser.add_argument("--queries", type=int, default=200, help="查询数量")
+    parser.add_argument("--top-k", type=int, default=10, help="每次检索返回的结果数")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="rag_quant_")
+    try:
+        path = os.path.join(work_dir, "rag_storage.json")
+        print(f"生成合成语料: {args.count} 条, 维度 {args.dim}")
+        vectors = build_corpus(path, args.count, args.dim, args.clusters, args.seed)
+
+        rng = np.random.default_rng(args.seed + 1)
+        queries = vectors[rng.choice(args.count, args.queries, replace=False)]
+        queries = queries + 0.05 * rng.normal(size=queries.shape).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+        # 以float32暴力检索结果作为召回率基准
+        exact_ids = []
+        for query in queries:
+            scores = vectors @ query
+            top = np.argpartition(-scores, args.top_k - 1)[:args.top_k]
+            exact_ids.append({f"doc_{row}" for row in top})
+
+        storage = BinaryStorage(path)
+        float32_bytes = storage._matrix_size * args.dim * 4
+
+        print(f"\n{'模式':<18}{'recall@' + str(args.top_k):>10}{'p50(ms)':>10}{'p95(ms)':>10}{'扫描内存(MB)':>14}")
+        for name, quant_config in MODES:
+            storage._quantized = None
+            scan_bytes = float32_bytes
+            if quant_config:
+                storage.enable_quantization(quant_config)
+                scan_bytes = storage._quantized.nbytes
+            # 预热，排除首次分页读取的影响
+            evaluate(storage, queries[:5], exact_ids[:5], args.top_k)
+            report = evaluate(storage, queries, exact_ids, args.top_k)
+            print(f"{name:<18}{report['recall']:>10.3f}{report['p50']:>10.2f}{report['p95']:>10.2f}"
+                  f"{scan_bytes / 1024 / 1024:>14.1f}")
+
+        print("\n说明: 启用重排时float32向量文件仍保留在磁盘上，仅读取少量候选行。")
+        return 0
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
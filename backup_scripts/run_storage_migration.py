@@ -0,0 +1,48 @@
+"""
+RAG存储迁移脚本 - 运行入口
+将 data/avatars/<角色>/ 下的 rag_storage.json 迁移为二进制存储格式（storage.type: binary）
+"""
+import sys
+import os
+import logging
+
+sys.path.insert(0, os.getcwd())
+
+from src.handlers.memories.core.rag import migrate_json_to_binary
+
+# 设置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def find_json_storages(root_dir: str):
+    """
+    查找所有rag_storage.json文件
+    """
+    for dirpath, _, filenames in os.walk(root_dir):
+        if "rag_storage.json" in filenames:
+            yield os.path.join(dirpath, "rag_storage.json")
+
+def main():
+    """
+    存储迁移主入口函数
+    """
+    root_dir = os.path.join(os.getcwd(), "data", "avatars")
+    if not os.path.exists(root_dir):
+        print(f"角色目录不存在: {root_dir}")
+        return 1
+        
+    failed = 0
+    for json_path in find_json_storages(root_dir):
+        print(f"迁移: {json_path}")
+        if not migrate_json_to_binary(json_path):
+            failed += 1
+            
+    if failed:
+        print(f"有 {failed} 个存储迁移失败，请查看日志获取详细信息。")
+        return 1
+        
+    print("RAG存储迁移完成，原JSON文件已保留，可在确认无误后手动删除。")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -175,6 +175,11 @@ def parse_config_groups() -> Dict[str, Dict[str, Any]]:
                     "description": "回复最大token数",
                     "type": "number",
                 },
+                "CONTEXT_LENGTH": {
+                    "value": config.llm.context_length,
+                    "description": "模型上下文长度(token)，决定提示词的token预算",
+                    "type": "number",
+                },
                 "TEMPERATURE": {
                     "value": float(config.llm.temperature),  # 确保是浮点数
                     "type": "number",
@@ -421,7 +426,7 @@ def save_config():
                 except Exception as e:
                     logger.error(f"处理定时任务配置失败: {str(e)}")
             # 处理其他配置项
-            elif key in ['LISTEN_LIST', 'DEEPSEEK_BASE_URL', 'MODEL', 'DEEPSEEK_API_KEY', 'MAX_TOKEN', 'TEMPERATURE',
+            elif key in ['LISTEN_LIST', 'DEEPSEEK_BASE_URL', 'MODEL', 'DEEPSEEK_API_KEY', 'MAX_TOKEN', 'CONTEXT_LENGTH', 'TEMPERATURE',
                          'MOONSHOT_API_KEY', 'MOONSHOT_BASE_URL', 'MOONSHOT_TEMPERATURE', 'MOONSHOT_MODEL',
                          'IMAGE_MODEL', 'TEMP_IMAGE_DIR', 'AUTO_MESSAGE', 'MIN_COUNTDOWN_HOURS', 'MAX_COUNTDOWN_HOURS',
                          'QUIET_TIME_START', 'QUIET_TIME_END', 'TTS_API_URL', 'VOICE_DIR', 'MAX_GROUPS', 'AVATAR_DIR',
@@ -502,6 +507,7 @@ def update_config_value(config_data, key, value):
             'MODEL': ['categories', 'llm_settings', 'settings', 'model', 'value'],
             'DEEPSEEK_API_KEY': ['categories', 'llm_settings', 'settings', 'api_key', 'value'],
             'MAX_TOKEN': ['categories', 'llm_settings', 'settings', 'max_tokens', 'value'],
+            'CONTEXT_LENGTH': ['categories', 'llm_settings', 'settings', 'context_length', 'value'],
             'TEMPERATURE': ['categories', 'llm_settings', 'settings', 'temperature', 'value'],
             'MOONSHOT_API_KEY': ['categories', 'media_settings', 'settings', 'image_recognition', 'api_key', 'value'],
             'MOONSHOT_BASE_URL': ['categories', 'media_settings', 'settings', 'image_recognition', 'base_url', 'value'],
@@ -531,6 +537,7 @@ def update_config_value(config_data, key, value):
         # 数值类型配置项
         numeric_keys = {
             'MAX_TOKEN': int,
+            'CONTEXT_LENGTH': int,
             'TEMPERATURE': float,
             'MOONSHOT_TEMPERATURE': float,
             'MIN_COUNTDOWN_HOURS': float,
@@ -3,5 +3,8 @@ HTTP请求包 - 提供API调用相关功能
 """
 
 from .wrapper import APIWrapper, APIEmbeddings
+from .client_pool import ClientRegistry, client_registry
+from .retry_policy import CircuitBreaker, CircuitOpenError, RetryPolicy, retry_policy
 
-__all__ = ['APIWrapper', 'APIEmbeddings'] 
\ No newline at end of file
+__all__ = ['APIWrapper', 'APIEmbeddings', 'ClientRegistry', 'client_registry',
+           'CircuitBreaker', 'CircuitOpenError', 'RetryPolicy', 'retry_policy'] 
\ No newline at end of file
@@ -0,0 +1,366 @@
+"""
+HTTP客户端注册表 - 进程内共享的连接池
+按 (base_url, api_key, purpose) 复用长连接的HTTP客户端，所有连接池共用同一个SSL上下文，
+并统计每个连接池的新建连接数、TLS握手次数和请求延迟，避免热路径上反复出现TCP/TLS冷启动
+"""
+import asyncio
+import hashlib
+import importlib.util
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+# 设置日志
+logger = logging.getLogger('main')
+
+class PoolStats:
+    """
+    单个连接池的统计信息
+    """
+
+    def __init__(self, name: str, latency_window: int = 512):
+        """
+        初始化统计信息
+
+        Args:
+            name: 连接池名称（用途@主机）
+            latency_window: 计算延迟分位数时保留的最近请求数
+        """
+        self.name = name
+        self.tracks_connections = False  # requests会话无法观察到新建连接
+        self.requests = 0
+        self.errors = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        self.connect_time = 0.0
+        self.latency_total = 0.0
+        self.latencies = deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+
+    def record_request(self, latency: float, success: bool = True):
+        """记录一次请求的延迟（秒，到收到响应头为止）"""
+        with self._lock:
+            self.requests += 1
+            if not success:
+                self.errors += 1
+            self.latency_total += latency
+            self.latencies.append(latency)
+
+    def record_trace(self, event_name: str, started: Dict[str, float]):
+        """
+        处理httpcore的trace事件，统计新建TCP连接和TLS握手
+
+        Args:
+            event_name: 事件名称，如 connection.connect_tcp.started
+            started: 当前请求内各阶段的开始时间
+        """
+        self.tracks_connections = True
+        if event_name.endswith(".started"):
+            started[event_name[:-len(".started")]] = time.perf_counter()
+            return
+        if not event_name.endswith(".complete"):
+            return
+        stage = event_name[:-len(".complete")]
+        if stage not in ("connection.connect_tcp", "connection.start_tls"):
+            return
+        duration = time.perf_counter() - started.pop(stage, time.perf_counter())
+        with self._lock:
+            if stage == "connection.connect_tcp":
+                self.connections += 1
+            else:
+                self.tls_handshakes += 1
+            self.connect_time += duration
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        获取统计快照
+
+        Returns:
+            Dict[str, Any]: 请求数、错误数、新建连接数、连接复用率和延迟
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            requests = self.requests
+            connections = self.connections
+            tracked = self.tracks_connections
+            return {
+                "requests": requests,
+                "errors": self.errors,
+                "new_connections": connections if tracked else None,
+                "tls_handshakes": self.tls_handshakes if tracked else None,
+                "reuse_rate": (round(max(0.0, 1 - connections / requests), 3) if requests else 0.0) if tracked else None,
+                "avg_connect_ms": round(self.connect_time / max(1, connections + self.tls_handshakes) * 1000, 2),
+                "avg_latency_ms": round(self.latency_total / requests * 1000, 2) if requests else 0.0,
+                "p95_latency_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 2) if latencies else 0.0
+            }
+
+class ClientRegistry:
+    """
+    进程内HTTP客户端注册表，线程安全
+
+    同步客户端在所有线程间共享；异步客户端的连接池绑定在创建它的事件循环上，
+    只在该循环中复用，其他事件循环获取时返回None，由调用方改用同步客户端
+    """
+
+    def __init__(self, max_connections: int = 50, max_keepalive_connections: int = 20,
+                 keepalive_expiry: float = 120.0):
+        """
+        初始化注册表
+
+        Args:
+            max_connections: 每个连接池的最大连接数
+            max_keepalive_connections: 每个连接池保持的空闲长连接数
+            keepalive_expiry: 空闲长连接的保留时间（秒）
+        """
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = importlib.util.find_spec("h2") is not None
+        self._clients = {}
+        self._async_clients = {}
+        self._sessions = {}
+        self._sdk_clients = {}
+        self._stats = {}
+        self._ssl_context = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _make_key(base_url: Optional[str], api_key: Optional[str], purpose: str) -> Tuple[str, str, str]:
+        """构建连接池键，API密钥只保留摘要"""
+        url = (base_url or "https://api.openai.com/v1").rstrip('/')
+        key_digest = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+        return (url, key_digest, purpose)
+
+    def _get_stats(self, key: Tuple[str, str, str]) -> PoolStats:
+        """获取（必要时创建）连接池的统计对象"""
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                host = key[0].split("://", 1)[-1].split("/", 1)[0]
+                stats = PoolStats(f"{key[2]}@{host}")
+                self._stats[key] = stats
+            return stats
+
+    def _get_ssl_context(self):
+        """所有连接池共用一个SSL上下文，避免每个客户端重复加载证书"""
+        with self._lock:
+            if self._ssl_context is None:
+                import httpx
+                self._ssl_context = httpx.create_ssl_context()
+            return self._ssl_context
+
+    def _client_options(self) -> Dict[str, Any]:
+        """httpx客户端的公共参数"""
+        import httpx
+        return {
+            "http2": self.http2,
+            "verify": self._get_ssl_context(),
+            "follow_redirects": True,
+            "timeout": httpx.Timeout(60.0, connect=10.0),
+            "limits": httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry
+            )
+        }
+
+    def get_http_client(self, base_url: Optional[str], api_key: Optional[str], purpose: str = "default"):
+        """
+        获取共享的同步HTTP客户端
+
+        Args:
+            base_url: API基础URL
+            api_key: API密钥
+            purpose: 用途，如 chat、memory、image_recognition
+
+        Returns:
+            httpx.Client: 共享的客户端
+        """
+        import httpx
+        key = self._make_key(base_url, api_key, purpose)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None and not client.is_closed:
+                return client
+
+            stats = self._get_stats(key)
+
+            def on_request(request):
+                started = {}
+                request.extensions["trace"] = lambda event_name, info: stats.record_trace(event_name, started)
+                request.extensions["pool_request_start"] = time.perf_counter()
+
+            def on_response(response):
+                start = response.request.extensions.get("pool_request_start", time.perf_counter())
+                stats.record_request(time.perf_counter() - start, response.status_code < 400)
+
+            client = httpx.Client(
+                event_hooks={"request": [on_request], "response": [on_response]},
+                **self._client_options()
+            )
+            self._clients[key] = client
+            logger.info(f"创建共享HTTP连接池: {stats.name}, HTTP/2: {self.http2}")
+            return client
+
+    def get_async_http_client(self, base_url: Optional[str], api_key: Optional[str], purpose: str = "default"):
+        """
+        获取当前事件循环可用的共享异步HTTP客户端
+
+        Args:
+            base_url: API基础URL
+            api_key: API密钥
+            purpose: 用途
+
+        Returns:
+            httpx.AsyncClient: 共享的异步客户端，不在事件循环中或循环不匹配时返回None
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+        import httpx
+        key = self._make_key(base_url, api_key, purpose)
+        with self._lock:
+            entry = self._async_clients.get(key)
+            if entry is not None:
+                bound_loop, client = entry
+                # 绑定的事件循环已关闭时重新绑定到当前循环
+                if not bound_loop.is_closed() and not client.is_closed:
+                    return client if bound_loop is loop else None
+
+            stats = self._get_stats(key)
+
+            async def on_request(request):
+                started = {}
+
+                async def trace(event_name, info):
+                    stats.record_trace(event_name, started)
+
+                request.extensions["trace"] = trace
+                request.extensions["pool_request_start"] = time.perf_counter()
+
+            async def on_response(response):
+                start = response.request.extensions.get("pool_request_start", time.perf_counter())
+                stats.record_request(time.perf_counter() - start, response.status_code < 400)
+
+            client = httpx.AsyncClient(
+                event_hooks={"request": [on_request], "response": [on_response]},
+                **self._client_options()
+            )
+            self._async_clients[key] = (loop, client)
+            logger.info(f"创建共享异步HTTP连接池: {stats.name}, HTTP/2: {self.http2}")
+            return client
+
+    def get_openai_client(self, base_url: Optional[str], api_key: str, purpose: str = "default", **options):
+        """
+        获取使用共享连接池的OpenAI客户端
+
+        Args:
+            base_url: API基础URL
+            api_key: API密钥
+            purpose: 用途
+            **options: 传给OpenAI客户端的其他参数，如timeout、max_retries
+
+        Returns:
+            openai.OpenAI: 客户端实例，相同参数的调用方共享同一个实例
+        """
+        import openai
+        http_client = self.get_http_client(base_url, api_key, purpose)
+        return self._get_sdk_client(openai.OpenAI, http_client, base_url, api_key, purpose, options)
+
+    def get_async_openai_client(self, base_url: Optional[str], api_key: str, purpose: str = "default", **options):
+        """
+        获取当前事件循环可用的、使用共享连接池的异步OpenAI客户端
+
+        Args:
+            base_url: API基础URL
+            api_key: API密钥
+            purpose: 用途
+            **options: 传给AsyncOpenAI客户端的其他参数
+
+        Returns:
+            openai.AsyncOpenAI: 客户端实例，当前事件循环不可用时返回None
+        """
+        http_client = self.get_async_http_client(base_url, api_key, purpose)
+        if http_client is None:
+            return None
+        import openai
+        return self._get_sdk_client(openai.AsyncOpenAI, http_client, base_url, api_key, purpose, options)
+
+    def _get_sdk_client(self, client_class, http_client, base_url: Optional[str], api_key: str,
+                        purpose: str, options: Dict[str, Any]):
+        """缓存包装共享连接池的SDK客户端，连接池重建后随之重建"""
+        cache_key = (client_class.__name__, self._make_key(base_url, api_key, purpose), repr(sorted(options.items())))
+        with self._lock:
+            entry = self._sdk_clients.get(cache_key)
+            if entry is not None and entry[0] is http_client:
+                return entry[1]
+            client = client_class(api_key=api_key, base_url=base_url, http_client=http_client, **options)
+            self._sdk_clients[cache_key] = (http_client, client)
+            return client
+
+    def get_session(self, base_url: Optional[str], api_key: Optional[str], purpose: str = "default"):
+        """
+        获取共享的requests会话，供仍使用requests的服务复用长连接
+
+        Args:
+            base_url: API基础URL
+            api_key: API密钥
+            purpose: 用途
+
+        Returns:
+            requests.Session: 共享的会话
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+        key = self._make_key(base_url, api_key, purpose)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None:
+                return session
+
+            stats = self._get_stats(key)
+
+            def on_response(response, *args, **kwargs):
+                stats.record_request(response.elapsed.total_seconds(), response.status_code < 400)
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.max_keepalive_connections)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.hooks["response"].append(on_response)
+            self._sessions[key] = session
+            logger.info(f"创建共享HTTP会话: {stats.name}")
+            return session
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        获取所有连接池的统计信息
+
+        Returns:
+            Dict[str, Dict[str, Any]]: 连接池名称 -> 统计快照
+        """
+        with self._lock:
+            stats = list(self._stats.values())
+        return {item.name: item.snapshot() for item in stats}
+
+    def close_all(self):
+        """关闭所有同步客户端和会话（异步客户端随其事件循环结束）"""
+        with self._lock:
+            clients = list(self._clients.values())
+            sessions = list(self._sessions.values())
+            self._clients.clear()
+            self._sessions.clear()
+            self._async_clients.clear()
+            self._sdk_clients.clear()
+        for client in clients + sessions:
+            try:
+                client.close()
+            except Exception as e:
+                logger.debug(f"关闭HTTP客户端失败: {str(e)}")
+
+# 进程内共享的客户端注册表
+client_registry = ClientRegistry()
@@ -0,0 +1,368 @@
+"""
+统一重试策略 - 为LLM、嵌入和图像识别调用提供一致的重试行为
+- 每次请求的总尝试次数和总耗时预算
+- 带随机抖动的指数退避，遵守服务端返回的Retry-After
+- 按端点的熔断器，上游不健康时快速失败，避免重试放大故障
+"""
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# 设置日志
+logger = logging.getLogger('main')
+
+# 可重试的HTTP状态码：超时、冲突、限流和服务端错误
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# 可重试的网络异常（按类名匹配，兼容openai、httpx、requests，无需导入这些库）
+RETRYABLE_EXCEPTION_NAMES = {
+    "APIConnectionError", "APITimeoutError", "TimeoutException", "TransportError",
+    "ConnectError", "ConnectTimeout", "ReadTimeout", "ReadError", "WriteError",
+    "RemoteProtocolError", "ConnectionError", "Timeout", "ChunkedEncodingError"
+}
+
+class RetryableError(Exception):
+    """调用方主动标记为可重试的错误（如返回了空响应）"""
+
+class CircuitOpenError(Exception):
+    """熔断器打开，请求被快速拒绝"""
+
+    def __init__(self, endpoint: str, retry_in: float):
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+        super().__init__(f"服务暂时不可用: {endpoint} 已熔断，{retry_in:.0f}秒后再试")
+
+class CircuitBreaker:
+    """
+    单个端点的熔断器
+
+    连续失败达到阈值后打开，在恢复时间内直接拒绝请求；恢复时间过后进入半开状态，
+    只放行一个试探请求，成功则关闭，失败则重新打开
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, endpoint: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        """
+        初始化熔断器
+
+        Args:
+            endpoint: 端点名称
+            failure_threshold: 打开熔断器的连续失败次数
+            recovery_timeout: 打开后到允许试探请求的时间（秒）
+        """
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """
+        请求前检查
+
+        Raises:
+            CircuitOpenError: 熔断器打开或半开状态下已有试探请求时
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            elapsed = time.monotonic() - self.opened_at
+            if self.state == self.OPEN and elapsed >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                logger.info(f"熔断器半开，放行试探请求: {self.endpoint}")
+                return
+            self.rejected += 1
+            raise CircuitOpenError(self.endpoint, max(0.0, self.recovery_timeout - elapsed))
+
+    def record_success(self):
+        """记录成功请求"""
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"熔断器关闭，服务已恢复: {self.endpoint}")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        """记录上游故障导致的失败"""
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"熔断器打开: {self.endpoint}，连续失败 {self.failures} 次，"
+                                   f"{self.recovery_timeout:.0f}秒内快速失败")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def release_probe(self):
+        """
+        释放半开状态下的试探名额而不判定结果（请求被取消，或返回了不说明上游健康状况的客户端错误），
+        熔断器回到打开状态，下一个请求可以立即重新试探
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._probe_in_flight:
+                self.state = self.OPEN
+            self._probe_in_flight = False
+            
+    def get_stats(self) -> Dict[str, Any]:
+        """获取熔断器状态"""
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+class RetryPolicy:
+    """
+    重试策略
+
+    同一个策略对象在所有调用方之间共享熔断器；with_budget可以派生出预算不同、
+    但共享熔断器的策略
+    """
+
+    def __init__(self, max_attempts: int = 3, max_elapsed: float = 30.0, base_delay: float = 0.5,
+                 max_delay: float = 8.0, failure_threshold: int = 5, recovery_timeout: float = 30.0,
+                 breakers: Optional[Dict[str, CircuitBreaker]] = None):
+        """
+        初始化重试策略
+
+        Args:
+            max_attempts: 每次请求的最大尝试次数（包括第一次）
+            max_elapsed: 每次请求的总耗时预算（秒），下一次等待会超出预算时不再重试
+            base_delay: 退避基础时间（秒）
+            max_delay: 单次退避的最长时间（秒）
+            failure_threshold: 熔断器打开的连续失败次数
+            recovery_timeout: 熔断器打开后的恢复时间（秒）
+            breakers: 共享的熔断器表
+        """
+        self.max_attempts = max(1, int(max_attempts))
+        self.max_elapsed = max_elapsed
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._breakers = breakers if breakers is not None else {}
+        self._lock = threading.Lock()
+
+    def with_budget(self, max_attempts: Optional[int] = None, max_elapsed: Optional[float] = None) -> "RetryPolicy":
+        """
+        派生一个预算不同的策略，熔断器与当前策略共享
+
+        Args:
+            max_attempts: 最大尝试次数
+            max_elapsed: 总耗时预算（秒）
+
+        Returns:
+            RetryPolicy: 新的策略
+        """
+        return RetryPolicy(
+            max_attempts=self.max_attempts if max_attempts is None else max_attempts,
+            max_elapsed=self.max_elapsed if max_elapsed is None else max_elapsed,
+            base_delay=self.base_delay,
+            max_delay=self.max_delay,
+            failure_threshold=self.failure_threshold,
+            recovery_timeout=self.recovery_timeout,
+            breakers=self._breakers
+        )
+
+    def get_breaker(self, endpoint: str) -> CircuitBreaker:
+        """获取（必要时创建）端点的熔断器"""
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                breaker = CircuitBreaker(endpoint, self.failure_threshold, self.recovery_timeout)
+                self._breakers[endpoint] = breaker
+            return breaker
+
+    @staticmethod
+    def _status_code(error: Exception) -> Optional[int]:
+        """提取异常对应的HTTP状态码"""
+        status = getattr(error, "status_code", None)
+        if status is None:
+            status = getattr(getattr(error, "response", None), "status_code", None)
+        return status if isinstance(status, int) else None
+
+    def is_retryable(self, error: Exception) -> bool:
+        """
+        判断异常是否可重试（同时也是熔断器计入的上游故障）
+
+        Args:
+            error: 异常对象
+
+        Returns:
+            bool: 网络错误、超时、限流和5xx可重试；认证、参数等客户端错误不重试
+        """
+        if isinstance(error, CircuitOpenError):
+            return False
+        if isinstance(error, (RetryableError, TimeoutError, ConnectionError, asyncio.TimeoutError)):
+            return True
+        status = self._status_code(error)
+        if status is not None:
+            return status in RETRYABLE_STATUS_CODES
+        return any(cls.__name__ in RETRYABLE_EXCEPTION_NAMES for cls in type(error).__mro__)
+
+    @staticmethod
+    def retry_after(error: Exception) -> Optional[float]:
+        """
+        解析服务端要求的等待时间
+
+        Args:
+            error: 异常对象
+
+        Returns:
+            Optional[float]: 等待秒数，没有Retry-After时返回None
+        """
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        if not headers:
+            return None
+        try:
+            retry_after_ms = headers.get("retry-after-ms")
+            if retry_after_ms:
+                return max(0.0, float(retry_after_ms) / 1000)
+            retry_after = headers.get("retry-after")
+            if not retry_after:
+                return None
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                retry_date = email.utils.parsedate_to_datetime(retry_after)
+                return max(0.0, retry_date.timestamp() - time.time())
+        except Exception:
+            return None
+
+    def compute_delay(self, attempt: int, error: Exception) -> float:
+        """
+        计算第attempt次失败后的等待时间：全抖动指数退避，服务端给出Retry-After时以其为下限
+
+        Args:
+            attempt: 已失败的次数（从1开始）
+            error: 本次失败的异常
+
+        Returns:
+            float: 等待秒数
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _next_delay(self, attempt: int, error: Exception, started: float, endpoint: str) -> Optional[float]:
+        """记录失败并判断是否继续重试，返回等待时间；不再重试时返回None"""
+        retryable = self.is_retryable(error)
+        breaker = self.get_breaker(endpoint)
+        if retryable:
+            breaker.record_failure()
+        else:
+            # 客户端错误不计入上游故障，但也不能证明上游已恢复，只释放可能占用的半开试探名额
+            breaker.release_probe()
+            return None
+
+        if attempt >= self.max_attempts or breaker.state == CircuitBreaker.OPEN:
+            return None
+        delay = self.compute_delay(attempt, error)
+        if time.monotonic() - started + delay > self.max_elapsed:
+            logger.warning(f"重试预算已用尽: {endpoint}，已尝试 {attempt} 次")
+            return None
+        logger.warning(f"请求失败，{delay:.1f}秒后重试({attempt + 1}/{self.max_attempts}): {endpoint}, {str(error)[:200]}")
+        return delay
+
+    def call(self, func: Callable[..., Any], *args, endpoint: str = "default", **kwargs) -> Any:
+        """
+        按重试策略同步调用
+
+        Args:
+            func: 被调用的函数
+            *args: 位置参数
+            endpoint: 端点名称，用于熔断统计
+            **kwargs: 关键字参数
+
+        Returns:
+            Any: 函数返回值
+
+        Raises:
+            Exception: 最后一次失败的异常，或熔断时的CircuitOpenError
+        """
+        breaker = self.get_breaker(endpoint)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            breaker.before_request()
+            attempt += 1
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = self._next_delay(attempt, e, started, endpoint)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # 被中断（如KeyboardInterrupt）时释放试探名额，否则熔断器会一直拒绝请求
+                breaker.release_probe()
+                raise
+            breaker.record_success()
+            return result
+
+    async def async_call(self, func: Callable[..., Awaitable[Any]], *args, endpoint: str = "default", **kwargs) -> Any:
+        """
+        按重试策略异步调用
+
+        Args:
+            func: 返回协程的函数
+            *args: 位置参数
+            endpoint: 端点名称，用于熔断统计
+            **kwargs: 关键字参数
+
+        Returns:
+            Any: 协程返回值
+
+        Raises:
+            Exception: 最后一次失败的异常，或熔断时的CircuitOpenError
+        """
+        breaker = self.get_breaker(endpoint)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            breaker.before_request()
+            attempt += 1
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._next_delay(attempt, e, started, endpoint)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # 任务被取消（CancelledError）时释放试探名额，否则熔断器会一直拒绝请求
+                breaker.release_probe()
+                raise
+            breaker.record_success()
+            return result
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        获取所有端点的熔断器状态
+
+        Returns:
+            Dict[str, Dict[str, Any]]: 端点 -> 熔断器状态
+        """
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.endpoint: breaker.get_stats() for breaker in breakers}
+
+# 进程内共享的重试策略
+retry_policy = RetryPolicy()
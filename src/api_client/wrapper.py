@@ -8,6 +8,8 @@ import openai
 import asyncio
 import re
 from typing import Any, Dict, List, Optional, Union
+from .client_pool import client_registry
+from .retry_policy import retry_policy
 
 # 设置日志
 logger = logging.getLogger('main')
@@ -27,6 +29,8 @@ class APIWrapper:
         """
         self.api_key = api_key
         self.base_url = base_url
+        # 重试策略中熔断器的端点名称
+        self.retry_endpoint = f"memory@{base_url or 'https://api.openai.com/v1'}"
         
         # 初始化OpenAI客户端
         self._init_client()
@@ -42,16 +46,34 @@ class APIWrapper:
             if self.base_url:
                 os.environ["OPENAI_API_BASE"] = self.base_url
                 
-            # 创建客户端
-            self.client = openai.OpenAI(
-                api_key=self.api_key,
-                base_url=self.base_url
+            # 创建客户端，使用进程内共享的连接池；重试统一由retry_policy负责
+            self.client = client_registry.get_openai_client(
+                self.base_url,
+                self.api_key,
+                purpose="memory",
+                max_retries=0
             )
             logger.info(f"成功初始化API客户端，基础URL: {self.base_url or '默认OpenAI'}")
         except Exception as e:
             logger.error(f"初始化API客户端失败: {str(e)}")
             # 创建一个空客户端，避免程序崩溃
             self.client = object()
+        
+    def get_async_client(self):
+        """
+        获取当前事件循环可用的异步客户端
+        
+        异步连接池由客户端注册表共享，绑定在首次使用它的事件循环（记忆系统的后台事件循环）上；
+        其他事件循环返回None，由调用方改用线程执行同步客户端
+        
+        Returns:
+            openai.AsyncOpenAI: 异步客户端，不可用时返回None
+        """
+        try:
+            return client_registry.get_async_openai_client(self.base_url, self.api_key, purpose="memory", max_retries=0)
+        except Exception as e:
+            logger.error(f"初始化异步API客户端失败: {str(e)}")
+            return None
             
     def _create_interfaces(self):
         """创建API接口"""
@@ -105,6 +127,35 @@ class APIWrapper:
             logger.error(f"获取嵌入向量失败: {str(e)}")
             return None
             
+    async def async_embeddings(self, texts: List[str], model_name: str = "text-embedding-3-large") -> List[Optional[List[float]]]:
+        """
+        异步批量获取嵌入向量，一次请求处理多条文本
+        
+        Args:
+            texts: 输入文本列表
+            model_name: 模型名称
+            
+        Returns:
+            List[Optional[List[float]]]: 与输入顺序一致的嵌入向量列表
+        """
+        try:
+            # 调用嵌入API
+            response = await self.embeddings.create(model=model_name, input=texts)
+            
+            # 解析结果，按index还原输入顺序
+            if hasattr(response, 'data'):
+                items = sorted(response.data, key=lambda item: getattr(item, 'index', 0))
+                return [item.embedding for item in items]
+            elif isinstance(response, dict) and 'data' in response:
+                items = sorted(response['data'], key=lambda item: item.get('index', 0))
+                return [item['embedding'] for item in items]
+            else:
+                logger.error(f"无法解析嵌入向量响应: {response}")
+                return [None] * len(texts)
+        except Exception as e:
+            logger.error(f"批量获取嵌入向量失败: {str(e)}")
+            return [None] * len(texts)
+            
     def embedding(self, text: str, model_name: str = "text-embedding-3-large") -> List[float]:
         """
         同步获取嵌入向量
@@ -148,12 +199,14 @@ class APIWrapper:
             max_tokens: 最大token数
             
         Returns:
-            Dict: 包含响应内容的字典
+            Dict: 包含响应内容的字典；失败时content为错误提示，并带有error字段
         """
         try:
             # 调用OpenAI API
-            response = await asyncio.to_thread(
+            response = await retry_policy.async_call(
+                asyncio.to_thread,
                 self.client.chat.completions.create,
+                endpoint=self.retry_endpoint,
                 model="gpt-3.5-turbo",
                 messages=[{"role": "user", "content": prompt}],
                 temperature=temperature,
@@ -173,10 +226,10 @@ class APIWrapper:
                 return {"content": cleaned_content.strip()}
             else:
                 logger.error(f"无法解析完成响应: {response}")
-                return {"content": "无法解析响应"}
+                return {"content": "无法解析响应", "error": "无法解析响应"}
         except Exception as e:
             logger.error(f"获取完成响应失败: {str(e)}")
-            return {"content": f"API调用错误: {str(e)}"}
+            return {"content": f"API调用错误: {str(e)}", "error": str(e)}
 
 class APIEmbeddings:
     """嵌入API接口"""
@@ -202,8 +255,21 @@ class APIEmbeddings:
             Any: API响应
         """
         try:
-            # 调用OpenAI API
-            response = self.wrapper.client.embeddings.create(
+            # 优先使用异步客户端，避免在事件循环中阻塞等待网络I/O
+            async_client = self.wrapper.get_async_client()
+            if async_client is not None:
+                return await retry_policy.async_call(
+                    async_client.embeddings.create,
+                    endpoint=self.wrapper.retry_endpoint,
+                    model=model,
+                    input=input
+                )
+                
+            # 否则在线程中调用同步客户端
+            response = await retry_policy.async_call(
+                asyncio.to_thread,
+                self.wrapper.client.embeddings.create,
+                endpoint=self.wrapper.retry_endpoint,
                 model=model,
                 input=input
             )
@@ -18,6 +18,7 @@ class LLMSettings:
     model: str
     max_tokens: int
     temperature: float
+    context_length: int = 8192
 
 @dataclass
 class ImageRecognitionSettings:
@@ -235,7 +236,8 @@ class SettingReader:
                 base_url=llm_data.get('base_url', {}).get('value', ''),
                 model=model,
                 max_tokens=llm_data.get('max_tokens', {}).get('value', 0),
-                temperature=llm_data.get('temperature', {}).get('value', 0.0)
+                temperature=llm_data.get('temperature', {}).get('value', 0.0),
+                context_length=llm_data.get('context_length', {}).get('value', 8192)
             ))
         
         # RAG设置
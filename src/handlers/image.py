@@ -11,6 +11,7 @@ import os
 import logging
 import requests
 from datetime import datetime
+from src.api_client.client_pool import client_registry
 from typing import Optional, List, Tuple, Callable
 import re
 import time
@@ -37,6 +38,8 @@ class ImageHandler:
         self.base_url = base_url
         self.image_model = image_model
         self.temp_dir = os.path.join(root_dir, "data", "images", "temp")
+        # 复用进程内共享的长连接会话
+        self.session = client_registry.get_session(base_url, api_key, purpose="image_generation")
         
         # 使用任务队列替代处理锁
         self.task_queue = queue.Queue()
@@ -407,7 +410,7 @@ class ImageHandler:
             }
             
             # 调用生成API
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/images/generations",
                 headers=headers,
                 json=payload,
@@ -419,7 +422,7 @@ class ImageHandler:
             result = response.json()
             if "data" in result and len(result["data"]) > 0:
                 img_url = result["data"][0]["url"]
-                img_response = requests.get(img_url)
+                img_response = self.session.get(img_url)
                 if img_response.status_code == 200:
                     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                     temp_path = os.path.join(self.temp_dir, f"image_{timestamp}.jpg")
@@ -9,15 +9,33 @@ from src.handlers.memories.core.memory_utils import (
     clean_dialog_memory, 
     get_memory_path, 
     get_importance_keywords, 
-    remove_special_instructions
+    remove_special_instructions,
+    parse_timestamp,
+    time_decay_weights,
+    RetrievedMemory
+)
+
+from src.handlers.memories.core.async_runner import (
+    AsyncRunner,
+    get_async_runner,
+    run_sync,
+    submit
 )
 
 from src.handlers.memories.core.rag import (
     RagManager,
+    RagNamespacePool,
+    EmbeddingCache,
+    get_embedding_cache,
     ApiEmbeddingModel,
     LocalEmbeddingModel,
     ApiReranker,
+    LocalReranker,
     JsonStorage,
+    BinaryStorage,
+    IvfIndex,
+    KeywordIndex,
+    migrate_json_to_binary,
     create_default_config
 )
 
@@ -29,12 +47,29 @@ __all__ = [
     'get_memory_path',
     'get_importance_keywords',
     'remove_special_instructions',
+    'parse_timestamp',
+    'time_decay_weights',
+    'RetrievedMemory',
+    
+    # async_runner
+    'AsyncRunner',
+    'get_async_runner',
+    'run_sync',
+    'submit',
     
     # rag
     'RagManager',
+    'RagNamespacePool',
+    'EmbeddingCache',
+    'get_embedding_cache',
     'ApiEmbeddingModel',
     'LocalEmbeddingModel',
     'ApiReranker',
+    'LocalReranker',
     'JsonStorage',
+    'BinaryStorage',
+    'IvfIndex',
+    'KeywordIndex',
+    'migrate_json_to_binary',
     'create_default_config'
 ] 
\ No newline at end of file
@@ -0,0 +1,180 @@
+"""
+记忆子系统后台事件循环
+提供一个长期运行的asyncio事件循环线程，同步代码通过它提交RAG相关协程，
+避免每次调用都创建线程和事件循环
+"""
+import asyncio
+import atexit
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Coroutine, Optional
+
+# 设置日志
+logger = logging.getLogger('main')
+
+class AsyncRunner:
+    """
+    后台事件循环线程，提供线程安全的提交/等待接口，并限制并发协程数量
+    """
+
+    def __init__(self, max_concurrency: int = 8, name: str = "memory-async-loop"):
+        """
+        初始化后台事件循环
+
+        Args:
+            max_concurrency: 同时运行的协程上限
+            name: 线程名称
+        """
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self._started = threading.Event()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """获取后台事件循环（首次访问时启动）"""
+        self._ensure_started()
+        return self._loop
+
+    def _ensure_started(self):
+        """确保后台线程已启动"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._started.clear()
+            self._thread = threading.Thread(target=self._run_loop, name=self.name, daemon=True)
+            self._thread.start()
+        self._started.wait()
+
+    def _run_loop(self):
+        """后台线程入口"""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._started.set()
+        logger.info(f"记忆系统后台事件循环已启动，并发上限: {self.max_concurrency}")
+        try:
+            loop.run_forever()
+        finally:
+            try:
+                pending = asyncio.all_tasks(loop)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            finally:
+                loop.close()
+
+    async def _bounded(self, coro: Coroutine) -> Any:
+        """在并发上限内执行协程"""
+        async with self._semaphore:
+            return await coro
+
+    def in_loop_thread(self) -> bool:
+        """当前是否运行在后台事件循环线程中"""
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def submit(self, coro: Coroutine) -> Future:
+        """
+        提交协程到后台事件循环，不等待结果
+
+        Args:
+            coro: 协程对象
+
+        Returns:
+            Future: 可在任意线程等待的结果
+        """
+        return asyncio.run_coroutine_threadsafe(self._bounded(coro), self.loop)
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        """
+        提交协程到后台事件循环并阻塞等待结果
+
+        Args:
+            coro: 协程对象
+            timeout: 超时时间（秒），None表示一直等待
+
+        Returns:
+            协程运行结果
+        """
+        if self.in_loop_thread():
+            # 在后台循环内部同步等待会死锁，改为在临时线程中运行
+            logger.warning("在记忆系统事件循环线程内同步等待协程，改用临时线程执行")
+            result = Future()
+
+            def _run_in_thread():
+                try:
+                    result.set_result(asyncio.run(coro))
+                except BaseException as e:
+                    result.set_exception(e)
+
+            threading.Thread(target=_run_in_thread, daemon=True).start()
+            return result.result(timeout)
+
+        return self.submit(coro).result(timeout)
+
+    def shutdown(self, timeout: float = 5.0):
+        """
+        停止后台事件循环
+
+        Args:
+            timeout: 等待线程退出的时间（秒）
+        """
+        with self._lock:
+            if self._loop is None or self._thread is None or not self._thread.is_alive():
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            thread = self._thread
+        thread.join(timeout)
+
+# 全局实例
+_runner = None
+_runner_lock = threading.Lock()
+
+def get_async_runner() -> AsyncRunner:
+    """
+    获取记忆系统共享的后台事件循环
+
+    Returns:
+        AsyncRunner: 后台事件循环实例
+    """
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                _runner = AsyncRunner()
+                atexit.register(_runner.shutdown)
+    return _runner
+
+def run_sync(coro: Coroutine, timeout: Optional[float] = None) -> Any:
+    """
+    在后台事件循环中运行协程并等待结果
+
+    Args:
+        coro: 协程对象
+        timeout: 超时时间（秒）
+
+    Returns:
+        协程运行结果
+    """
+    return get_async_runner().run(coro, timeout)
+
+def submit(coro: Coroutine) -> Future:
+    """
+    提交协程到后台事件循环，不等待结果
+
+    Args:
+        coro: 协程对象
+
+    Returns:
+        Future: 结果
+    """
+    return get_async_runner().submit(coro)
@@ -6,6 +6,11 @@ import re
 import functools
 import logging
 import json
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
 from typing import Dict, List, Any, Optional, Tuple, Union, Callable
 
 # 设置日志
@@ -263,4 +268,166 @@ def get_importance_keywords() -> List[str]:
         "地址", "电话", "密码", "账号", "名字", "生日",
         "喜欢", "讨厌", "爱好", "兴趣","爱",
         "我的", "我是", "我要", "我想", "我们", "我们的"
-    ] 
\ No newline at end of file
+    ] 
+
+# 记忆时间戳格式
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# 历史数据中出现过的时间戳格式
+TIMESTAMP_FORMATS = (
+    TIMESTAMP_FORMAT,
+    "%Y-%m-%d %H:%M",
+    "%Y/%m/%d %H:%M",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y%m%d%H%M",
+)
+
+@functools.lru_cache(maxsize=8192)
+def _parse_timestamp_str(timestamp: str) -> float:
+    """解析时间戳字符串，结果按字符串缓存"""
+    for time_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(timestamp, time_format).timestamp()
+        except ValueError:
+            continue
+            
+    # 所有格式都失败时，从字符串中提取日期时间部分
+    date_match = re.search(r'(\d{4})[-/](\d{1,2})[-/](\d{1,2})[T\s]?(\d{1,2}):(\d{1,2})(?::(\d{1,2}))?', timestamp)
+    if date_match:
+        try:
+            year, month, day, hour, minute = map(int, date_match.groups()[:5])
+            second = int(date_match.group(6)) if date_match.group(6) else 0
+            return datetime(year, month, day, hour, minute, second).timestamp()
+        except ValueError:
+            pass
+    return 0.0
+
+def parse_timestamp(timestamp: Any) -> float:
+    """
+    将记忆时间戳解析为epoch秒
+    
+    Args:
+        timestamp: 时间戳字符串（TIMESTAMP_FORMATS中的任一格式）、datetime或数字
+        
+    Returns:
+        float: epoch秒，无法解析时返回0.0
+    """
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    if isinstance(timestamp, datetime):
+        return timestamp.timestamp()
+    if not timestamp or not isinstance(timestamp, str):
+        return 0.0
+    return _parse_timestamp_str(timestamp.strip())
+
+def time_decay_weights(epochs, now: Any = None, decay_rate: float = 0.05, method: str = "exponential",
+                       min_weight: float = 0.0, max_weight: float = 1.0, default: float = 0.5) -> np.ndarray:
+    """
+    批量计算按小时衰减的时间权重
+    
+    Args:
+        epochs: epoch秒数组，0表示时间未知
+        now: 当前时间（epoch秒、datetime或时间戳字符串），默认取系统时间
+        decay_rate: 每小时的衰减率
+        method: exponential（exp(-λt)）或linear（1-λt）
+        min_weight: 权重下限
+        max_weight: 权重上限
+        default: 时间未知时的权重
+        
+    Returns:
+        np.ndarray: 与epochs等长的权重数组
+    """
+    epochs = np.asarray(epochs, dtype=np.float64)
+    now = parse_timestamp(now) if now is not None else 0.0
+    if not now:
+        now = time.time()
+    hours = np.maximum(now - epochs, 0.0) / 3600.0
+    if method == "exponential":
+        weights = np.exp(-decay_rate * hours)
+    else:
+        weights = 1.0 - decay_rate * hours
+    weights = np.clip(weights, min_weight, max_weight)
+    return np.where(epochs > 0, weights, default)
+
+@dataclass
+class RetrievedMemory:
+    """检索到的一条记忆"""
+    id: str
+    user_id: str
+    timestamp: float  # epoch秒，未知时为0.0
+    score: float
+    human: str
+    assistant: str
+    content: str = ""
+    
+    @classmethod
+    def from_result(cls, result: Dict) -> "RetrievedMemory":
+        """
+        从RAG检索结果构建记忆对象
+        
+        Args:
+            result: 包含id、content、metadata、score的检索结果
+            
+        Returns:
+            RetrievedMemory: 记忆对象
+        """
+        metadata = result.get("metadata", {}) or {}
+        content = result.get("content", "") or ""
+        
+        # 私聊记忆使用sender_text/receiver_text，群聊记忆使用human_message/assistant_message
+        human = metadata.get("sender_text", metadata.get("human_message"))
+        assistant = metadata.get("receiver_text", metadata.get("assistant_message"))
+        if human is None and assistant is None:
+            # 旧文档只有content，格式为 "发送者: 消息\n接收者: 回复"
+            lines = content.split("\n", 1)
+            human = lines[0].split(": ", 1)[-1]
+            assistant = lines[1].split(": ", 1)[-1] if len(lines) > 1 else ""
+            
+        return cls(
+            id=result.get("id", ""),
+            user_id=metadata.get("user_id", ""),
+            timestamp=parse_timestamp(metadata.get("epoch") or metadata.get("timestamp")),
+            score=float(result.get("score", 0.0) or 0.0),
+            human=human or "",
+            assistant=assistant or "",
+            content=content
+        )
+        
+    @property
+    def timestamp_str(self) -> str:
+        """格式化的时间戳，未知时为空字符串"""
+        if not self.timestamp:
+            return ""
+        return datetime.fromtimestamp(self.timestamp).strftime(TIMESTAMP_FORMAT)
+        
+    def to_dict(self) -> Dict:
+        """
+        转换为上下文构建使用的字典
+        
+        Returns:
+            Dict: 包含message、reply、timestamp、epoch、score等字段
+        """
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "message": self.human,
+            "reply": self.assistant,
+            "timestamp": self.timestamp_str,
+            "epoch": self.timestamp,
+            "score": self.score
+        }
+        
+    def render(self, index: int) -> str:
+        """
+        渲染为提示词中的记忆文本
+        
+        Args:
+            index: 记忆序号（从1开始）
+            
+        Returns:
+            str: 记忆文本
+        """
+        timestamp = self.timestamp_str or "未知时间"
+        return f"记忆 {index} [{timestamp}] (相关度: {self.score:.2f}):\n{self.content}\n"
@@ -10,10 +10,23 @@ import asyncio
 import time
 import numpy as np
 import math
+import hashlib
+import sqlite3
+import threading
+import zlib
+import gzip
+import bisect
+import gc
+import itertools
+import weakref
+from collections import OrderedDict, deque
 from typing import Dict, List, Any, Optional, Tuple, Union, Callable
 from datetime import datetime
 import re
 
+from src.handlers.memories.core.async_runner import get_async_runner
+from src.handlers.memories.core.memory_utils import parse_timestamp, time_decay_weights
+
 # 设置日志
 logger = logging.getLogger('main')
 
@@ -35,7 +48,8 @@ class RagManager:
     RAG管理器 - 管理检索增强生成相关功能
     """
     
-    def __init__(self, config_path: str, api_wrapper = None, storage_dir = None):
+    def __init__(self, config_path: str, api_wrapper = None, storage_dir = None,
+                 engine: "RagManager" = None, open_storage: bool = True):
         """
         初始化RAG管理器
         
@@ -43,26 +57,37 @@ class RagManager:
             config_path: 配置文件路径
             api_wrapper: API调用包装器
             storage_dir: 存储目录，如果提供则覆盖默认存储路径
+            engine: 共享引擎，提供时复用其配置、嵌入模型和重排序器，只打开自己的存储
+            open_storage: 是否打开存储，仅作为共享引擎时设为False
         """
         self.config_path = config_path
         self.api_wrapper = api_wrapper
         self.storage_dir = storage_dir
         
-        # 加载配置
-        self.config = self._load_config()
-        
-        # 获取当前角色名
-        try:
-            from src.config import config
-            self.avatar_name = config.behavior.context.avatar_dir
-        except Exception as e:
-            logger.error(f"获取角色名失败: {str(e)}")
-            self.avatar_name = "default"
+        if engine is not None:
+            # 复用共享引擎的组件，避免重复读取配置和创建嵌入模型/HTTP客户端
+            self.config = engine.config
+            self.avatar_name = engine.avatar_name
+            self.api_wrapper = engine.api_wrapper
+            self.embedding_model = engine.embedding_model
+            self.reranker = engine.reranker
+        else:
+            # 加载配置
+            self.config = self._load_config()
+            
+            # 获取当前角色名
+            try:
+                from src.config import config
+                self.avatar_name = config.behavior.context.avatar_dir
+            except Exception as e:
+                logger.error(f"获取角色名失败: {str(e)}")
+                self.avatar_name = "default"
+            
+            # 初始化组件
+            self.embedding_model = self._init_embedding_model()
+            self.reranker = self._init_reranker() if self.config.get("is_rerank", False) else None
         
-        # 初始化组件
-        self.embedding_model = self._init_embedding_model()
-        self.storage = self._init_storage()
-        self.reranker = self._init_reranker() if self.config.get("is_rerank", False) else None
+        self.storage = self._init_storage() if open_storage else None
         
         # 记录状态
         self.document_count = 0
@@ -74,6 +99,16 @@ class RagManager:
         # 设置是否启用混合搜索作为备选
         self.enable_hybrid_fallback = True
         
+        # 查询结果缓存：键 -> (语料版本, 写入时间, 结果)
+        self._query_cache = OrderedDict()
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+        
+        # 后台分层压缩状态：上次压缩时间持久化在存储旁，重启后不会立即触发全量压缩
+        self._last_compaction = self._load_compaction_time()
+        self._compaction_running = False
+        self._compaction_task = None
+        
         logger.info(f"RAG管理器初始化完成，角色: {self.avatar_name}，使用嵌入模型: {self.config.get('embedding_model', {}).get('name', 'default')}，标准向量维度: {self.standard_vector_dim}")
         
     def _load_config(self) -> Dict:
@@ -117,13 +152,61 @@ class RagManager:
             },
             "storage": {
                 "type": "json",
-                "path": "./data/rag_storage.json"
+                "path": "./data/rag_storage.json",
+                "ann_index": {
+                    "enabled": False,
+                    "nprobe": 8,
+                    "min_documents": 5000
+                },
+                "quantization": {
+                    # none、int8（推荐：内存为1/4，扫描更快）或float16（只节省内存，扫描比float32慢）
+                    "mode": "none",
+                    "rescore": True,
+                    "rescore_factor": 4
+                },
+                "projection": {
+                    "mode": "none",
+                    "dim": 256,
+                    "min_fit_documents": 1000
+                }
+            },
+            "embedding_cache": {
+                "path": "./data/cache/embedding_cache.db",
+                "memory_size": 1000,
+                "disk_max_mb": 256
+            },
+            "dedup": {
+                "enabled": True,
+                "max_distance": 3
+            },
+            "compaction": {
+                "enabled": True,
+                "interval_hours": 6,
+                "session_gap_minutes": 120,
+                "cold_after_days": 7,
+                "min_session_documents": 3,
+                "max_hot_documents": 500,
+                "max_sessions_per_run": 20
+            },
+            "query_cache": {
+                "enabled": True,
+                "max_size": 256,
+                "ttl": 300
             },
             "top_k": rag_config.RAG_TOP_K,
             "is_rerank": rag_config.RAG_IS_RERANK,
             "reranker": {
-                "type": "api",
-                "name": rag_config.RAG_RERANKER_MODEL or "rerank-large"
+                "type": "local",
+                "name": rag_config.RAG_RERANKER_MODEL or "rerank-large",
+                "weights": {
+                    "embedding": 0.5,
+                    "bm25": 0.2,
+                    "recency": 0.15,
+                    "entity": 0.15
+                },
+                "half_life_days": 30,
+                "cache_size": 1024,
+                "cache_ttl": 600
             },
             "local_model": {
                 "enabled": rag_config.LOCAL_MODEL_ENABLED,
@@ -191,7 +274,7 @@ class RagManager:
                 logger.info(f"尝试加载本地嵌入模型: {local_model_path}")
                 # 这里可以实现本地模型的加载逻辑
                 # 为了降低内存占用，本地模型加载可以懒加载或使用更轻量的实现
-                return LocalEmbeddingModel(local_model_path)
+                return LocalEmbeddingModel(local_model_path, cache=self._init_embedding_cache())
             except Exception as e:
                 logger.error(f"加载本地嵌入模型失败: {str(e)}，将使用API模型")
         
@@ -230,7 +313,27 @@ class RagManager:
         
         # 使用API模型
         logger.info(f"使用API嵌入模型: {model_name}")
-        return ApiEmbeddingModel(self.api_wrapper, model_name, model_type)
+        return ApiEmbeddingModel(
+            self.api_wrapper, model_name, model_type,
+            batch_size=model_config.get("batch_size", 64),
+            batch_max_tokens=model_config.get("batch_max_tokens", 16000),
+            batch_window_ms=model_config.get("batch_window_ms", 20),
+            cache=self._init_embedding_cache()
+        )
+        
+    def _init_embedding_cache(self) -> "EmbeddingCache":
+        """
+        获取共享的两级嵌入向量缓存
+        
+        Returns:
+            EmbeddingCache: 缓存实例
+        """
+        cache_config = self.config.get("embedding_cache", {})
+        return get_embedding_cache(
+            cache_config.get("path", os.path.join("data", "cache", "embedding_cache.db")),
+            memory_size=cache_config.get("memory_size", 1000),
+            disk_max_mb=cache_config.get("disk_max_mb", 256)
+        )
     
     def _init_storage(self):
         """
@@ -252,7 +355,7 @@ class RagManager:
             os.makedirs(self.storage_dir, exist_ok=True)
             
             logger.info(f"初始化RAG存储: {storage_type}, 使用自定义路径: {avatar_storage_path}")
-            return JsonStorage(avatar_storage_path)
+            return self._create_storage(storage_type, avatar_storage_path)
         
         # 否则使用角色专属的存储路径，确保与memory.json在同一文件夹
         base_storage_path = storage_config.get("path", "./data/rag_storage.json")
@@ -266,7 +369,42 @@ class RagManager:
         os.makedirs(avatar_storage_dir, exist_ok=True)
         
         logger.info(f"初始化RAG存储: {storage_type}, 路径: {avatar_storage_path}")
-        return JsonStorage(avatar_storage_path)
+        return self._create_storage(storage_type, avatar_storage_path)
+    
+    def _create_storage(self, storage_type: str, storage_path: str):
+        """
+        按存储类型创建存储实例
+        
+        Args:
+            storage_type: 存储类型，json或binary
+            storage_path: 存储文件路径
+            
+        Returns:
+            存储系统实例
+        """
+        if storage_type == "binary":
+            storage = BinaryStorage(storage_path)
+        else:
+            if storage_type != "json":
+                logger.warning(f"未知的存储类型: {storage_type}，使用json存储")
+            storage = JsonStorage(storage_path)
+            
+        # 可选的降维投影，需在量化和ANN索引之前生效
+        projection_config = self.config.get("storage", {}).get("projection", {})
+        if projection_config.get("mode", "none") != "none":
+            storage.enable_projection(projection_config)
+            
+        # 可选的近似最近邻索引
+        ann_config = self.config.get("storage", {}).get("ann_index", {})
+        if ann_config.get("enabled", False):
+            storage.enable_ann_index(ann_config)
+            
+        # 可选的量化检索
+        quant_config = self.config.get("storage", {}).get("quantization", {})
+        if quant_config.get("mode", "none") != "none":
+            storage.enable_quantization(quant_config)
+            
+        return storage
     
     def _init_reranker(self):
         """
@@ -284,8 +422,19 @@ class RagManager:
         
         logger.info(f"初始化重排序器: {reranker_type}, 模型: {reranker_name}")
         
+        # 本地特征重排序器，不访问网络
+        if reranker_type == "local":
+            return LocalReranker(
+                weights=reranker_config.get("weights"),
+                half_life_days=reranker_config.get("half_life_days", 30),
+                cache_size=reranker_config.get("cache_size", 1024),
+                cache_ttl=reranker_config.get("cache_ttl", 600)
+            )
+            
         # 使用API重排序器
-        return ApiReranker(self.api_wrapper, reranker_name)
+        return ApiReranker(self.api_wrapper, reranker_name,
+                           cache_size=reranker_config.get("cache_size", 1024),
+                           cache_ttl=reranker_config.get("cache_ttl", 600))
     
     def _ensure_valid_path(self, path: str) -> str:
         """
@@ -369,6 +518,10 @@ class RagManager:
                 logger.warning(f"文档格式无效: {document}")
                 return False
                 
+            # 近似重复的内容合并到已有文档，不再请求嵌入向量
+            if self._merge_if_duplicate(document, user_id or SimHashIndex.owner_key(document.get("metadata", {}))):
+                return True
+                
             # 生成嵌入向量
             content = document.get("content", "")
             embedding = await self.embedding_model.get_embedding(content)
@@ -398,14 +551,103 @@ class RagManager:
             if success:
                 self.document_count = self.storage.get_document_count()
                 logger.info(f"成功添加文档到RAG系统，当前文档数: {self.document_count}")
+                self._maybe_schedule_compaction()
             
             return success
         except Exception as e:
             logger.error(f"添加文档失败: {str(e)}")
             return False
     
+    async def add_documents(self, documents: List[Dict], user_id: str = None) -> int:
+        """
+        批量添加文档到RAG系统，嵌入向量按批请求
+        
+        Args:
+            documents: 文档字典列表
+            user_id: 用户ID，用于标识文档所属用户
+            
+        Returns:
+            int: 成功添加的文档数
+        """
+        try:
+            valid_documents = [doc for doc in documents if self._validate_document(doc)]
+            if len(valid_documents) < len(documents):
+                logger.warning(f"跳过 {len(documents) - len(valid_documents)} 个格式无效的文档")
+                
+            # 近似重复的内容合并到已有文档，不再请求嵌入向量
+            merged = 0
+            unique_documents = []
+            for doc in valid_documents:
+                if self._merge_if_duplicate(doc, user_id or SimHashIndex.owner_key(doc.get("metadata", {}))):
+                    merged += 1
+                else:
+                    unique_documents.append(doc)
+            valid_documents = unique_documents
+            if not valid_documents:
+                return merged
+                
+            # 生成嵌入向量
+            contents = [doc.get("content", "") for doc in valid_documents]
+            if hasattr(self.embedding_model, "get_embeddings"):
+                embeddings = await self.embedding_model.get_embeddings(contents)
+            else:
+                embeddings = [await self.embedding_model.get_embedding(content) for content in contents]
+                
+            added = 0
+            for document, embedding in zip(valid_documents, embeddings):
+                if embedding is None:
+                    continue
+                    
+                standardized_embedding = self._standardize_vector_dimension(embedding)
+                document["embedding"] = standardized_embedding
+                if self.standard_vector_dim is None:
+                    self.standard_vector_dim = len(standardized_embedding)
+                    
+                if user_id:
+                    document.setdefault("metadata", {})["user_id"] = user_id
+                    
+                if self.storage.add_document(document):
+                    added += 1
+                    
+            self.document_count = self.storage.get_document_count()
+            logger.info(f"批量添加文档完成: {added}/{len(documents)}，合并重复 {merged} 个，当前文档数: {self.document_count}")
+            return added + merged
+        except Exception as e:
+            logger.error(f"批量添加文档失败: {str(e)}")
+            return 0
+    
+    def _merge_if_duplicate(self, document: Dict, owner: str = None) -> Optional[str]:
+        """
+        入库前的近似重复检测，重复时合并到已有文档（增加命中次数、更新最近出现时间）
+        
+        Args:
+            document: 待添加的文档
+            owner: 文档所有者（metadata.user_id，群聊消息为"group:群ID"）
+            
+        Returns:
+            Optional[str]: 已作为重复内容合并时返回被合并到的文档ID，否则返回None
+        """
+        try:
+            dedup_config = self.config.get("dedup", {})
+            if not dedup_config.get("enabled", True) or not hasattr(self.storage, "find_near_duplicate"):
+                return None
+                
+            duplicate = self.storage.find_near_duplicate(
+                document.get("content", ""), owner, dedup_config.get("max_distance", 3)
+            )
+            # 同ID视为更新，不做合并
+            if duplicate is None or duplicate.get("id") == document.get("id"):
+                return None
+                
+            self.storage.merge_duplicate(duplicate["id"], document.get("metadata", {}).get("timestamp"))
+            logger.info(f"检测到近似重复内容，已合并到文档 {duplicate['id']}")
+            return duplicate["id"]
+        except Exception as e:
+            logger.error(f"近似重复检测失败: {str(e)}")
+            return None
+            
     def _standardize_vector_dimension(self, vector):
-        """统一向量维度到标准尺寸"""
+        """统一向量维度到标准尺寸（存储启用降维投影时保留原始向量，由投影统一维度）"""
         if not isinstance(vector, list) and not (hasattr(vector, 'shape') and hasattr(vector, 'tolist')):
             # 如果不是列表或numpy数组，尝试转换
             try:
@@ -418,6 +660,9 @@ class RagManager:
         if hasattr(vector, 'tolist'):
             vector = vector.tolist()
             
+        if getattr(self.storage, 'projection_enabled', False):
+            return vector
+            
         # 如果没有设置标准维度，以当前向量维度为准
         if self.standard_vector_dim is None:
             self.standard_vector_dim = len(vector)
@@ -524,6 +769,12 @@ class RagManager:
             if top_k is None:
                 top_k = self.config.get("top_k", 5)
                 
+            # 语料未变化时直接返回缓存结果，跳过嵌入请求和向量扫描
+            cache_key = self._query_cache_key(query_text, top_k)
+            cached = self._get_cached_query(cache_key)
+            if cached is not None:
+                return cached
+                
             # 生成查询嵌入向量
             query_embedding = await self.embedding_model.get_embedding(query_text)
             
@@ -558,6 +809,7 @@ class RagManager:
                 results = results[:top_k]  # 直接截取top_k个结果
                 
             logger.info(f"查询成功，找到 {len(results)} 个相关文档，角色: {self.avatar_name}")
+            self._put_cached_query(cache_key, results)
             return results
         except Exception as e:
             logger.error(f"向量查询失败: {str(e)}，尝试使用混合特征备选方法")
@@ -565,9 +817,51 @@ class RagManager:
                 return self.hybrid_feature_search(query_text, top_k)
             return []
     
+    def _query_cache_key(self, query_text: str, top_k: int) -> Tuple:
+        """
+        生成查询缓存键：(规范化查询, top_k, 角色)
+        """
+        normalized = " ".join((query_text or "").split()).lower()
+        return normalized, top_k, self.avatar_name
+        
+    def _get_cached_query(self, key: Tuple) -> Optional[List[Dict]]:
+        """
+        查询结果缓存，语料版本变化或过期时视为未命中
+        
+        Returns:
+            Optional[List[Dict]]: 结果副本，未命中时为None
+        """
+        cache_config = self.config.get("query_cache", {})
+        if not cache_config.get("enabled", True):
+            return None
+        entry = self._query_cache.get(key)
+        if (entry is None or entry[0] != getattr(self.storage, "version", None)
+                or time.time() - entry[1] > cache_config.get("ttl", 300)):
+            self._query_cache.pop(key, None)
+            self.query_cache_misses += 1
+            return None
+        self._query_cache.move_to_end(key)
+        self.query_cache_hits += 1
+        return [dict(result) for result in entry[2]]
+        
+    def _put_cached_query(self, key: Tuple, results: List[Dict]):
+        """
+        写入查询结果缓存，标记当前语料版本
+        """
+        cache_config = self.config.get("query_cache", {})
+        if not cache_config.get("enabled", True) or not hasattr(self.storage, "version"):
+            return
+        self._query_cache[key] = (self.storage.version, time.time(), [dict(result) for result in results])
+        self._query_cache.move_to_end(key)
+        while len(self._query_cache) > cache_config.get("max_size", 256):
+            self._query_cache.popitem(last=False)
+            
     def hybrid_feature_search(self, query_text: str, top_k: int = 5) -> List[Dict]:
         """
-        使用混合特征搜索，包括TF-IDF特征和嵌入特征
+        使用混合特征搜索，包括BM25关键词特征、时间衰减和内容质量
+        
+        候选文档来自存储维护的关键词倒排索引，只有与查询有关键词重叠的文档
+        （不足时补充最近的文档）才参与打分，耗时不随总文档数线性增长
         
         Args:
             query_text: 查询文本
@@ -579,56 +873,52 @@ class RagManager:
         try:
             logger.info(f"开始混合特征搜索: {query_text[:30]}...")
             
-            # 获取所有文档
-            all_documents = self.storage.data.get("documents", [])
+            from difflib import SequenceMatcher
             
-            # 过滤出当前角色的文档
-            documents = []
-            for doc in all_documents:
-                metadata = doc.get("metadata", {})
-                doc_user_id = metadata.get("user_id", "")
-                # 检查文档是否属于当前角色（支持多种可能的元数据字段）
-                if (doc_user_id == self.avatar_name or 
-                    metadata.get("ai_name") == self.avatar_name or
-                    metadata.get("avatar_name") == self.avatar_name):
-                    documents.append(doc)
+            keyword_index = self.storage.get_keyword_index()
             
-            if not documents:
+            # 对查询文本进行分词，并通过倒排索引获取候选文档
+            query_tokens = KeywordIndex.tokenize(query_text)
+            candidate_limit = max(top_k * 10, 50)
+            candidates = keyword_index.search(query_tokens, owner=self.avatar_name, limit=candidate_limit)
+            
+            # 关键词命中不足时补充最近的文档，保持原有的时间衰减偏好
+            if len(candidates) < top_k:
+                seen = {doc.get("id") for doc, _, _ in candidates}
+                for doc, docno in keyword_index.recent(self.avatar_name, candidate_limit):
+                    if doc.get("id") not in seen:
+                        candidates.append((doc, 0.0, docno))
+                        
+            if not candidates:
                 logger.warning(f"未找到角色 {self.avatar_name} 的文档")
                 return []
-            
-            # 导入所需库
-            import jieba
-            from difflib import SequenceMatcher
-            from datetime import datetime
-            import math
-            import re
-            
+                
             # 当前时间
             current_time = datetime.now()
             
             # 最新消息的轮数（用于计算轮数差）
-            latest_turn = 0
-            for doc in documents:
-                metadata = doc.get("metadata", {})
-                turn = metadata.get("turn", 0)
-                if turn > latest_turn:
-                    latest_turn = turn
+            latest_turn = keyword_index.owner_max_turn.get(self.avatar_name, 0)
+            
+            # BM25分数归一化到0-1
+            max_bm25 = max((score for _, score, _ in candidates), default=0.0) or 1.0
             
-            # 对查询文本进行分词
-            query_words = set(jieba.cut(query_text))
+            # 提取查询中的实体、日期、时间、数字等
+            entities = re.findall(r'[一-龥]{2,}|[A-Za-z]{2,}|\d{2,}', query_text)
             
-            # 计算每个文档的混合特征分数
+            # 整个候选集的时间衰减权重一次性计算，时间未知时取中等权重
+            time_weights = time_decay_weights(
+                [self._document_epoch(doc) for doc, _, _ in candidates], current_time,
+                decay_rate=0.05, min_weight=0.1, max_weight=1.0, default=0.5
+            )
+            
+            # 计算每个候选文档的混合特征分数
             scored_docs = []
-            for doc in documents:
+            for i, (doc, bm25_score, docno) in enumerate(candidates):
                 content = doc.get("content", "")
                 metadata = doc.get("metadata", {})
                 
                 # 1. 时间衰减 (40%)
-                time_weight = 0.5  # 默认中等权重
-                timestamp = metadata.get("timestamp", "")
-                if timestamp:
-                    time_weight = self._calculate_time_decay_weight(timestamp, current_time)
+                time_weight = float(time_weights[i])
                 
                 # 2. 对话轮数之差 (25%)
                 turn_weight = 0.5  # 默认中等权重
@@ -641,64 +931,22 @@ class RagManager:
                     turn_weight = max(0.1, min(1.0, turn_weight))
                 
                 # 3. 匹配程度 (15%)
-                match_weight = 0.1  # 默认低权重
-                
-                # 3.1 关键词匹配
-                doc_words = set(jieba.cut(content))
-                keyword_matches = query_words.intersection(doc_words)
-                keyword_score = len(keyword_matches) / max(len(query_words), 1)
+                # 3.1 关键词匹配（BM25）
+                keyword_score = bm25_score / max_bm25
                 
                 # 3.2 序列匹配
                 sequence_score = SequenceMatcher(None, query_text, content).ratio()
                 
                 # 3.3 正则表达式匹配关键概念
-                # 提取查询中的实体、日期、时间、数字等
-                entities = re.findall(r'[\u4e00-\u9fa5]{2,}|[A-Za-z]{2,}|\d{2,}', query_text)
-                entity_matches = 0
-                for entity in entities:
-                    if entity in content:
-                        entity_matches += 1
+                entity_matches = sum(1 for entity in entities if entity in content)
                 entity_score = entity_matches / max(len(entities), 1)
                 
                 # 组合不同的匹配分数
                 match_weight = 0.4 * keyword_score + 0.3 * sequence_score + 0.3 * entity_score
                 match_weight = max(0.1, min(1.0, match_weight))
                 
-                # 4. 内容质量 (20%)
-                quality_weight = 0.5  # 默认中等质量
-                
-                # 4.1 长度评分（假设长度适中的内容质量更高）
-                content_length = len(content)
-                length_score = 0
-                if content_length < 10:
-                    length_score = 0.2  # 太短
-                elif content_length < 50:
-                    length_score = 0.5  # 较短
-                elif content_length < 200:
-                    length_score = 1.0  # 适中
-                elif content_length < 500:
-                    length_score = 0.8  # 较长
-                else:
-                    length_score = 0.6  # 太长
-                
-                # 4.2 信息密度（关键词密度）
-                keywords = ["什么", "为什么", "怎么", "何时", "何地", "谁", "哪里"]
-                keyword_density = sum(1 for word in keywords if word in content) / max(len(content) / 10, 1)
-                density_score = min(1.0, keyword_density * 2)
-                
-                # 4.3 特殊属性评分
-                special_score = 0.5
-                # 包含问答对，质量可能更高
-                if "?" in content or "？" in content:
-                    special_score += 0.3
-                # 包含引号，可能是引用内容，质量更高
-                if "\"" in content or "\"" in content or "'" in content:
-                    special_score += 0.2
-                special_score = min(1.0, special_score)
-                
-                # 组合不同的质量分数
-                quality_weight = 0.4 * length_score + 0.3 * density_score + 0.3 * special_score
-                quality_weight = max(0.1, min(1.0, quality_weight))
+                # 4. 内容质量 (20%)，写入索引时已预先计算
+                quality_weight = keyword_index.get_quality(doc.get("id"))
                 
                 # 最终混合分数（按权重组合）
                 final_score = (
@@ -708,18 +956,11 @@ class RagManager:
                     0.2 * quality_weight      # 内容质量 (20%)
                 )
                 
-                # 存储计算结果
                 scored_docs.append({
                     "id": doc.get("id"),
                     "content": content,
                     "metadata": metadata,
-                    "score": final_score,
-                    "_debug": {
-                        "time_weight": time_weight,
-                        "turn_weight": turn_weight,
-                        "match_weight": match_weight,
-                        "quality_weight": quality_weight
-                    }
+                    "score": final_score
                 })
             
             # 按分数排序
@@ -728,12 +969,7 @@ class RagManager:
             # 截取top_k个结果
             results = scored_docs[:top_k]
             
-            # 移除调试信息
-            for doc in results:
-                if "_debug" in doc:
-                    del doc["_debug"]
-            
-            logger.info(f"混合特征搜索完成，找到 {len(results)} 个相关文档")
+            logger.info(f"混合特征搜索完成，候选 {len(candidates)} 个，返回 {len(results)} 个相关文档")
             return results
         except Exception as e:
             logger.error(f"混合特征搜索失败: {str(e)}")
@@ -834,32 +1070,242 @@ class RagManager:
             if not documents:
                 return "没有可用的记忆。"
                 
-            # 格式化记忆
-            memory_text = ""
-            for i, doc in enumerate(documents):
-                content = doc.get("content", "")
-                metadata = doc.get("metadata", {})
-                timestamp = metadata.get("timestamp", "未知时间")
-                memory_text += f"记忆 {i+1} [{timestamp}]:\n{content}\n\n"
+            return await self._summarize_documents(documents) or "无法生成摘要"
+        except Exception as e:
+            logger.error(f"生成记忆摘要失败: {str(e)}")
+            return "生成摘要时出错"
+            
+    async def _summarize_documents(self, documents: List[Dict],
+                                   instruction: str = "请提供一个简洁的摘要，包含关键信息点和重要的细节。") -> Optional[str]:
+        """
+        调用API总结一组记忆文档
+        
+        Args:
+            documents: 记忆文档列表
+            instruction: 附加在记忆之后的摘要要求
             
-            # 构造摘要请求
-            prompt = f"""请根据以下对话记忆，总结出重要的信息点：
+        Returns:
+            Optional[str]: 摘要内容，API调用失败时为None，未返回内容时为空字符串
+        """
+        # 格式化记忆
+        memory_text = ""
+        for i, doc in enumerate(documents):
+            content = doc.get("content", "")
+            metadata = doc.get("metadata", {})
+            timestamp = metadata.get("timestamp", "未知时间")
+            memory_text += f"记忆 {i+1} [{timestamp}]:\n{content}\n\n"
+        
+        # 构造摘要请求
+        prompt = f"""请根据以下对话记忆，总结出重要的信息点：
 
 {memory_text}
 
-请提供一个简洁的摘要，包含关键信息点和重要的细节。"""
+{instruction}"""
 
-            # 调用API生成摘要
-            response = await self.api_wrapper.async_completion(
-                prompt=prompt,
-                temperature=0.3,
-                max_tokens=500
-            )
+        # 调用API生成摘要
+        response = await self.api_wrapper.async_completion(
+            prompt=prompt,
+            temperature=0.3,
+            max_tokens=500
+        )
+        if response.get("error"):
+            return None
+        return response.get("content") or ""
+        
+    def _compaction_state_path(self) -> Optional[str]:
+        """上次压缩时间的状态文件路径，与存储文件同目录"""
+        file_path = getattr(self.storage, "file_path", None)
+        return os.path.splitext(file_path)[0] + ".compaction.json" if file_path else None
+        
+    def _load_compaction_time(self) -> float:
+        """
+        读取上次压缩时间
+        
+        Returns:
+            float: 上次压缩的epoch秒；没有记录时取当前时间，首次压缩在一个间隔之后进行
+        """
+        path = self._compaction_state_path()
+        try:
+            if path and os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    return float(json.load(f).get("last_compaction", 0.0))
+        except Exception as e:
+            logger.warning(f"读取记忆压缩状态失败: {str(e)}")
+        return time.time()
+        
+    def _save_compaction_time(self):
+        """持久化上次压缩时间"""
+        path = self._compaction_state_path()
+        if not path:
+            return
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"last_compaction": self._last_compaction}, f)
+        except Exception as e:
+            logger.warning(f"保存记忆压缩状态失败: {str(e)}")
             
-            return response.get("content", "无法生成摘要")
+    def _maybe_schedule_compaction(self):
+        """距上次压缩超过配置的间隔时，在记忆系统的后台事件循环中安排一次压缩，不占用聊天循环"""
+        try:
+            compaction_config = self.config.get("compaction", {})
+            if not compaction_config.get("enabled", True) or not self.api_wrapper or self._compaction_running:
+                return
+            if time.time() - self._last_compaction < compaction_config.get("interval_hours", 6) * 3600:
+                return
+                
+            self._last_compaction = time.time()
+            self._save_compaction_time()
+            self._compaction_task = get_async_runner().submit(self.compact_sessions())
         except Exception as e:
-            logger.error(f"生成记忆摘要失败: {str(e)}")
-            return "生成摘要时出错"
+            logger.error(f"安排记忆压缩失败: {str(e)}")
+            
+    async def compact_sessions(self, now: float = None) -> int:
+        """
+        分层压缩：按时间间隔把每个对话对象的历史切分为会话，将冷会话总结为一条摘要文档，
+        原始对话移入不参与检索的压缩归档段，使可检索的文档数保持有界
+        
+        Args:
+            now: 当前时间（epoch秒），默认取系统时间
+            
+        Returns:
+            int: 归档的原始文档数
+        """
+        if self._compaction_running:
+            return 0
+        self._compaction_running = True
+        try:
+            if not self.api_wrapper or not hasattr(self.storage, "archive_documents"):
+                return 0
+                
+            compaction_config = self.config.get("compaction", {})
+            now = now or time.time()
+            session_gap = compaction_config.get("session_gap_minutes", 120) * 60
+            cold_before = now - compaction_config.get("cold_after_days", 7) * 86400
+            min_documents = compaction_config.get("min_session_documents", 3)
+            max_hot = compaction_config.get("max_hot_documents", 500)
+            max_sessions = compaction_config.get("max_sessions_per_run", 20)
+            
+            # 按(角色, 对话对象)分组原始对话，摘要文档本身不再压缩
+            histories = {}
+            for doc in self.storage.data.get("documents", []):
+                metadata = doc.get("metadata", {})
+                if metadata.get("type") == "session_summary":
+                    continue
+                epoch = self._document_epoch(doc)
+                if not epoch:
+                    continue
+                key = (metadata.get("user_id"), metadata.get("sender") or metadata.get("group_id") or "")
+                histories.setdefault(key, []).append((epoch, doc))
+                
+            # 每次最多总结max_sessions个会话，其余留到下一次，避免一次压缩连续发起大量API调用
+            batches = [(owner, session) for (owner, _), history in histories.items()
+                       for session in self._select_cold_sessions(history, session_gap, cold_before,
+                                                                 min_documents, max_hot)]
+            if len(batches) > max_sessions:
+                logger.info(f"待压缩会话 {len(batches)} 个，本次处理 {max_sessions} 个")
+                batches = batches[:max_sessions]
+                
+            archived = 0
+            for owner, session in batches:
+                archived += await self._compact_session(owner, session)
+                
+            if archived:
+                self.document_count = self.storage.get_document_count()
+                logger.info(f"记忆压缩完成，归档 {archived} 条原始对话，当前文档数: {self.document_count}")
+            return archived
+        except Exception as e:
+            logger.error(f"压缩记忆会话失败: {str(e)}")
+            return 0
+        finally:
+            self._compaction_running = False
+            self._last_compaction = time.time()
+            self._save_compaction_time()
+            
+    @staticmethod
+    def _select_cold_sessions(history: List[Tuple[float, Dict]], session_gap: float, cold_before: float,
+                              min_documents: int, max_hot: int) -> List[List[Dict]]:
+        """
+        将一个对话对象的历史切分为会话，并选出需要压缩的冷会话
+        
+        Args:
+            history: (epoch秒, 文档)列表
+            session_gap: 相邻两条超过该间隔（秒）视为新会话
+            cold_before: 结束时间早于该时间的会话视为冷会话
+            min_documents: 过短的相邻冷会话合并后再总结，避免逐条调用API
+            max_hot: 保留的可检索原始文档上限，超出时从最旧的会话开始压缩
+            
+        Returns:
+            List[List[Dict]]: 按时间顺序排列的待压缩文档组
+        """
+        history = sorted(history, key=lambda item: item[0])
+        sessions = []
+        for epoch, doc in history:
+            if sessions and epoch - sessions[-1][-1][0] <= session_gap:
+                sessions[-1].append((epoch, doc))
+            else:
+                sessions.append([(epoch, doc)])
+                
+        # 最后一个会话可能仍在进行，始终保留
+        hot = len(history)
+        batches = []
+        pending = []
+        for session in sessions[:-1]:
+            if session[-1][0] >= cold_before and hot <= max_hot:
+                break
+            pending.extend(doc for _, doc in session)
+            hot -= len(session)
+            if len(pending) >= min_documents:
+                batches.append(pending)
+                pending = []
+        if pending:
+            batches.append(pending)
+        return batches
+        
+    async def _compact_session(self, owner: Optional[str], documents: List[Dict]) -> int:
+        """
+        将一组冷会话总结为摘要文档，并把原始对话移入归档段
+        
+        Args:
+            owner: 文档所有者（metadata.user_id）
+            documents: 按时间排序的原始文档
+            
+        Returns:
+            int: 归档的原始文档数，摘要失败时为0（保留原始对话）
+        """
+        summary = await self._summarize_documents(
+            documents, "请用一段简洁的话总结这次对话，保留人物、事件、偏好和约定等关键信息。"
+        )
+        if not summary:
+            logger.warning(f"会话摘要生成失败，保留 {len(documents)} 条原始对话")
+            return 0
+            
+        first_meta = documents[0].get("metadata", {})
+        last_meta = documents[-1].get("metadata", {})
+        doc_ids = [doc.get("id") for doc in documents]
+        metadata = {
+            key: last_meta[key] for key in ("sender", "receiver", "group_id") if key in last_meta
+        }
+        metadata.update({
+            "type": "session_summary",
+            "timestamp": last_meta.get("timestamp", ""),
+            "session_start": first_meta.get("timestamp", ""),
+            "session_end": last_meta.get("timestamp", ""),
+            "document_count": len(documents),
+            "archived_ids": doc_ids
+        })
+        if owner is not None:
+            metadata["user_id"] = owner
+            
+        summary_doc = {
+            "id": "session_summary_" + hashlib.md5("|".join(doc_ids).encode("utf-8")).hexdigest()[:16],
+            "content": f"[{metadata['session_start']} ~ {metadata['session_end']}] 会话摘要: {summary}",
+            "metadata": metadata
+        }
+        if not await self.add_document(summary_doc):
+            logger.warning(f"会话摘要入库失败，保留 {len(documents)} 条原始对话")
+            return 0
+            
+        return self.storage.archive_documents(doc_ids)
             
     def clear_storage(self, user_id: str = None) -> bool:
         """
@@ -872,16 +1318,7 @@ class RagManager:
             bool: 是否成功清空
         """
         try:
-            if user_id:
-                # 只清空指定角色的记忆
-                self.data["documents"] = [doc for doc in self.data.get("documents", [])
-                                        if doc.get("metadata", {}).get("user_id") != user_id]
-            else:
-                # 清空所有记忆
-                self.data = {"documents": []}
-            
-            self._save_data()
-            return True
+            return self.storage.clear(user_id)
         except Exception as e:
             logger.error(f"清空存储失败: {str(e)}")
             return False
@@ -900,24 +1337,17 @@ class RagManager:
             List[Dict]: 最近的消息列表
         """
         try:
-            if not hasattr(self.storage, 'data') or 'group_chats' not in self.storage.data:
+            if not hasattr(self.storage, 'get_group_store'):
                 logger.warning(f"群聊存储未初始化")
                 return []
             
-            if group_id not in self.storage.data['group_chats']:
+            group_store = self.storage.get_group_store(group_id)
+            if group_store is None:
                 logger.warning(f"群聊 {group_id} 在RAG存储中不存在")
                 return []
             
-            messages = self.storage.data['group_chats'][group_id]
-            messages.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-            
-            if current_timestamp:
-                messages = [msg for msg in messages if msg.get('timestamp') != current_timestamp]
-            
-            recent_messages = messages[:top_k]
-            recent_messages.sort(key=lambda x: x.get('timestamp', ''))
-            
-            return recent_messages
+            # 从按时间排序的环形缓冲区读取最近消息
+            return group_store.latest(top_k, current_timestamp)
         except Exception as e:
             logger.error(f"查询群聊上下文失败: {str(e)}")
             return []
@@ -934,14 +1364,7 @@ class RagManager:
             bool: 是否成功添加
         """
         try:
-            if not hasattr(self.storage, 'data'):
-                self.storage.data = {}
-            
-            if 'group_chats' not in self.storage.data:
-                self.storage.data['group_chats'] = {}
-            
-            if group_id not in self.storage.data['group_chats']:
-                self.storage.data['group_chats'][group_id] = []
+            group_store = self.storage.get_group_store(group_id, create=True)
             
             # 提取消息信息
             timestamp = message.get('timestamp', '')
@@ -968,28 +1391,39 @@ class RagManager:
                 }
             }
             
-            # 查找是否存在相同时间戳的消息
-            existing_messages = [msg for msg in self.storage.data['group_chats'][group_id] 
-                                if msg.get('timestamp') == timestamp]
-            
-            if existing_messages:
-                for existing_msg in existing_messages:
-                    existing_msg.update(message)
-            else:
-                self.storage.data['group_chats'][group_id].append(message)
+            # 相同时间戳的消息合并更新，否则追加
+            group_store.add(message)
             
             # 保存原始消息格式到group_chats
             self.storage._save_data()
             
+            # 同一群内近似重复的消息合并到已有文档，不再请求嵌入向量；
+            # 该时间戳映射到被合并的文档，后续的助手回复更新到该文档
+            merged_id = self._merge_if_duplicate(rag_message, SimHashIndex.owner_key(rag_message["metadata"]))
+            if merged_id:
+                group_store.doc_ids[timestamp] = merged_id
+                return True
+            
             # 构建用于嵌入的内容
             content_for_embedding = self._format_content_for_rag(human_message, assistant_message, sender_name)
             
+            # 等待嵌入向量之前先登记文档ID，期间到达的助手回复能找到该时间戳对应的文档
+            group_store.doc_ids[timestamp] = rag_message["id"]
+            
             # 获取嵌入向量
             embedding = await self.embedding_model.get_embedding(content_for_embedding)
+            added = False
             if embedding:
                 rag_message["embedding"] = embedding
+                # 等待期间助手回复可能已写入群聊存储（此时文档尚未入库，无法更新），按最新的消息重建内容
+                latest = group_store.get(timestamp) or message
+                assistant_message = latest.get('assistant_message')
+                rag_message["content"] = self._format_content_for_rag(human_message, assistant_message, sender_name)
+                rag_message["metadata"]["assistant_message"] = assistant_message
                 # 使用RAG格式添加文档，确保rag_storage.json中的格式正确
-                self.storage.add_document(rag_message)
+                added = self.storage.add_document(rag_message)
+            if not added and group_store.doc_ids.get(timestamp) == rag_message["id"]:
+                del group_store.doc_ids[timestamp]
             
             return True
         except Exception as e:
@@ -1016,201 +1450,664 @@ class RagManager:
             bool: 是否成功更新
         """
         try:
-            if not hasattr(self.storage, 'data') or 'group_chats' not in self.storage.data:
+            if not hasattr(self.storage, 'get_group_store'):
                 logger.warning(f"群聊存储未初始化")
                 return False
             
-            if group_id not in self.storage.data['group_chats']:
+            group_store = self.storage.get_group_store(group_id)
+            if group_store is None:
                 logger.warning(f"群聊 {group_id} 在RAG存储中不存在")
                 return False
             
-            found = False
-            sender_name = ""
-            human_message = ""
-            
             # 更新memory.json格式的消息
-            for message in self.storage.data['group_chats'][group_id]:
-                if message.get('timestamp') == timestamp:
-                    message['assistant_message'] = response
-                    sender_name = message.get('sender_name', '')
-                    human_message = message.get('human_message', '')
-                    found = True
-                    break
-            
-            if not found:
+            message = group_store.get(timestamp)
+            if message is None:
                 logger.warning(f"未找到时间戳为 {timestamp} 的群聊消息")
                 return False
             
-            self.storage._save_data()
+            message['assistant_message'] = response
+            sender_name = message.get('sender_name', '')
+            human_message = message.get('human_message', '')
             
-            # 更新RAG存储中的文档
-            query = f"timestamp:{timestamp} AND group_id:{group_id}"
-            results = await self.query(query, top_k=1)
+            self.storage._save_data()
             
-            if results:
-                doc = results[0]
-                doc["metadata"]["assistant_message"] = response
-                # 更新内容字段，确保格式一致
-                doc["content"] = self._format_content_for_rag(human_message, response, sender_name)
-                
-                await self.update_document(doc)
+            # 按文档ID更新RAG存储中的文档，沿用原有嵌入向量
+            doc_id = group_store.doc_ids.get(timestamp)
+            doc = self.storage.get_document(doc_id) if doc_id else None
+            if doc is not None:
+                metadata = dict(doc.get("metadata", {}))
+                metadata["assistant_message"] = response
+                self.storage.add_document({
+                    "id": doc_id,
+                    # 更新内容字段，确保格式一致
+                    "content": self._format_content_for_rag(human_message, response, sender_name),
+                    "metadata": metadata
+                })
             
             return True
         except Exception as e:
             logger.error(f"更新群聊助手回复失败: {str(e)}")
             return False
 
+    @staticmethod
+    def _document_epoch(document: Dict) -> float:
+        """
+        获取文档的epoch秒，旧文档没有metadata.epoch时回退到解析时间戳
+        """
+        metadata = document.get("metadata", {}) or {}
+        return metadata.get("epoch") or parse_timestamp(metadata.get("timestamp"))
+        
     def _calculate_time_decay_weight(self, timestamp_str: str, current_time=None) -> float:
         """
         计算基于时间衰减的权重
         
         Args:
-            timestamp_str: 时间戳字符串
+            timestamp_str: 时间戳字符串或epoch秒
             current_time: 当前时间，如果为None则使用当前时间
             
         Returns:
-            float: 时间衰减权重 (0~1)
+            float: 时间衰减权重 (0.1~1.0)，无法解析时为0.5
         """
         try:
             if not timestamp_str:
                 return 0.5
-            
-            if current_time is None:
-                current_time = datetime.now()
-            elif isinstance(current_time, str):
-                try:
-                    current_time = datetime.strptime(current_time, '%Y-%m-%d %H:%M')
-                except ValueError:
-                    current_time = datetime.now()
-                
-            # 尝试多种时间格式
-            timestamp = None
-            formats_to_try = [
-                '%Y-%m-%d %H:%M',     # 无秒格式（主要格式）
-                '%Y-%m-%d %H:%M:%S',  # 标准格式
-                '%Y/%m/%d %H:%M',     # 使用/分隔符无秒
-                '%Y/%m/%d %H:%M:%S',  # 使用/分隔符
-                '%Y-%m-%dT%H:%M',     # ISO格式无秒
-                '%Y-%m-%dT%H:%M:%S',  # ISO格式
-                '%Y%m%d%H%M'          # 紧凑格式
-            ]
-            
-            for time_format in formats_to_try:
-                try:
-                    timestamp = datetime.strptime(timestamp_str, time_format)
-                    break
-                except ValueError:
-                    continue
-                    
-            if timestamp is None:
-                # 如果所有格式都失败，尝试从字符串中提取日期部分
-                try:
-                    # 使用正则表达式提取日期时间部分
-                    date_match = re.search(r'(\d{4})[-/](\d{1,2})[-/](\d{1,2})[T\s]?(\d{1,2}):(\d{1,2})(?::(\d{1,2}))?', timestamp_str)
-                    if date_match:
-                        year, month, day, hour, minute = map(int, date_match.groups()[:5])
-                        second = int(date_match.group(6)) if date_match.group(6) else 0
-                        timestamp = datetime(year, month, day, hour, minute, second)
-                    else:
-                        return 0.5  # 无法解析，使用中等权重
-                except Exception as e:
-                    logger.error(f"无法从字符串中提取日期: {timestamp_str}, 错误: {str(e)}")
-                    return 0.5  # 无法解析，使用中等权重
-            
-            # 计算时间差（小时）
-            time_diff = (current_time - timestamp).total_seconds() / 3600
-            
-            # 计算衰减权重（随时间指数衰减）
-            # 1天 = 0.9, 1周 = 0.5, 2周 = 0.3, 1个月 = 0.1
-            decay_rate = 0.05  # 控制衰减速率的参数
-            weight = math.exp(-decay_rate * time_diff)
-            
-            # 限制权重范围在 0.1 ~ 1.0
-            weight = max(0.1, min(1.0, weight))
-            
-            return weight
+                
+            # 1天 = 0.3, 1周 ≈ 0.1（下限）
+            return float(time_decay_weights([parse_timestamp(timestamp_str)], current_time,
+                                            decay_rate=0.05, min_weight=0.1, max_weight=1.0, default=0.5)[0])
         except Exception as e:
             logger.error(f"计算时间衰减权重失败: {str(e)}")
             return 0.5
 
-# 嵌入模型实现
-class ApiEmbeddingModel:
-    """API嵌入模型"""
+class RagNamespacePool:
+    """
+    共享RAG引擎的命名空间池
+    
+    所有命名空间（如各个群聊）共用一份配置、嵌入模型、缓存和HTTP客户端，
+    每个命名空间只持有自己的存储，首次使用时打开，空闲超时后关闭
+    """
     
-    def __init__(self, api_wrapper, model_name, model_type="openai"):
+    def __init__(self, config_path: str, api_wrapper = None, idle_timeout: float = 1800):
         """
-        初始化API嵌入模型
+        初始化命名空间池
         
         Args:
+            config_path: 配置文件路径
             api_wrapper: API调用包装器
-            model_name: 模型名称
-            model_type: 模型类型
+            idle_timeout: 命名空间空闲多久后关闭（秒）
         """
+        self.config_path = config_path
         self.api_wrapper = api_wrapper
-        self.model_name = model_name
-        self.model_type = model_type
-        self.cache = {}  # 简单缓存，避免重复计算
-        self.cache_hits = 0
-        self.cache_misses = 0
-        self.max_cache_size = 1000
+        self.idle_timeout = idle_timeout
+        self._engine = None
+        self._namespaces = {}  # 命名空间 -> RagManager
+        self._last_used = {}   # 命名空间 -> 最近使用时间
+        self._lock = threading.RLock()
         
-    async def get_embedding(self, text: str) -> List[float]:
+    @property
+    def engine(self) -> RagManager:
+        """获取共享引擎（首次访问时创建）"""
+        with self._lock:
+            if self._engine is None:
+                self._engine = RagManager(
+                    config_path=self.config_path,
+                    api_wrapper=self.api_wrapper,
+                    open_storage=False
+                )
+            return self._engine
+            
+    def get(self, namespace: str, storage_dir: str) -> RagManager:
         """
-        获取文本的嵌入向量
+        获取命名空间的RAG管理器，未打开时创建
         
         Args:
-            text: 输入文本
+            namespace: 命名空间名称
+            storage_dir: 命名空间的存储目录
             
         Returns:
-            List[float]: 嵌入向量
+            RagManager: 使用共享引擎的RAG管理器
         """
-        # 检查缓存
-        if text in self.cache:
-            self.cache_hits += 1
-            return self.cache[text]
+        with self._lock:
+            manager = self._namespaces.get(namespace)
+            if manager is None:
+                self.close_idle()
+                manager = RagManager(
+                    config_path=self.config_path,
+                    storage_dir=storage_dir,
+                    engine=self.engine
+                )
+                self._namespaces[namespace] = manager
+                logger.info(f"打开RAG命名空间: {namespace}，当前打开数量: {len(self._namespaces)}")
+            self._last_used[namespace] = time.time()
+            return manager
             
-        self.cache_misses += 1
+    def close(self, namespace: str) -> bool:
+        """
+        关闭命名空间，释放其存储
         
-        try:
-            if not self.api_wrapper:
-                logger.error("API包装器未初始化，无法获取嵌入向量")
-                return None
-                
-            # 使用API获取嵌入向量
+        Args:
+            namespace: 命名空间名称
+            
+        Returns:
+            bool: 命名空间是否处于打开状态
+        """
+        with self._lock:
+            self._last_used.pop(namespace, None)
+            return self._namespaces.pop(namespace, None) is not None
+            
+    def close_idle(self) -> int:
+        """
+        关闭超过空闲时间的命名空间
+        
+        Returns:
+            int: 关闭的命名空间数量
+        """
+        with self._lock:
+            now = time.time()
+            idle = [namespace for namespace, last_used in self._last_used.items()
+                    if now - last_used > self.idle_timeout]
+            for namespace in idle:
+                self.close(namespace)
+            if idle:
+                logger.info(f"关闭了 {len(idle)} 个空闲的RAG命名空间")
+            return len(idle)
+            
+    def __contains__(self, namespace: str) -> bool:
+        with self._lock:
+            return namespace in self._namespaces
+
+# 嵌入模型实现
+# 嵌入向量缓存
+class EmbeddingCache:
+    """
+    两级嵌入向量缓存
+    
+    内存层为LRU，磁盘层为SQLite，键为(模型名, 文本)的哈希。
+    磁盘层按总字节数淘汰最久未访问的条目，重启后仍可命中。
+    """
+    
+    def __init__(self, disk_path: str = None, memory_size: int = 1000, disk_max_mb: int = 256):
+        """
+        初始化嵌入向量缓存
+        
+        Args:
+            disk_path: SQLite缓存文件路径，为None时只使用内存层
+            memory_size: 内存层最大条目数
+            disk_max_mb: 磁盘层最大容量（MB）
+        """
+        self.memory_size = max(1, int(memory_size))
+        self.disk_max_bytes = max(1, int(disk_max_mb)) * 1024 * 1024
+        self.disk_path = disk_path
+        
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disk_bytes = 0
+        
+        # 统计信息
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        
+        if disk_path:
+            self._init_disk()
+            
+    def _init_disk(self):
+        """初始化SQLite磁盘层"""
+        try:
+            os.makedirs(os.path.dirname(self.disk_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.disk_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings(last_access)")
+            self._conn.commit()
+            row = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+            self._disk_bytes = int(row[0])
+            logger.info(f"嵌入向量磁盘缓存已加载: {self.disk_path} ({self._disk_bytes / 1024 / 1024:.1f} MB)")
+        except Exception as e:
+            logger.error(f"初始化嵌入向量磁盘缓存失败: {str(e)}，仅使用内存缓存")
+            self._conn = None
+            
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        """
+        生成缓存键
+        
+        Args:
+            model_name: 模型名称
+            text: 文本
+            
+        Returns:
+            str: 缓存键
+        """
+        return hashlib.sha1(f"{model_name}\x00{text}".encode("utf-8")).hexdigest()
+        
+    def _memory_put(self, key: str, embedding):
+        """写入内存层（调用方持有锁）"""
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+            
+    def get(self, model_name: str, text: str) -> Optional[List[float]]:
+        """
+        查询缓存
+        
+        Args:
+            model_name: 模型名称
+            text: 文本
+            
+        Returns:
+            Optional[List[float]]: 嵌入向量，未命中返回None
+        """
+        key = self.make_key(model_name, text)
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+                
+            if self._conn is not None:
+                try:
+                    row = self._conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        embedding = np.frombuffer(row[0], dtype=np.float32).tolist()
+                        self._conn.execute("UPDATE embeddings SET last_access = ? WHERE key = ?", (time.time(), key))
+                        self._conn.commit()
+                        self._memory_put(key, embedding)
+                        self.disk_hits += 1
+                        return embedding
+                except Exception as e:
+                    logger.error(f"读取嵌入向量磁盘缓存失败: {str(e)}")
+                    
+            self.misses += 1
+            return None
+            
+    def put(self, model_name: str, text: str, embedding):
+        """
+        写入缓存
+        
+        Args:
+            model_name: 模型名称
+            text: 文本
+            embedding: 嵌入向量
+        """
+        if embedding is None:
+            return
+        key = self.make_key(model_name, text)
+        with self._lock:
+            self._memory_put(key, embedding)
+            
+            if self._conn is None:
+                return
             try:
-                # 首先尝试异步方法
-                if hasattr(self.api_wrapper, 'async_embedding'):
-                    embedding = await self.api_wrapper.async_embedding(text, self.model_name)
-                # 如果不存在异步方法，则使用同步方法
-                elif hasattr(self.api_wrapper, 'embedding'):
-                    embedding = self.api_wrapper.embedding(text, self.model_name)
-                else:
-                    # 直接调用底层API
-                    response = await self.api_wrapper.embeddings.create(
-                        model=self.model_name,
-                        input=text
-                    )
-                    if hasattr(response, 'data') and len(response.data) > 0:
-                        embedding = response.data[0].embedding
-                    elif isinstance(response, dict) and 'data' in response:
-                        embedding = response['data'][0]['embedding']
-                    else:
-                        logger.error(f"无法解析嵌入向量响应: {response}")
-                        return None
+                blob = np.asarray(embedding, dtype=np.float32).tobytes()
+                old = self._conn.execute("SELECT LENGTH(vector) FROM embeddings WHERE key = ?", (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                    (key, blob, time.time())
+                )
+                self._disk_bytes += len(blob) - (old[0] if old else 0)
+                if self._disk_bytes > self.disk_max_bytes:
+                    self._evict_disk()
+                self._conn.commit()
             except Exception as e:
-                logger.error(f"调用嵌入API失败: {str(e)}")
-                return None
+                logger.error(f"写入嵌入向量磁盘缓存失败: {str(e)}")
                 
-            # 缓存结果
-            self.cache[text] = embedding
+    def _evict_disk(self):
+        """按最久未访问淘汰磁盘条目，直到容量降到上限的90%（调用方持有锁）"""
+        target = int(self.disk_max_bytes * 0.9)
+        while self._disk_bytes > target:
+            rows = self._conn.execute(
+                "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_access LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self._disk_bytes = 0
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self._disk_bytes -= size
+                self.disk_evictions += 1
+                if self._disk_bytes <= target:
+                    break
+                    
+    def get_stats(self) -> Dict:
+        """
+        获取缓存统计信息
+        
+        Returns:
+            Dict: 缓存统计信息
+        """
+        with self._lock:
+            disk_size = 0
+            if self._conn is not None:
+                try:
+                    disk_size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                except Exception:
+                    pass
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "size": len(self._memory),
+                "max_size": self.memory_size,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+                "disk_size": disk_size,
+                "disk_bytes": self._disk_bytes
+            }
+
+# 按磁盘路径共享的缓存实例
+_embedding_caches = {}
+_embedding_caches_lock = threading.Lock()
+
+def get_embedding_cache(disk_path: str = None, memory_size: int = 1000, disk_max_mb: int = 256) -> EmbeddingCache:
+    """
+    获取共享的嵌入向量缓存，同一磁盘路径只创建一个实例
+    
+    Args:
+        disk_path: SQLite缓存文件路径
+        memory_size: 内存层最大条目数
+        disk_max_mb: 磁盘层最大容量（MB）
+        
+    Returns:
+        EmbeddingCache: 缓存实例
+    """
+    cache_key = os.path.abspath(disk_path) if disk_path else None
+    with _embedding_caches_lock:
+        cache = _embedding_caches.get(cache_key)
+        if cache is None:
+            cache = EmbeddingCache(disk_path, memory_size, disk_max_mb)
+            _embedding_caches[cache_key] = cache
+        return cache
+
+class ApiEmbeddingModel:
+    """API嵌入模型"""
+    
+    def __init__(self, api_wrapper, model_name, model_type="openai",
+                 batch_size: int = 64, batch_max_tokens: int = 16000, batch_window_ms: int = 20,
+                 cache: EmbeddingCache = None):
+        """
+        初始化API嵌入模型
+        
+        Args:
+            api_wrapper: API调用包装器
+            model_name: 模型名称
+            model_type: 模型类型
+            batch_size: 单次批量请求的最大文本数
+            batch_max_tokens: 单次批量请求的最大估算token数
+            batch_window_ms: 合并并发单条请求的等待窗口（毫秒）
+            cache: 共享的嵌入向量缓存，为None时使用仅内存的缓存
+        """
+        self.api_wrapper = api_wrapper
+        self.model_name = model_name
+        self.model_type = model_type
+        self.cache = cache or get_embedding_cache()  # 缓存，避免重复计算
+        self.cache_hits = 0
+        self.cache_misses = 0
+        
+        # 批量请求设置
+        self.batch_size = max(1, int(batch_size))
+        self.batch_max_tokens = max(1, int(batch_max_tokens))
+        self.batch_window = max(0, int(batch_window_ms)) / 1000.0
+        self.batch_requests = 0
+        self.batched_texts = 0
+        
+        # 按事件循环区分的待合并请求: loop -> {"items": [(text, future)], "task": flush任务}
+        self._pending = {}
+        
+    def _cache_put(self, text: str, embedding):
+        """
+        写入缓存
+        
+        Args:
+            text: 输入文本
+            embedding: 嵌入向量
+        """
+        self.cache.put(self.model_name, text, embedding)
+            
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        """
+        粗略估算文本token数（中文约1字1token，英文约4字符1token）
+        
+        Args:
+            text: 输入文本
+            
+        Returns:
+            int: 估算的token数
+        """
+        ascii_chars = sum(1 for c in text if ord(c) < 128)
+        return max(1, (len(text) - ascii_chars) + ascii_chars // 4)
+        
+    def _split_batches(self, texts: List[str]) -> List[List[str]]:
+        """
+        按数量和token上限切分批次
+        
+        Args:
+            texts: 文本列表
+            
+        Returns:
+            List[List[str]]: 批次列表
+        """
+        batches = []
+        current = []
+        current_tokens = 0
+        for text in texts:
+            tokens = self._estimate_tokens(text)
+            if current and (len(current) >= self.batch_size or current_tokens + tokens > self.batch_max_tokens):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(text)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+        
+    async def _request_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        发送一次批量嵌入请求
+        
+        Args:
+            texts: 文本列表
+            
+        Returns:
+            List[Optional[List[float]]]: 与输入顺序一致的嵌入向量列表
+        """
+        self.batch_requests += 1
+        self.batched_texts += len(texts)
+        
+        if hasattr(self.api_wrapper, 'async_embeddings'):
+            return await self.api_wrapper.async_embeddings(texts, self.model_name)
+            
+        if hasattr(self.api_wrapper, 'embeddings'):
+            response = await self.api_wrapper.embeddings.create(
+                model=self.model_name,
+                input=texts
+            )
+            if hasattr(response, 'data'):
+                items = sorted(response.data, key=lambda item: getattr(item, 'index', 0))
+                return [item.embedding for item in items]
+            if isinstance(response, dict) and 'data' in response:
+                items = sorted(response['data'], key=lambda item: item.get('index', 0))
+                return [item['embedding'] for item in items]
+            logger.error(f"无法解析嵌入向量响应: {response}")
+            return [None] * len(texts)
+            
+        # 不支持批量接口时逐条请求
+        return [await self._request_single(text) for text in texts]
+        
+    async def _request_single(self, text: str) -> Optional[List[float]]:
+        """
+        发送单条嵌入请求
+        
+        Args:
+            text: 输入文本
+            
+        Returns:
+            Optional[List[float]]: 嵌入向量
+        """
+        # 首先尝试异步方法
+        if hasattr(self.api_wrapper, 'async_embedding'):
+            return await self.api_wrapper.async_embedding(text, self.model_name)
+        # 如果不存在异步方法，则使用同步方法
+        if hasattr(self.api_wrapper, 'embedding'):
+            return self.api_wrapper.embedding(text, self.model_name)
+        logger.error("API包装器不支持嵌入接口")
+        return None
+        
+    async def _embed_uncached(self, texts: List[str]) -> Dict[str, List[float]]:
+        """
+        分批请求嵌入向量并写入缓存
+        
+        Args:
+            texts: 去重后的文本列表
+            
+        Returns:
+            Dict[str, List[float]]: 文本到嵌入向量的映射，失败的文本不包含在内
+        """
+        embeddings = {}
+        for batch in self._split_batches(texts):
+            try:
+                batch_embeddings = await self._request_batch(batch)
+            except Exception as e:
+                logger.error(f"批量调用嵌入API失败: {str(e)}")
+                continue
+                
+            for text, embedding in zip(batch, batch_embeddings):
+                if embedding is not None:
+                    embeddings[text] = embedding
+                    self._cache_put(text, embedding)
+        return embeddings
+        
+    async def get_embeddings(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        批量获取文本的嵌入向量
+        
+        Args:
+            texts: 输入文本列表
             
-            # 限制缓存大小
-            if len(self.cache) > self.max_cache_size:
-                # 删除最旧的项
-                oldest_key = next(iter(self.cache))
-                del self.cache[oldest_key]
+        Returns:
+            List[Optional[List[float]]]: 与输入顺序一致的嵌入向量列表，失败项为None
+        """
+        results = [None] * len(texts)
+        missing = {}
+        
+        # 检查缓存，并对未命中的文本去重
+        for i, text in enumerate(texts):
+            cached = self.cache.get(self.model_name, text)
+            if cached is not None:
+                self.cache_hits += 1
+                results[i] = cached
+            else:
+                self.cache_misses += 1
+                missing.setdefault(text, []).append(i)
                 
-            return embedding
+        if not missing:
+            return results
+            
+        if not self.api_wrapper:
+            logger.error("API包装器未初始化，无法获取嵌入向量")
+            return results
+            
+        embeddings = await self._embed_uncached(list(missing.keys()))
+        for text, embedding in embeddings.items():
+            for i in missing[text]:
+                results[i] = embedding
+                
+        return results
+        
+    async def _flush_after(self, loop, delay: float):
+        """
+        等待合并窗口结束后，发送当前事件循环上累积的请求
+        
+        Args:
+            loop: 事件循环
+            delay: 等待时间（秒）
+        """
+        if delay:
+            await asyncio.sleep(delay)
+            
+        state = self._pending.pop(loop, None)
+        if state:
+            await self._dispatch(state["items"])
+            
+    async def _dispatch(self, items: List[Tuple[str, Any]]):
+        """
+        将累积的单条请求合并为批量请求，并把结果分发给各调用方
+        
+        Args:
+            items: (文本, future) 列表
+        """
+        try:
+            texts = list(dict.fromkeys(text for text, _ in items))
+            embeddings = await self._embed_uncached(texts)
+                        
+            if len(items) > 1:
+                logger.debug(f"合并 {len(items)} 个嵌入请求为 {len(texts)} 条批量请求文本")
+                
+            for text, future in items:
+                if not future.done():
+                    future.set_result(embeddings.get(text))
+        except Exception as e:
+            logger.error(f"处理批量嵌入请求失败: {str(e)}")
+            for _, future in items:
+                if not future.done():
+                    future.set_result(None)
+        
+    async def get_embedding(self, text: str) -> List[float]:
+        """
+        获取文本的嵌入向量
+        
+        并发的单条请求会在短暂窗口内合并为一次批量请求，结果再分发给各调用方
+        
+        Args:
+            text: 输入文本
+            
+        Returns:
+            List[float]: 嵌入向量
+        """
+        # 检查缓存
+        cached = self.cache.get(self.model_name, text)
+        if cached is not None:
+            self.cache_hits += 1
+            return cached
+            
+        self.cache_misses += 1
+        
+        try:
+            if not self.api_wrapper:
+                logger.error("API包装器未初始化，无法获取嵌入向量")
+                return None
+                
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            
+            state = self._pending.get(loop)
+            if state is None:
+                state = {"items": [], "task": None}
+                self._pending[loop] = state
+            state["items"].append((text, future))
+            
+            if len(state["items"]) >= self.batch_size:
+                # 达到批量上限，立即发送
+                self._pending.pop(loop, None)
+                if state["task"] is not None:
+                    state["task"].cancel()
+                loop.create_task(self._dispatch(state["items"]))
+            elif state["task"] is None:
+                state["task"] = loop.create_task(self._flush_after(loop, self.batch_window))
+                
+            return await future
         except Exception as e:
             logger.error(f"获取嵌入向量失败: {str(e)}")
             return None
@@ -1222,29 +2119,31 @@ class ApiEmbeddingModel:
         Returns:
             Dict: 缓存统计信息
         """
-        return {
+        stats = self.cache.get_stats()
+        stats.update({
             "hits": self.cache_hits,
             "misses": self.cache_misses,
-            "size": len(self.cache),
-            "max_size": self.max_cache_size
-        }
+            "batch_requests": self.batch_requests,
+            "batched_texts": self.batched_texts
+        })
+        return stats
 
 class LocalEmbeddingModel:
     """本地嵌入模型"""
     
-    def __init__(self, model_path):
+    def __init__(self, model_path, cache: EmbeddingCache = None):
         """
         初始化本地嵌入模型
         
         Args:
             model_path: 模型路径
+            cache: 共享的嵌入向量缓存，为None时使用仅内存的缓存
         """
         self.model_path = model_path
         self.model = None
-        self.cache = {}
+        self.cache = cache or get_embedding_cache()
         self.cache_hits = 0
         self.cache_misses = 0
-        self.max_cache_size = 1000
         
         # 懒加载模型，降低内存占用
         
@@ -1259,9 +2158,10 @@ class LocalEmbeddingModel:
             List[float]: 嵌入向量
         """
         # 检查缓存
-        if text in self.cache:
+        cached = self.cache.get(self.model_path, text)
+        if cached is not None:
             self.cache_hits += 1
-            return self.cache[text]
+            return cached
             
         self.cache_misses += 1
         
@@ -1278,13 +2178,7 @@ class LocalEmbeddingModel:
             embedding = self._get_embedding_with_local_model(text)
             
             # 缓存结果
-            self.cache[text] = embedding
-            
-            # 限制缓存大小
-            if len(self.cache) > self.max_cache_size:
-                # 删除最旧的项
-                oldest_key = next(iter(self.cache))
-                del self.cache[oldest_key]
+            self.cache.put(self.model_path, text, embedding)
                 
             return embedding
         except Exception as e:
@@ -1349,27 +2243,106 @@ class LocalEmbeddingModel:
         Returns:
             Dict: 缓存统计信息
         """
-        return {
+        stats = self.cache.get_stats()
+        stats.update({
             "hits": self.cache_hits,
-            "misses": self.cache_misses,
-            "size": len(self.cache),
-            "max_size": self.max_cache_size
-        }
+            "misses": self.cache_misses
+        })
+        return stats
 
 # 重排序器实现
-class ApiReranker:
-    """API重排序器"""
+class RerankCache:
+    """
+    重排序结果缓存：按(查询哈希, 候选文档ID集合)缓存最终排序，LRU淘汰并带过期时间
+    """
     
-    def __init__(self, api_wrapper, model_name):
+    def __init__(self, max_size: int = 1024, ttl: float = 600):
         """
-        初始化API重排序器
+        初始化重排序缓存
         
         Args:
-            api_wrapper: API调用包装器
-            model_name: 模型名称
+            max_size: 最大缓存条目数
+            ttl: 过期时间（秒），时间特征会随时间变化，排序不宜长期复用
         """
-        self.api_wrapper = api_wrapper
-        self.model_name = model_name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # 键 -> (排序后的文档ID元组, 写入时间)
+        self.hits = 0
+        self.misses = 0
+        
+    @staticmethod
+    def make_key(query: str, results: List[Dict]) -> Optional[Tuple[str, frozenset]]:
+        """
+        生成缓存键，候选文档缺少ID或ID重复时返回None（不缓存）
+        """
+        doc_ids = [result.get("id") for result in results]
+        if None in doc_ids or len(set(doc_ids)) != len(doc_ids):
+            return None
+        return hashlib.md5((query or "").encode("utf-8")).hexdigest(), frozenset(doc_ids)
+        
+    def get(self, key, results: List[Dict]) -> Optional[List[Dict]]:
+        """
+        查询缓存的排序，命中时按缓存的ID顺序重组候选结果
+        """
+        if key is None or self.max_size <= 0:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        by_id = {result.get("id"): result for result in results}
+        return [by_id[doc_id] for doc_id in entry[0]]
+        
+    def put(self, key, ordered: List[Dict]):
+        """
+        写入排序结果
+        """
+        if key is None or self.max_size <= 0:
+            return
+        self._entries[key] = (tuple(result.get("id") for result in ordered), time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            
+    def get_stats(self) -> Dict:
+        """
+        获取缓存统计信息
+        """
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+class LocalReranker:
+    """
+    本地特征重排序器
+    
+    在候选集上用NumPy组合向量相似度、BM25关键词重叠、时间新近度和实体重叠四项特征打分，
+    不调用LLM，耗时为毫秒级
+    """
+    
+    DEFAULT_WEIGHTS = {"embedding": 0.5, "bm25": 0.2, "recency": 0.15, "entity": 0.15}
+    
+    def __init__(self, weights: Dict = None, half_life_days: float = 30, cache_size: int = 1024,
+                 cache_ttl: float = 600, k1: float = 1.5, b: float = 0.75):
+        """
+        初始化本地重排序器
+        
+        Args:
+            weights: 各特征权重，缺省项使用DEFAULT_WEIGHTS
+            half_life_days: 时间新近度的半衰期（天）
+            cache_size: 排序缓存条目数，0表示不缓存
+            cache_ttl: 排序缓存过期时间（秒）
+            k1: BM25词频饱和参数
+            b: BM25文档长度归一化参数
+        """
+        weights = {**self.DEFAULT_WEIGHTS, **(weights or {})}
+        self.feature_names = list(self.DEFAULT_WEIGHTS)
+        self.weights = np.array([float(weights[name]) for name in self.feature_names], dtype=np.float32)
+        self.half_life = max(float(half_life_days), 1e-6) * 86400
+        self.k1 = k1
+        self.b = b
+        self.cache = RerankCache(cache_size, cache_ttl)
         
     async def rerank(self, query: str, results: List[Dict]) -> List[Dict]:
         """
@@ -1377,27 +2350,146 @@ class ApiReranker:
         
         Args:
             query: 查询文本
-            results: 检索结果列表
+            results: 检索结果列表（score字段为向量相似度）
             
         Returns:
             List[Dict]: 重排序后的结果列表
         """
         try:
-            if not self.api_wrapper:
-                logger.error("API包装器未初始化，无法进行重排序")
-                return results
-                
             if not results or len(results) <= 1:
                 return results
                 
-            # 使用LLM进行重排序
-            prompt = self._create_rerank_prompt(query, results)
+            key = RerankCache.make_key(query, results)
+            cached = self.cache.get(key, results)
+            if cached is not None:
+                return cached
+                
+            scores = self.features(query, results) @ self.weights
+            order = np.argsort(-scores, kind="stable")
+            reranked_results = [results[int(i)] for i in order]
             
-            response = await self.api_wrapper.async_completion(
-                prompt=prompt,
-                temperature=0.1,
-                max_tokens=500
-            )
+            self.cache.put(key, reranked_results)
+            return reranked_results
+        except Exception as e:
+            logger.error(f"本地重排序失败: {str(e)}")
+            return results
+            
+    @staticmethod
+    def _min_max(values: np.ndarray) -> np.ndarray:
+        """将特征归一化到0-1，全部相等时取0.5"""
+        span = values.max() - values.min()
+        if span <= 1e-9:
+            return np.full_like(values, 0.5)
+        return (values - values.min()) / span
+        
+    def features(self, query: str, results: List[Dict], now: float = None) -> np.ndarray:
+        """
+        计算候选集的特征矩阵
+        
+        Args:
+            query: 查询文本
+            results: 检索结果列表
+            now: 当前时间（epoch秒），默认取系统时间
+            
+        Returns:
+            np.ndarray: (候选数, 4) 的特征矩阵，列顺序与feature_names一致
+        """
+        n = len(results)
+        contents = [result.get("content") or "" for result in results]
+        
+        # 1. 向量相似度
+        embedding = self._min_max(np.array([float(result.get("score") or 0.0) for result in results],
+                                           dtype=np.float32))
+        
+        # 2. BM25：只统计查询词，文档频率取自候选集本身
+        query_terms = list(dict.fromkeys(KeywordIndex.tokenize(query)))
+        bm25 = np.zeros(n, dtype=np.float32)
+        if query_terms:
+            doc_tokens = [KeywordIndex.tokenize(content) for content in contents]
+            doc_lens = np.array([len(tokens) for tokens in doc_tokens], dtype=np.float32)
+            term_pos = {term: j for j, term in enumerate(query_terms)}
+            tf = np.zeros((n, len(query_terms)), dtype=np.float32)
+            for i, tokens in enumerate(doc_tokens):
+                for token in tokens:
+                    j = term_pos.get(token)
+                    if j is not None:
+                        tf[i, j] += 1
+            df = (tf > 0).sum(axis=0)
+            idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * doc_lens / max(doc_lens.mean(), 1.0))
+            bm25 = self._min_max(((tf * (self.k1 + 1)) / (tf + norm[:, None])) @ idf)
+            
+        # 3. 时间新近度：按半衰期指数衰减，时间未知时取0.5
+        now = now or time.time()
+        epochs = np.array([RagManager._document_epoch(result) for result in results], dtype=np.float64)
+        ages = np.maximum(now - epochs, 0.0)
+        recency = np.where(epochs > 0, np.exp(-math.log(2) * ages / self.half_life), 0.5)
+        
+        # 4. 实体重叠：查询分词中的中文词组、英文单词和数字在候选内容中出现的比例
+        entities = [term for term in query_terms if re.fullmatch(r'[一-龥]{2,}|[a-z]{2,}|\d{2,}', term)]
+        entity = np.zeros(n, dtype=np.float32)
+        if entities:
+            hits = np.array([[entity_text in content.lower() for entity_text in entities] for content in contents],
+                            dtype=np.float32)
+            entity = hits.mean(axis=1)
+            
+        return np.stack([embedding, bm25, recency.astype(np.float32), entity], axis=1)
+        
+    def get_cache_stats(self) -> Dict:
+        """
+        获取排序缓存统计信息
+        """
+        return self.cache.get_stats()
+
+class ApiReranker:
+    """API重排序器"""
+    
+    def __init__(self, api_wrapper, model_name, cache_size: int = 1024, cache_ttl: float = 600):
+        """
+        初始化API重排序器
+        
+        Args:
+            api_wrapper: API调用包装器
+            model_name: 模型名称
+            cache_size: 排序缓存条目数，0表示不缓存
+            cache_ttl: 排序缓存过期时间（秒）
+        """
+        self.api_wrapper = api_wrapper
+        self.model_name = model_name
+        self.cache = RerankCache(cache_size, cache_ttl)
+        
+    async def rerank(self, query: str, results: List[Dict]) -> List[Dict]:
+        """
+        重排序检索结果
+        
+        Args:
+            query: 查询文本
+            results: 检索结果列表
+            
+        Returns:
+            List[Dict]: 重排序后的结果列表
+        """
+        try:
+            if not self.api_wrapper:
+                logger.error("API包装器未初始化，无法进行重排序")
+                return results
+                
+            if not results or len(results) <= 1:
+                return results
+                
+            key = RerankCache.make_key(query, results)
+            cached = self.cache.get(key, results)
+            if cached is not None:
+                return cached
+                
+            # 使用LLM进行重排序
+            prompt = self._create_rerank_prompt(query, results)
+            
+            response = await self.api_wrapper.async_completion(
+                prompt=prompt,
+                temperature=0.1,
+                max_tokens=500
+            )
             
             # 解析重排序结果
             reranked_results = self._parse_rerank_response(response.get("content", ""), results)
@@ -1406,6 +2498,7 @@ class ApiReranker:
             if not reranked_results:
                 return results
                 
+            self.cache.put(key, reranked_results)
             return reranked_results
         except Exception as e:
             logger.error(f"重排序失败: {str(e)}")
@@ -1495,101 +2588,2101 @@ class ApiReranker:
             logger.error(f"解析重排序响应失败: {str(e)}")
             return []
 
-# 存储实现
-class JsonStorage:
-    """JSON文件存储"""
+# 关键词倒排索引
+class KeywordIndex:
+    """
+    关键词倒排索引（BM25）
     
-    def __init__(self, file_path):
+    在写入文档时分词并维护 词 -> {文档序号: 词频} 倒排表，同时预先计算文档长度和内容质量分，
+    供嵌入不可用时的混合特征检索使用。索引以JSON行追加写入，启动时回放，无需重新分词。
+    """
+    
+    # 高频虚词，不参与打分
+    STOPWORDS = {"的", "了", "是", "在", "我", "你", "他", "她", "它", "们", "吗", "呢", "吧", "啊",
+                 "和", "就", "都", "也", "还", "这", "那", "有", "不", "没", "很", "说", "对"}
+    
+    def __init__(self, index_path: str, k1: float = 1.5, b: float = 0.75):
         """
-        初始化JSON存储
+        初始化关键词索引
         
         Args:
-            file_path: JSON文件路径
+            index_path: 索引日志路径（.jsonl）
+            k1: BM25词频饱和参数
+            b: BM25长度归一化参数
         """
-        self.file_path = file_path
-        self.data = self._load_data()
+        self.index_path = index_path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._reset_structures()
         
-        # 添加维度缓存
-        self.dimension_cache = {}
+    def _reset_structures(self):
+        """清空内存结构"""
+        self.doc_ids = []          # 文档序号 -> 文档ID（已删除为None）
+        self.docs = []             # 文档序号 -> 文档字典
+        self.doc_terms = []        # 文档序号 -> {词: 词频}
+        self.doc_lens = []         # 文档序号 -> 词数
+        self.quality = []          # 文档序号 -> 内容质量分
+        self.owners = []           # 文档序号 -> 所属角色集合
+        self.docno_by_id = {}      # 文档ID -> 文档序号
+        self.postings = {}         # 词 -> {文档序号: 词频}
+        self.owner_docs = {}       # 角色 -> {文档序号: None}，作为按写入顺序排列的集合
+        self.owner_max_turn = {}   # 角色 -> 最大对话轮数
+        self.total_len = 0
+        self.live_count = 0
         
-    def _load_data(self) -> Dict:
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
         """
-        加载数据
+        分词并过滤标点和停用词
         
+        Args:
+            text: 文本
+            
         Returns:
-            Dict: 数据字典
+            List[str]: 词列表
+        """
+        import jieba
+        tokens = []
+        for token in jieba.lcut((text or "").lower(), cut_all=False, HMM=False):
+            token = token.strip()
+            if not token or token in cls.STOPWORDS:
+                continue
+            if not re.search(r'[一-龥a-z0-9]', token):
+                continue
+            tokens.append(token)
+        return tokens
+        
+    @staticmethod
+    def content_quality(content: str) -> float:
+        """
+        计算内容质量分（长度、信息密度、特殊属性）
+        
+        Args:
+            content: 文档内容
+            
+        Returns:
+            float: 0.1-1.0之间的质量分
+        """
+        # 长度评分（假设长度适中的内容质量更高）
+        content_length = len(content)
+        if content_length < 10:
+            length_score = 0.2  # 太短
+        elif content_length < 50:
+            length_score = 0.5  # 较短
+        elif content_length < 200:
+            length_score = 1.0  # 适中
+        elif content_length < 500:
+            length_score = 0.8  # 较长
+        else:
+            length_score = 0.6  # 太长
+            
+        # 信息密度（关键词密度）
+        keywords = ["什么", "为什么", "怎么", "何时", "何地", "谁", "哪里"]
+        keyword_density = sum(1 for word in keywords if word in content) / max(len(content) / 10, 1)
+        density_score = min(1.0, keyword_density * 2)
+        
+        # 特殊属性评分
+        special_score = 0.5
+        # 包含问答对，质量可能更高
+        if "?" in content or "？" in content:
+            special_score += 0.3
+        # 包含引号，可能是引用内容，质量更高
+        if "\"" in content or "“" in content or "'" in content:
+            special_score += 0.2
+        special_score = min(1.0, special_score)
+        
+        quality = 0.4 * length_score + 0.3 * density_score + 0.3 * special_score
+        return max(0.1, min(1.0, quality))
+        
+    @staticmethod
+    def _doc_owners(document: Dict) -> List[str]:
+        """获取文档所属的角色（支持多种可能的元数据字段）"""
+        metadata = document.get("metadata", {}) or {}
+        owners = {metadata.get("user_id"), metadata.get("ai_name"), metadata.get("avatar_name")}
+        return sorted(owner for owner in owners if owner)
+        
+    @staticmethod
+    def _content_hash(content: str) -> int:
+        return zlib.crc32((content or "").encode("utf-8"))
+        
+    def _make_record(self, document: Dict) -> Dict:
+        """对文档分词并生成索引记录"""
+        content = document.get("content", "") or ""
+        tokens = self.tokenize(content)
+        tf = {}
+        for token in tokens:
+            tf[token] = tf.get(token, 0) + 1
+        return {
+            "id": document.get("id"),
+            "h": self._content_hash(content),
+            "tf": tf,
+            "len": len(tokens),
+            "quality": self.content_quality(content),
+            "owners": self._doc_owners(document)
+        }
+        
+    def _apply(self, record: Dict, document: Dict = None):
+        """将一条索引记录应用到内存结构（调用方持有锁）"""
+        doc_id = record.get("id")
+        self._remove(doc_id)
+        if record.get("deleted"):
+            return
+            
+        docno = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.docs.append(document)
+        self.doc_terms.append(record["tf"])
+        self.doc_lens.append(record["len"])
+        self.quality.append(record["quality"])
+        self.owners.append(record["owners"])
+        self.docno_by_id[doc_id] = docno
+        self.total_len += record["len"]
+        self.live_count += 1
+        
+        for token, count in record["tf"].items():
+            self.postings.setdefault(token, {})[docno] = count
+        for owner in record["owners"]:
+            self.owner_docs.setdefault(owner, {})[docno] = None
+            
+        if document is not None:
+            self._update_turn(docno)
+            
+    def _update_turn(self, docno: int):
+        """更新所属角色的最大对话轮数（调用方持有锁）"""
+        document = self.docs[docno]
+        turn = (document.get("metadata", {}) or {}).get("turn", 0) or 0
+        for owner in self.owners[docno]:
+            if turn > self.owner_max_turn.get(owner, 0):
+                self.owner_max_turn[owner] = turn
+                
+    def _remove(self, doc_id):
+        """从内存结构中移除文档（调用方持有锁）"""
+        docno = self.docno_by_id.pop(doc_id, None)
+        if docno is None:
+            return
+        for token in self.doc_terms[docno]:
+            posting = self.postings.get(token)
+            if posting is not None:
+                posting.pop(docno, None)
+                if not posting:
+                    del self.postings[token]
+        for owner in self.owners[docno]:
+            docnos = self.owner_docs.get(owner)
+            if docnos is not None:
+                docnos.pop(docno, None)
+                if not docnos:
+                    del self.owner_docs[owner]
+        self.total_len -= self.doc_lens[docno]
+        self.live_count -= 1
+        self.doc_ids[docno] = None
+        self.docs[docno] = None
+        self.doc_terms[docno] = {}
+        self.owners[docno] = []
+        
+        # 已删除的槽位过多时重新编号，避免归档和更新后内存只增不减
+        if len(self.doc_ids) - self.live_count > max(1000, self.live_count):
+            self._compact_docnos()
+            
+    def _compact_docnos(self):
+        """按写入顺序重新编号有效文档，回收已删除文档的槽位（调用方持有锁）"""
+        live = [docno for docno, doc_id in enumerate(self.doc_ids) if doc_id is not None]
+        remap = {old: new for new, old in enumerate(live)}
+        self.doc_ids = [self.doc_ids[docno] for docno in live]
+        self.docs = [self.docs[docno] for docno in live]
+        self.doc_terms = [self.doc_terms[docno] for docno in live]
+        self.doc_lens = [self.doc_lens[docno] for docno in live]
+        self.quality = [self.quality[docno] for docno in live]
+        self.owners = [self.owners[docno] for docno in live]
+        self.docno_by_id = {doc_id: docno for docno, doc_id in enumerate(self.doc_ids)}
+        self.postings = {token: {remap[docno]: count for docno, count in posting.items()}
+                         for token, posting in self.postings.items()}
+        self.owner_docs = {owner: {remap[docno]: None for docno in docnos}
+                           for owner, docnos in self.owner_docs.items()}
+        
+    def get_quality(self, doc_id: str, default: float = 0.5) -> float:
+        """
+        获取文档的内容质量分
+        
+        Args:
+            doc_id: 文档ID
+            default: 文档不在索引中时的默认值
+            
+        Returns:
+            float: 内容质量分
+        """
+        with self._lock:
+            docno = self.docno_by_id.get(doc_id)
+            return self.quality[docno] if docno is not None else default
+        
+    def _append_records(self, records: List[Dict]):
+        """追加索引记录到日志"""
+        if not records:
+            return
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        with open(self.index_path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                
+    def load(self, documents: List[Dict]):
         """
+        回放索引日志，并与当前文档对齐（补建缺失或内容变化的文档，移除已不存在的文档）
+        
+        Args:
+            documents: 存储中的文档列表
+        """
+        records = {}
+        total_records = 0
         try:
-            if os.path.exists(self.file_path):
-                with open(self.file_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    # 确保基本结构存在
-                    if "documents" not in data:
-                        data["documents"] = []
-                    if "group_chats" not in data:
-                        data["group_chats"] = {}
-                    return data
-            else:
-                # 初始化空数据
-                data = {
-                    "documents": [],
-                    "group_chats": {}  # 添加群聊数据结构
-                }
-                self._save_data(data)
-                return data
+            if os.path.exists(self.index_path):
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        total_records += 1
+                        records[record.get("id")] = record
         except Exception as e:
-            logger.error(f"加载数据失败: {str(e)}")
-            return {"documents": [], "group_chats": {}}
+            logger.error(f"加载关键词索引失败: {str(e)}")
+            records = {}
+            
+        new_records = []
+        with self._lock:
+            for document in documents:
+                doc_id = document.get("id")
+                record = records.get(doc_id)
+                if record is None or record.get("deleted") or \
+                        record.get("h") != self._content_hash(document.get("content", "")):
+                    record = self._make_record(document)
+                    new_records.append(record)
+                self._apply(record, document)
+                
+        stale = total_records - self.live_count
+        if stale > max(1000, self.live_count):
+            # 日志中过期记录过多时压缩
+            self.compact()
+        else:
+            self._append_records(new_records)
             
-    def _save_data(self, data: Dict = None):
+        if new_records:
+            logger.info(f"关键词索引已补建 {len(new_records)} 个文档，共 {self.live_count} 个文档")
+            
+    def add(self, document: Dict):
         """
-        保存数据
+        新增或更新文档
         
         Args:
-            data: 要保存的数据字典
+            document: 文档字典
         """
         try:
-            # 确保目录存在
-            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            record = self._make_record(document)
+            with self._lock:
+                self._apply(record, document)
+            self._append_records([record])
+        except Exception as e:
+            logger.error(f"更新关键词索引失败: {str(e)}")
             
-            # 如果未提供数据，使用当前数据
-            if data is None:
-                data = self.data
-                
-            # 保存数据
-            with open(self.file_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+    def reset(self, documents: List[Dict]):
+        """
+        按当前文档重建索引（用于清空存储后）
+        
+        Args:
+            documents: 存储中的文档列表
+        """
+        with self._lock:
+            records = []
+            for document in documents:
+                docno = self.docno_by_id.get(document.get("id"))
+                if docno is not None:
+                    records.append((self._record_from_docno(docno), document))
+                else:
+                    records.append((self._make_record(document), document))
+                    
+            self._reset_structures()
+            for record, document in records:
+                self._apply(record, document)
+        self.compact()
+        
+    def _record_from_docno(self, docno: int) -> Dict:
+        """由内存结构生成索引记录"""
+        document = self.docs[docno] or {}
+        return {
+            "id": self.doc_ids[docno],
+            "h": self._content_hash(document.get("content", "")),
+            "tf": self.doc_terms[docno],
+            "len": self.doc_lens[docno],
+            "quality": self.quality[docno],
+            "owners": self.owners[docno]
+        }
+        
+    def compact(self):
+        """将内存中的有效文档重写为新的索引日志（原子替换）"""
+        try:
+            with self._lock:
+                records = [self._record_from_docno(docno) for docno in self.docno_by_id.values()]
+            os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.index_path)
         except Exception as e:
-            logger.error(f"保存数据失败: {str(e)}")
+            logger.error(f"压缩关键词索引失败: {str(e)}")
             
-    def add_document(self, document: Dict) -> bool:
+    def search(self, query_tokens: List[str], owner: str = None, limit: int = 50) -> List[Tuple[Dict, float, int]]:
+        """
+        BM25关键词检索
+        
+        Args:
+            query_tokens: 查询词列表
+            owner: 角色名，如果提供则只检索该角色的文档
+            limit: 返回的候选数量
+            
+        Returns:
+            List[Tuple[Dict, float, int]]: (文档, BM25分数, 文档序号) 列表，按分数降序
+        """
+        with self._lock:
+            n = self.live_count
+            if n == 0:
+                return []
+            avg_len = self.total_len / n if n else 1.0
+            scores = {}
+            
+            for token in set(query_tokens):
+                posting = self.postings.get(token)
+                if not posting:
+                    continue
+                df = len(posting)
+                # 出现在大多数文档中的词区分度很低，跳过以控制开销
+                if n > 100 and df > n * 0.6:
+                    continue
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                for docno, tf in posting.items():
+                    if owner and owner not in self.owners[docno]:
+                        continue
+                    norm = tf + self.k1 * (1 - self.b + self.b * self.doc_lens[docno] / max(avg_len, 1e-9))
+                    scores[docno] = scores.get(docno, 0.0) + idf * tf * (self.k1 + 1) / norm
+                    
+            top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+            return [(self.docs[docno], score, docno) for docno, score in top if self.docs[docno] is not None]
+            
+    def recent(self, owner: str, limit: int) -> List[Tuple[Dict, int]]:
+        """
+        获取角色最近写入的文档
+        
+        Args:
+            owner: 角色名
+            limit: 数量
+            
+        Returns:
+            List[Tuple[Dict, int]]: (文档, 文档序号) 列表
+        """
+        with self._lock:
+            docnos = self.owner_docs.get(owner, {})
+            latest = itertools.islice(reversed(docnos), max(limit, 0))
+            return [(self.docs[docno], docno) for docno in latest if self.docs[docno] is not None]
+
+# 近似重复检测
+class SimHashIndex:
+    """
+    按所有者分组的SimHash指纹索引，用于入库前发现近似重复的文档
+    
+    64位指纹按16位分为4段，任一段相同的文档作为候选，再按汉明距离判断
+    """
+    
+    BANDS = 4
+    BAND_BITS = 16
+    
+    def __init__(self, max_distance: int = 3):
+        """
+        初始化指纹索引
+        
+        Args:
+            max_distance: 视为重复的最大汉明距离
+        """
+        self.max_distance = max_distance
+        self.buckets = {}      # (所有者, 段号, 段值) -> 文档ID集合
+        self.fingerprints = {} # 文档ID -> (所有者, 指纹)
+        
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        规范化文本：转小写并去掉空白和标点
+        
+        Args:
+            text: 原始文本
+            
+        Returns:
+            str: 规范化后的文本
+        """
+        return re.sub(r"[\s\W_]+", "", (text or "").lower())
+        
+    @classmethod
+    def fingerprint(cls, text: str) -> int:
+        """
+        计算文本的64位SimHash指纹（基于字符3-gram）
+        
+        Args:
+            text: 原始文本
+            
+        Returns:
+            int: 指纹
+        """
+        normalized = cls.normalize(text)
+        if not normalized:
+            return 0
+        shingles = [normalized[i:i + 3] for i in range(max(1, len(normalized) - 2))]
+        weights = [0] * 64
+        for shingle in shingles:
+            value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+            for bit in range(64):
+                weights[bit] += 1 if value >> bit & 1 else -1
+        return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+        
+    @staticmethod
+    def owner_key(metadata: Dict) -> Optional[str]:
+        """
+        文档在索引中的分组键：群聊消息按群隔离，其余按metadata.user_id
+        
+        Args:
+            metadata: 文档元数据
+            
+        Returns:
+            Optional[str]: 分组键
+        """
+        group_id = metadata.get("group_id")
+        if metadata.get("type") == "group_chat_message" and group_id:
+            return f"group:{group_id}"
+        return metadata.get("user_id")
+        
+    def _bands(self, fingerprint: int) -> List[int]:
+        mask = (1 << self.BAND_BITS) - 1
+        return [(fingerprint >> (band * self.BAND_BITS)) & mask for band in range(self.BANDS)]
+        
+    def add(self, doc_id: str, owner: str, fingerprint: int):
+        """
+        添加或更新文档指纹
+        
+        Args:
+            doc_id: 文档ID
+            owner: 所有者
+            fingerprint: 指纹
+        """
+        self.remove(doc_id)
+        self.fingerprints[doc_id] = (owner, fingerprint)
+        for band, value in enumerate(self._bands(fingerprint)):
+            self.buckets.setdefault((owner, band, value), set()).add(doc_id)
+            
+    def remove(self, doc_id: str):
+        """
+        移除文档指纹
+        
+        Args:
+            doc_id: 文档ID
+        """
+        old = self.fingerprints.pop(doc_id, None)
+        if old is None:
+            return
+        owner, fingerprint = old
+        for band, value in enumerate(self._bands(fingerprint)):
+            bucket = self.buckets.get((owner, band, value))
+            if bucket is not None:
+                bucket.discard(doc_id)
+                if not bucket:
+                    del self.buckets[(owner, band, value)]
+                    
+    def find(self, owner: str, fingerprint: int) -> Optional[str]:
+        """
+        查找同一所有者下的近似重复文档
+        
+        Args:
+            owner: 所有者
+            fingerprint: 指纹
+            
+        Returns:
+            Optional[str]: 汉明距离最小的重复文档ID，没有时返回None
+        """
+        best_id, best_distance = None, self.max_distance + 1
+        seen = set()
+        for band, value in enumerate(self._bands(fingerprint)):
+            for doc_id in self.buckets.get((owner, band, value), ()):
+                if doc_id in seen:
+                    continue
+                seen.add(doc_id)
+                distance = bin(self.fingerprints[doc_id][1] ^ fingerprint).count("1")
+                if distance < best_distance:
+                    best_id, best_distance = doc_id, distance
+        return best_id
+        
+    def reset(self, documents: List[Dict]):
+        """
+        根据文档列表重建索引
+        
+        Args:
+            documents: 文档列表
+        """
+        self.buckets = {}
+        self.fingerprints = {}
+        for doc in documents:
+            metadata = doc.get("metadata", {})
+            fingerprint = metadata.get("simhash")
+            fingerprint = int(fingerprint, 16) if fingerprint else self.fingerprint(doc.get("content", ""))
+            self.add(doc.get("id"), self.owner_key(metadata), fingerprint)
+
+# 近似最近邻索引
+class IvfIndex:
+    """
+    倒排文件（IVF）近似最近邻索引
+    
+    使用球面k-means将归一化向量划分到若干簇，查询时只扫描最近的nprobe个簇。
+    索引与存储文件同目录持久化，召回率下降时在后台重建。
+    """
+    
+    def __init__(self, index_path: str, nlist: int = 0, nprobe: int = 8,
+                 min_documents: int = 5000, recall_threshold: float = 0.9,
+                 check_interval: int = 2000):
+        """
+        初始化IVF索引
+        
+        Args:
+            index_path: 索引文件路径（.npz）
+            nlist: 簇数量，0表示按sqrt(N)自动确定
+            nprobe: 查询时扫描的簇数量
+            min_documents: 文档数低于该值时不使用索引
+            recall_threshold: recall@k自检阈值，低于该值时重建
+            check_interval: 每新增多少条向量执行一次自检
+        """
+        self.index_path = index_path
+        self.nlist = int(nlist or 0)
+        self.nprobe = max(1, int(nprobe))
+        self.min_documents = int(min_documents)
+        self.recall_threshold = float(recall_threshold)
+        self.check_interval = max(1, int(check_interval))
+        
+        self.centroids = None       # (nlist, dim) float32
+        self.row_assign = np.zeros(0, dtype=np.int32)  # 行号 -> 簇号，-1表示未分配
+        self.lists = []             # 簇号 -> 行号列表
+        self.last_recall = None
+        
+        self._lock = threading.Lock()
+        self._building = False
+        self._generation = 0        # 存储行号重排时递增，用于丢弃基于旧行布局的构建结果
+        self._adds_since_check = 0
+        
+    @property
+    def ready(self) -> bool:
+        """索引是否可用"""
+        return self.centroids is not None
+        
+    def load(self, storage) -> bool:
+        """
+        从磁盘加载索引
+        
+        Args:
+            storage: 提供_matrix和_matrix_size的存储实例
+            
+        Returns:
+            bool: 是否加载成功
+        """
+        try:
+            if not os.path.exists(self.index_path):
+                return False
+            with np.load(self.index_path) as data:
+                centroids = data["centroids"].astype(np.float32)
+                row_assign = data["row_assign"].astype(np.int32)
+                nprobe = int(data["nprobe"])
+                fingerprint = str(data["fingerprint"])
+            if centroids.ndim != 2 or centroids.shape[1] != storage._matrix.shape[1]:
+                logger.info(f"ANN索引维度与存储不一致，忽略已有索引: {self.index_path}")
+                return False
+            # 行号与文档的对应关系变化后（如清空、重排），旧索引不可复用
+            if row_assign.shape[0] > storage._matrix_size or \
+                    fingerprint != storage._row_fingerprint(row_assign.shape[0]):
+                logger.info(f"ANN索引与存储行不一致，忽略已有索引: {self.index_path}")
+                return False
+            with self._lock:
+                self._install(centroids, row_assign)
+                self.nprobe = max(self.nprobe, nprobe)
+            logger.info(f"已加载ANN索引: {centroids.shape[0]} 个簇, {row_assign.shape[0]} 行")
+            return True
+        except Exception as e:
+            logger.error(f"加载ANN索引失败: {str(e)}")
+            return False
+            
+    def save(self, storage, generation: int = None):
+        """
+        持久化索引
+        
+        Args:
+            storage: 存储实例，用于记录行指纹
+            generation: 结果对应的行布局代数，与当前不一致时不保存
+        """
+        try:
+            n = storage._matrix_size
+            with self._lock:
+                if self.centroids is None or (generation is not None and generation != self._generation):
+                    return
+                centroids = self.centroids
+                row_assign = np.full(n, -1, dtype=np.int32)
+                m = min(n, self.row_assign.shape[0])
+                row_assign[:m] = self.row_assign[:m]
+                nprobe = self.nprobe
+            tmp_path = self.index_path + ".tmp.npz"
+            np.savez(tmp_path, centroids=centroids, row_assign=row_assign, nprobe=np.int32(nprobe),
+                     fingerprint=np.array(storage._row_fingerprint(n)))
+            with self._lock:
+                # 写文件期间行号发生重排时丢弃
+                if generation is not None and generation != self._generation:
+                    os.remove(tmp_path)
+                    return
+                os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            logger.error(f"保存ANN索引失败: {str(e)}")
+            
+    def _install(self, centroids: np.ndarray, row_assign: np.ndarray):
+        """安装新的簇中心与行分配（调用方持有锁）"""
+        lists = [[] for _ in range(centroids.shape[0])]
+        for row, cluster in enumerate(row_assign.tolist()):
+            if cluster >= 0:
+                lists[cluster].append(row)
+        self.centroids = centroids
+        self.row_assign = row_assign
+        self.lists = lists
+        
+    def invalidate(self):
+        """存储行号重排后使索引失效，进行中的构建结果随之作废"""
+        with self._lock:
+            self._generation += 1
+            self.centroids = None
+            self.row_assign = np.zeros(0, dtype=np.int32)
+            self.lists = []
+            
+    def _train(self, matrix: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        球面k-means训练并分配所有行
+        
+        Args:
+            matrix: 归一化向量矩阵
+            n: 有效行数
+            
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 簇中心与行分配
+        """
+        nlist = self.nlist or int(max(1, round(math.sqrt(n))))
+        nlist = min(nlist, n)
+        rng = np.random.default_rng(0)
+        
+        # 只用采样训练簇中心，控制构建耗时
+        sample_size = min(n, nlist * 64)
+        sample = np.asarray(matrix[rng.choice(n, sample_size, replace=False)], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        
+        for _ in range(10):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assign == c]
+                if members.shape[0]:
+                    centroids[c] = members.sum(axis=0)
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids /= norms
+            
+        row_assign = np.empty(n, dtype=np.int32)
+        for start in range(0, n, 8192):
+            block = np.asarray(matrix[start:start + 8192], dtype=np.float32)
+            row_assign[start:start + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+        return centroids.astype(np.float32), row_assign
+        
+    def build(self, storage) -> bool:
+        """
+        基于存储的嵌入矩阵构建索引
+        
+        Args:
+            storage: 提供_matrix和_matrix_size的存储实例
+            
+        Returns:
+            bool: 是否构建成功
+        """
+        try:
+            with self._lock:
+                generation = self._generation
+            matrix = storage._matrix
+            n = storage._matrix_size
+            if n < max(self.min_documents, 1):
+                return False
+                
+            start_time = time.time()
+            centroids, row_assign = self._train(matrix, n)
+            with self._lock:
+                # 训练期间存储行号已重排，簇分配对应的是旧的行布局
+                if generation != self._generation:
+                    logger.info("ANN索引构建期间存储已重排，丢弃本次构建结果")
+                    return False
+                self._install(centroids, row_assign)
+                
+            # 构建期间追加的行直接分配到最近的簇
+            for row in range(n, storage._matrix_size):
+                self.add(row, storage._matrix[row])
+                
+            self.last_recall = self.self_check(storage)
+            logger.info(f"ANN索引构建完成: {n} 行, {centroids.shape[0]} 个簇, "
+                        f"nprobe={self.nprobe}, recall@10={self.last_recall:.3f}, "
+                        f"耗时 {time.time() - start_time:.2f}s")
+            
+            # 召回率不足时扩大扫描范围
+            while self.last_recall < self.recall_threshold and self.nprobe < centroids.shape[0]:
+                self.nprobe = min(centroids.shape[0], self.nprobe * 2)
+                self.last_recall = self.self_check(storage)
+                logger.info(f"ANN召回率不足，nprobe调整为 {self.nprobe}，recall@10={self.last_recall:.3f}")
+                
+            self.save(storage, generation)
+            return True
+        except Exception as e:
+            logger.error(f"构建ANN索引失败: {str(e)}")
+            return False
+            
+    def build_async(self, storage):
+        """
+        在后台线程构建索引
+        
+        Args:
+            storage: 存储实例
+        """
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+            
+        def _run():
+            try:
+                while True:
+                    with self._lock:
+                        generation = self._generation
+                    self.build(storage)
+                    with self._lock:
+                        # 构建期间没有发生重排时结束；否则之前被忽略的重建请求由这里补上
+                        if generation == self._generation:
+                            self._building = False
+                            return
+                    if storage._matrix_size < self.min_documents:
+                        return
+                    logger.info("ANN索引构建期间存储已重排，按新的行布局重新构建")
+            finally:
+                with self._lock:
+                    self._building = False
+                    
+        threading.Thread(target=_run, daemon=True, name="ann-index-build").start()
+        
+    def add(self, row: int, vector) -> None:
+        """
+        将新增或更新的行分配到最近的簇
+        
+        Args:
+            row: 行号
+            vector: 归一化向量
+        """
+        with self._lock:
+            if self.centroids is None:
+                return
+            cluster = int(np.argmax(self.centroids @ np.asarray(vector, dtype=np.float32)))
+            if row >= self.row_assign.shape[0]:
+                grown = np.full(max(row + 1, self.row_assign.shape[0] * 2), -1, dtype=np.int32)
+                grown[:self.row_assign.shape[0]] = self.row_assign
+                self.row_assign = grown
+            old = self.row_assign[row]
+            if old == cluster:
+                return
+            if old >= 0:
+                self.lists[old].remove(row)
+            self.row_assign[row] = cluster
+            self.lists[cluster].append(row)
+            self._adds_since_check += 1
+            
+    def maybe_check(self, storage):
+        """
+        新增数量达到阈值时在后台执行召回自检，必要时重建
+        
+        Args:
+            storage: 存储实例
+        """
+        if self._adds_since_check < self.check_interval or self._building:
+            return
+        self._adds_since_check = 0
+        
+        def _run():
+            with self._lock:
+                generation = self._generation
+            recall = self.self_check(storage)
+            self.last_recall = recall
+            if recall < self.recall_threshold:
+                logger.info(f"ANN索引召回率下降到 {recall:.3f}，后台重建索引")
+                self.build_async(storage)
+            else:
+                self.save(storage, generation)
+                
+        threading.Thread(target=_run, daemon=True, name="ann-index-check").start()
+        
+    def candidates(self, query_vec: np.ndarray) -> Optional[np.ndarray]:
+        """
+        获取查询向量的候选行号
+        
+        Args:
+            query_vec: 归一化查询向量
+            
+        Returns:
+            Optional[np.ndarray]: 候选行号数组，索引不可用时返回None
+        """
+        with self._lock:
+            if self.centroids is None:
+                return None
+            nprobe = min(self.nprobe, self.centroids.shape[0])
+            centroid_scores = self.centroids @ query_vec
+            if nprobe < centroid_scores.shape[0]:
+                probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+            else:
+                probe = np.arange(centroid_scores.shape[0])
+            rows = [row for cluster in probe for row in self.lists[cluster]]
+        return np.asarray(rows, dtype=np.int64)
+        
+    def self_check(self, storage, k: int = 10, samples: int = 32) -> float:
+        """
+        recall@k自检：用扰动后的已存向量作查询，对比精确检索结果
+        
+        Args:
+            storage: 存储实例
+            k: 比较的结果数量
+            samples: 采样查询数
+            
+        Returns:
+            float: 平均召回率
+        """
+        try:
+            n = storage._matrix_size
+            if n == 0 or self.centroids is None:
+                return 0.0
+            matrix = storage._matrix[:n]
+            rng = np.random.default_rng()
+            k = min(k, n)
+            hits = 0
+            total = 0
+            for row in rng.choice(n, min(samples, n), replace=False):
+                query = np.asarray(matrix[row], dtype=np.float32)
+                query = query + rng.normal(0, 0.05, query.shape[0]).astype(np.float32)
+                query /= max(np.linalg.norm(query), 1e-12)
+                
+                exact_scores = matrix @ query
+                exact = set(np.argpartition(-exact_scores, k - 1)[:k].tolist())
+                
+                rows = self.candidates(query)
+                rows = rows[rows < n] if rows is not None else np.zeros(0, dtype=np.int64)
+                if rows.shape[0] > k:
+                    approx_scores = exact_scores[rows]
+                    rows = rows[np.argpartition(-approx_scores, k - 1)[:k]]
+                hits += len(exact & set(rows.tolist()))
+                total += k
+            return hits / total if total else 0.0
+        except Exception as e:
+            logger.error(f"ANN召回自检失败: {str(e)}")
+            return 0.0
+
+# 量化向量
+class QuantizedMatrix:
+    """
+    嵌入矩阵的量化副本，用于低内存的粗排扫描
+    
+    float16按半精度存储；int8按行缩放（scale = max|v| / 127），得分为 (q·x) * scale。
+    粗排后可用原始float32矩阵对前若干候选做精确重排。
+    float16只节省内存：numpy没有半精度矩阵乘法，分块转换回float32的开销使扫描比float32慢数倍；
+    int8同时节省内存和扫描时间，推荐使用
+    """
+    
+    MODES = ("float16", "int8")
+    
+    def __init__(self, mode: str = "int8", rescore: bool = True, rescore_factor: int = 4,
+                 block_rows: int = 256):
+        """
+        初始化量化矩阵
+        
+        Args:
+            mode: 量化方式，int8（推荐）或float16（只节省内存）
+            rescore: 是否用float32向量对粗排候选精确重排
+            rescore_factor: 重排候选数为top_k的倍数
+            block_rows: 分块打分的行数，float32缓冲区保持在CPU缓存内
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"不支持的量化方式: {mode}")
+        self.mode = mode
+        self.rescore = rescore
+        self.rescore_factor = max(1, int(rescore_factor))
+        self.block_rows = block_rows
+        self.dtype = np.float16 if mode == "float16" else np.int8
+        self.size = 0
+        self.data = np.zeros((0, 0), dtype=self.dtype)
+        self.scales = np.zeros(0, dtype=np.float32)
+        
+    @property
+    def nbytes(self) -> int:
+        """量化数据占用的字节数"""
+        return int(self.data[:self.size].nbytes + (self.scales[:self.size].nbytes if self.mode == "int8" else 0))
+        
+    def _quantize(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        量化一组行向量
+        
+        Args:
+            vectors: float32行向量
+            
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 量化数据和每行缩放系数
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.mode == "float16":
+            return vectors.astype(np.float16), np.ones(vectors.shape[0], dtype=np.float32)
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+        
+    def rebuild(self, matrix: np.ndarray, size: int):
+        """
+        根据float32矩阵的前size行重建量化数据
+        
+        Args:
+            matrix: float32嵌入矩阵（可以是memmap）
+            size: 有效行数
+        """
+        dim = matrix.shape[1] if matrix.ndim == 2 else 0
+        capacity = max(16, size)
+        self.data = np.zeros((capacity, dim), dtype=self.dtype)
+        self.scales = np.ones(capacity, dtype=np.float32)
+        for start in range(0, size, self.block_rows):
+            end = min(size, start + self.block_rows)
+            self.data[start:end], self.scales[start:end] = self._quantize(matrix[start:end])
+        self.size = size
+        
+    def set_row(self, row: int, vec: np.ndarray):
+        """
+        写入一行（追加或覆盖），容量不足时按倍数扩容
+        
+        Args:
+            row: 行号
+            vec: float32归一化向量
+        """
+        vec = np.asarray(vec, dtype=np.float32)
+        if self.data.shape[1] != vec.shape[0]:
+            # 维度变化时由调用方整体重建
+            return
+        if row >= self.data.shape[0]:
+            capacity = max(row + 1, self.data.shape[0] * 2)
+            grown = np.zeros((capacity, self.data.shape[1]), dtype=self.dtype)
+            grown[:self.size] = self.data[:self.size]
+            grown_scales = np.ones(capacity, dtype=np.float32)
+            grown_scales[:self.size] = self.scales[:self.size]
+            self.data, self.scales = grown, grown_scales
+        quantized, scales = self._quantize(vec[None, :])
+        self.data[row] = quantized[0]
+        self.scales[row] = scales[0]
+        self.size = max(self.size, row + 1)
+        
+    def scores(self, query_vec: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        """
+        计算查询向量与量化行的近似相似度
+        
+        Args:
+            query_vec: float32归一化查询向量
+            rows: 候选行号，None表示全部行
+            
+        Returns:
+            np.ndarray: 近似得分
+        """
+        count = self.size if rows is None else rows.shape[0]
+        scores = np.empty(count, dtype=np.float32)
+        buffer = np.empty((min(self.block_rows, max(count, 1)), self.data.shape[1]), dtype=np.float32)
+        # 分块转换为float32后打分，避免一次性展开整个矩阵
+        for start in range(0, count, self.block_rows):
+            end = min(count, start + self.block_rows)
+            index = slice(start, end) if rows is None else rows[start:end]
+            block = buffer[:end - start]
+            np.copyto(block, self.data[index], casting="unsafe")
+            scores[start:end] = block @ query_vec
+            if self.mode == "int8":
+                scores[start:end] *= self.scales[index]
+        return scores
+
+# 向量降维投影
+class VectorProjection:
+    """
+    将不同维度的嵌入向量统一投影到固定的低维空间
+    
+    truncate：Matryoshka式截断前dim维后重新归一化（text-embedding-3系列按此方式训练）；
+    pca：在已存向量上拟合一次PCA，投影矩阵与索引一起保存，未拟合的维度退回截断
+    """
+    
+    MODES = ("truncate", "pca")
+    
+    def __init__(self, path: str, mode: str = "truncate", dim: int = 256,
+                 min_fit_documents: int = 1000, fit_samples: int = 4096):
+        """
+        初始化投影
+        
+        Args:
+            path: 投影矩阵文件路径（.npz）
+            mode: 投影方式，truncate或pca
+            dim: 目标维度
+            min_fit_documents: pca模式下拟合所需的最少文档数
+            fit_samples: 拟合时最多采样的向量数
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"不支持的投影方式: {mode}")
+        self.path = path
+        self.mode = mode
+        self.dim = int(dim)
+        self.min_fit_documents = min_fit_documents
+        self.fit_samples = fit_samples
+        self.source_dim = None
+        self.mean = None
+        self.components = None  # (dim, source_dim)
+        
+    @property
+    def fitted(self) -> bool:
+        """PCA投影是否已拟合"""
+        return self.components is not None
+        
+    def needs_fit(self, count: int) -> bool:
+        """
+        是否应当拟合PCA投影
+        
+        Args:
+            count: 当前可用于拟合的向量数
+            
+        Returns:
+            bool: 是否需要拟合
+        """
+        return self.mode == "pca" and not self.fitted and count >= self.min_fit_documents
+        
+    def load(self) -> bool:
+        """
+        加载已保存的PCA投影
+        
+        Returns:
+            bool: 是否加载成功
+        """
+        if self.mode != "pca" or not os.path.exists(self.path):
+            return False
+        try:
+            with np.load(self.path) as data:
+                if int(data["dim"]) != self.dim:
+                    logger.info(f"投影目标维度已变化 ({int(data['dim'])} -> {self.dim})，需要重新拟合")
+                    return False
+                self.mean = data["mean"].astype(np.float32)
+                self.components = data["components"].astype(np.float32)
+                self.source_dim = int(data["source_dim"])
+            logger.info(f"已加载PCA投影: {self.source_dim} -> {self.dim} 维")
+            return True
+        except Exception as e:
+            logger.error(f"加载PCA投影失败: {str(e)}")
+            return False
+            
+    def save(self):
+        """保存PCA投影"""
+        if not self.fitted:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp.npz"
+            np.savez(tmp_path, mean=self.mean, components=self.components,
+                     source_dim=self.source_dim, dim=self.dim)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"保存PCA投影失败: {str(e)}")
+            
+    def fit(self, vectors: np.ndarray) -> bool:
+        """
+        用随机化SVD在向量样本上拟合PCA投影
+        
+        Args:
+            vectors: 同一维度的向量矩阵（可以是memmap）
+            
+        Returns:
+            bool: 是否拟合成功
+        """
+        try:
+            count, source_dim = vectors.shape
+            if count < 2 or source_dim <= self.dim:
+                return False
+            rng = np.random.default_rng(0)
+            rows = np.sort(rng.choice(count, min(count, self.fit_samples), replace=False))
+            sample = np.asarray(vectors[rows], dtype=np.float32)
+            norms = np.linalg.norm(sample, axis=1, keepdims=True)
+            sample = sample / np.maximum(norms, 1e-12)
+            mean = sample.mean(axis=0)
+            centered = sample - mean
+            
+            # 随机化SVD：只求前dim个主成分，避免对完整协方差矩阵做分解
+            rank = min(self.dim + 10, min(centered.shape))
+            basis = centered.T @ rng.normal(size=(centered.shape[0], rank)).astype(np.float32)
+            for _ in range(2):
+                basis, _ = np.linalg.qr(basis)
+                basis = centered.T @ (centered @ basis)
+            basis, _ = np.linalg.qr(basis)
+            _, _, vt = np.linalg.svd(centered @ basis, full_matrices=False)
+            components = (basis @ vt.T).T[:self.dim]
+            
+            self.source_dim = source_dim
+            self.mean = mean.astype(np.float32)
+            self.components = np.ascontiguousarray(components, dtype=np.float32)
+            logger.info(f"PCA投影拟合完成: {source_dim} -> {self.components.shape[0]} 维，样本 {sample.shape[0]} 条")
+            self.save()
+            return True
+        except Exception as e:
+            logger.error(f"拟合PCA投影失败: {str(e)}")
+            return False
+            
+    def project_rows(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        投影一组同维度向量并归一化
+        
+        Args:
+            vectors: 向量矩阵
+            
+        Returns:
+            np.ndarray: (n, dim) float32单位向量
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[None, :]
+        if self.fitted and vectors.shape[1] == self.source_dim:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            projected = (vectors / np.maximum(norms, 1e-12) - self.mean) @ self.components.T
+        else:
+            projected = vectors[:, :self.dim]
+        if projected.shape[1] < self.dim:
+            projected = np.hstack([projected, np.zeros((projected.shape[0], self.dim - projected.shape[1]), dtype=np.float32)])
+        norms = np.linalg.norm(projected, axis=1, keepdims=True)
+        return np.where(norms > 0, projected / np.maximum(norms, 1e-12), 0).astype(np.float32)
+        
+    def project(self, embedding) -> np.ndarray:
+        """
+        投影单个向量
+        
+        Args:
+            embedding: 嵌入向量
+            
+        Returns:
+            np.ndarray: (dim,) float32单位向量
+        """
+        return self.project_rows(np.asarray(embedding, dtype=np.float32).ravel())[0]
+
+# 群聊消息存储
+class GroupMessageStore:
+    """
+    单个群聊的消息索引：时间戳 -> 消息的字典，以及按时间排序的最近消息环形缓冲区
+    
+    消息本身仍保存在storage.data['group_chats'][group_id]列表中，本类只维护索引
+    """
+    
+    def __init__(self, messages: List[Dict], recent_size: int = 200):
+        """
+        初始化群聊消息索引
+        
+        Args:
+            messages: 持久化的消息列表（原地追加）
+            recent_size: 环形缓冲区保留的最近消息数
+        """
+        self.messages = messages
+        self.recent_size = recent_size
+        self.by_timestamp = {}  # 时间戳 -> 消息
+        self.doc_ids = {}       # 时间戳 -> RAG文档ID
+        self._rebuild_recent()
+        
+    def _rebuild_recent(self):
+        """重建时间戳索引和环形缓冲区"""
+        self.by_timestamp = {}
+        for message in self.messages:
+            self.by_timestamp[message.get('timestamp', '')] = message
+        ordered = sorted(self.messages, key=lambda x: x.get('timestamp', ''))
+        self.recent = deque(ordered[-self.recent_size:], maxlen=self.recent_size)
+        
+    def get(self, timestamp: str) -> Optional[Dict]:
+        """
+        按时间戳获取消息
+        
+        Args:
+            timestamp: 消息时间戳
+            
+        Returns:
+            Optional[Dict]: 消息字典，不存在时返回None
+        """
+        return self.by_timestamp.get(timestamp)
+        
+    def add(self, message: Dict) -> Dict:
+        """
+        添加消息，相同时间戳的消息会被合并更新
+        
+        Args:
+            message: 消息字典
+            
+        Returns:
+            Dict: 存储中的消息对象
+        """
+        timestamp = message.get('timestamp', '')
+        epoch = parse_timestamp(timestamp)
+        if epoch:
+            message['epoch'] = epoch
+        existing = self.by_timestamp.get(timestamp)
+        if existing is not None:
+            existing.update(message)
+            return existing
+            
+        self.messages.append(message)
+        self.by_timestamp[timestamp] = message
+        if not self.recent or self.recent[-1].get('timestamp', '') <= timestamp:
+            self.recent.append(message)
+        else:
+            # 乱序到达的消息很少见，直接重建缓冲区
+            self._rebuild_recent()
+        return message
+        
+    def latest(self, limit: int, exclude_timestamp: str = None) -> List[Dict]:
+        """
+        获取最近的消息（按时间正序）
+        
+        Args:
+            limit: 消息数量
+            exclude_timestamp: 需要排除的消息时间戳
+            
+        Returns:
+            List[Dict]: 消息列表
+        """
+        if limit <= 0:
+            return []
+            
+        source = self.recent
+        if limit + 1 > len(self.recent) and len(self.messages) > len(self.recent):
+            # 超出缓冲区容量时退回到完整排序
+            source = sorted(self.messages, key=lambda x: x.get('timestamp', ''))
+            
+        result = []
+        for message in reversed(source):
+            if exclude_timestamp and message.get('timestamp') == exclude_timestamp:
+                continue
+            result.append(message)
+            if len(result) >= limit:
+                break
+        result.reverse()
+        return result
+
+# 存储实现
+class JsonStorage:
+    """JSON文件存储"""
+    
+    def __init__(self, file_path):
+        """
+        初始化JSON存储
+        
+        Args:
+            file_path: JSON文件路径
+        """
+        self.file_path = file_path
+        self.data = self._load_data()
+        
+        # 添加维度缓存
+        self.dimension_cache = {}
+        
+        # 嵌入矩阵：预归一化的float32行向量，与documents保持同步
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._matrix_size = 0
+        self._row_docs = []        # 行号 -> 文档字典
+        self._row_owners = []      # 行号 -> metadata.user_id
+        self._row_by_id = {}       # 文档ID -> 行号
+        self._owner_masks = {}     # user_id -> 行掩码缓存
+        self._ann_index = None     # 可选的近似最近邻索引
+        self._quantized = None     # 可选的量化矩阵
+        self._projection = None    # 可选的降维投影
+        self._projection_fitting = False  # 后台是否正在拟合投影
+        self._projection_fit = None       # 后台拟合完成、等待安装的(投影, 矩阵, 行数, 行布局)
+        self._projection_dirty_rows = set()  # 拟合期间原地更新过的行
+        self._matrix_layout = 0    # 行布局代数，整体重建矩阵时递增
+        self._keyword_index = None # 关键词倒排索引，首次使用时加载
+        self._dedup_index = None   # 近似重复指纹索引，首次使用时构建
+        self._group_stores = {}    # group_id -> GroupMessageStore
+        self.version = 0           # 语料版本，文档集合每次变更时递增
+        self._rebuild_doc_index()
+        self._rebuild_matrix()
+        self._migrate_epochs()
+        
+    def _load_data(self) -> Dict:
+        """
+        加载数据
+        
+        Returns:
+            Dict: 数据字典
+        """
+        try:
+            if os.path.exists(self.file_path):
+                with open(self.file_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                    # 确保基本结构存在
+                    if "documents" not in data:
+                        data["documents"] = []
+                    if "group_chats" not in data:
+                        data["group_chats"] = {}
+                    return data
+            else:
+                # 初始化空数据
+                data = {
+                    "documents": [],
+                    "group_chats": {}  # 添加群聊数据结构
+                }
+                self._save_data(data)
+                return data
+        except Exception as e:
+            logger.error(f"加载数据失败: {str(e)}")
+            return {"documents": [], "group_chats": {}}
+            
+    def _save_data(self, data: Dict = None):
+        """
+        保存数据
+        
+        Args:
+            data: 要保存的数据字典
+        """
+        try:
+            # 确保目录存在
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            
+            # 如果未提供数据，使用当前数据
+            if data is None:
+                data = self.data
+                
+            # 保存数据
+            with open(self.file_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.error(f"保存数据失败: {str(e)}")
+            
+    @staticmethod
+    def _time_key(document: Dict) -> str:
+        """
+        获取文档的排序时间：优先metadata.timestamp，其次从memory_前缀的ID中提取
+        
+        Args:
+            document: 文档字典
+            
+        Returns:
+            str: 可按字符串排序的时间
+        """
+        timestamp = document.get("metadata", {}).get("timestamp", "")
+        if not timestamp and "memory_" in document.get("id", ""):
+            try:
+                timestamp = document.get("id", "").split("memory_")[1]
+            except Exception:
+                pass
+        return timestamp if isinstance(timestamp, str) else str(timestamp)
+        
+    def _rebuild_doc_index(self):
+        """
+        重建文档二级索引：ID -> 位置，以及每个所有者按时间排序的文档列表
+        """
+        self._doc_pos = {}     # 文档ID -> data["documents"]中的位置
+        self._doc_keys = {}    # 文档ID -> (所有者, 排序项)
+        self._owner_times = {} # 所有者 -> 按(时间, -位置)升序的排序项列表，None表示全部文档
+        self._owner_times[None] = []
+        
+        entries = []
+        for pos, doc in enumerate(self.data.get("documents", [])):
+            self._doc_pos[doc.get("id")] = pos
+            owner = doc.get("metadata", {}).get("user_id")
+            entry = (self._time_key(doc), -pos)
+            self._doc_keys[doc.get("id")] = (owner, entry)
+            entries.append((owner, entry))
+            
+        entries.sort(key=lambda x: x[1])
+        for owner, entry in entries:
+            self._owner_times[None].append(entry)
+            self._owner_times.setdefault(owner, []).append(entry)
+            
+    def _index_document(self, pos: int, document: Dict):
+        """
+        新增或更新文档后维护二级索引
+        
+        Args:
+            pos: 文档在data["documents"]中的位置
+            document: 文档字典
+        """
+        doc_id = document.get("id")
+        owner = document.get("metadata", {}).get("user_id")
+        entry = (self._time_key(document), -pos)
+        
+        old = self._doc_keys.get(doc_id)
+        if old == (owner, entry):
+            return
+        if old is not None:
+            old_owner, old_entry = old
+            for key in (None, old_owner):
+                entries = self._owner_times.get(key, [])
+                i = bisect.bisect_left(entries, old_entry)
+                if i < len(entries) and entries[i] == old_entry:
+                    del entries[i]
+            if not self._owner_times.get(old_owner) and old_owner is not None:
+                self._owner_times.pop(old_owner, None)
+                
+        self._doc_pos[doc_id] = pos
+        self._doc_keys[doc_id] = (owner, entry)
+        bisect.insort(self._owner_times[None], entry)
+        bisect.insort(self._owner_times.setdefault(owner, []), entry)
+        
+    def add_document(self, document: Dict) -> bool:
+        """
+        添加文档
+        
+        Args:
+            document: 文档字典
+            
+        Returns:
+            bool: 是否成功添加
+        """
+        try:
+            self.version += 1
+            
+            # 检查文档ID是否已存在
+            doc_id = document.get("id")
+            keyword_index = self.get_keyword_index()
+            self._stamp_fingerprint(document)
+            self._stamp_epoch(document)
+            
+            pos = self._doc_pos.get(doc_id)
+            if pos is not None:
+                # 更新现有文档
+                existing_doc = self.data["documents"][pos]
+                existing_doc.update(document)
+                self._index_document(pos, existing_doc)
+                self._update_matrix_row(existing_doc)
+                keyword_index.add(existing_doc)
+                self._index_fingerprint(existing_doc)
+                self._save_data()
+                return True
+                    
+            # 添加新文档
+            self.data["documents"].append(document)
+            self._index_document(len(self.data["documents"]) - 1, document)
+            self._update_matrix_row(document)
+            self._maybe_fit_projection()
+            keyword_index.add(document)
+            self._index_fingerprint(document)
+            self._save_data()
+            return True
+        except Exception as e:
+            logger.error(f"添加文档失败: {str(e)}")
+            return False
+            
+    def _normalize_row(self, embedding, dim: int) -> np.ndarray:
+        """
+        将嵌入向量转换为指定维度的单位float32向量
+        
+        Args:
+            embedding: 嵌入向量
+            dim: 目标维度
+            
+        Returns:
+            np.ndarray: 归一化后的向量，范数为0时返回零向量
+        """
+        vec = np.asarray(embedding, dtype=np.float32).ravel()
+        
+        # 维度不一致时按原逻辑填充零值或截断
+        if vec.shape[0] < dim:
+            vec = np.concatenate([vec, np.zeros(dim - vec.shape[0], dtype=np.float32)])
+        elif vec.shape[0] > dim:
+            vec = vec[:dim]
+            
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            return np.zeros(dim, dtype=np.float32)
+        return vec / norm
+        
+    def _project_row(self, embedding, dim: int) -> np.ndarray:
+        """
+        将嵌入向量转换为检索矩阵中的行：启用投影时投影到目标维度，否则按原逻辑对齐维度
+        
+        Args:
+            embedding: 嵌入向量
+            dim: 检索矩阵维度
+            
+        Returns:
+            np.ndarray: 归一化后的向量
+        """
+        if self._projection is not None:
+            return self._projection.project(embedding)
+        return self._normalize_row(embedding, dim)
+        
+    @property
+    def projection_enabled(self) -> bool:
+        """是否启用了降维投影"""
+        return self._projection is not None
+        
+    def _raw_vectors(self) -> np.ndarray:
+        """
+        获取用于拟合投影的原始向量（取数量最多的维度）
+        
+        Returns:
+            np.ndarray: 原始向量矩阵
+        """
+        return self._source_vectors(self.data.get("documents", []))
+        
+    def _projection_source(self, rows):
+        """
+        获取指定行的投影来源，在调用线程上取快照，供后台线程使用
+        
+        Args:
+            rows: 行号切片或行号列表
+            
+        Returns:
+            List[Dict]: 对应行的文档
+        """
+        if isinstance(rows, slice):
+            return self._row_docs[rows]
+        return [self._row_docs[row] for row in rows]
+        
+    def _source_vectors(self, source) -> np.ndarray:
+        """
+        从投影来源中取出同一维度（数量最多的维度）的原始向量
+        
+        Args:
+            source: 文档列表
+            
+        Returns:
+            np.ndarray: 原始向量矩阵
+        """
+        embeddings = [doc["embedding"] for doc in source if doc and doc.get("embedding")]
+        if not embeddings:
+            return np.zeros((0, 0), dtype=np.float32)
+        dims = {}
+        for embedding in embeddings:
+            dims[len(embedding)] = dims.get(len(embedding), 0) + 1
+        dim = max(dims, key=dims.get)
+        return np.asarray([embedding for embedding in embeddings if len(embedding) == dim], dtype=np.float32)
+        
+    def _project_source(self, projection: "VectorProjection", source) -> np.ndarray:
+        """
+        用给定投影计算投影来源对应的检索矩阵行
+        
+        Args:
+            projection: 投影
+            source: 文档列表
+            
+        Returns:
+            np.ndarray: (len(source), dim) float32单位向量
+        """
+        matrix = np.zeros((len(source), projection.dim), dtype=np.float32)
+        for row, doc in enumerate(source):
+            if doc and doc.get("embedding"):
+                matrix[row] = projection.project(doc["embedding"])
+        return matrix
+        
+    def enable_projection(self, projection_config: Dict):
+        """
+        启用降维投影，投影矩阵文件与存储文件同目录
+        
+        Args:
+            projection_config: projection配置，支持mode、dim、min_fit_documents
+        """
+        try:
+            self._projection = VectorProjection(
+                os.path.splitext(self.file_path)[0] + ".projection.npz",
+                mode=projection_config.get("mode", "truncate"),
+                dim=projection_config.get("dim", 256),
+                min_fit_documents=projection_config.get("min_fit_documents", 1000)
+            )
+            if not self._projection.load():
+                raw = self._raw_vectors()
+                if self._projection.needs_fit(raw.shape[0]):
+                    self._projection.fit(raw)
+            self._rebuild_matrix()
+            logger.info(f"已启用{self._projection.mode}降维投影，目标维度: {self._projection.dim}")
+        except Exception as e:
+            logger.error(f"启用降维投影失败: {str(e)}")
+            self._projection = None
+            self._rebuild_matrix()
+            
+    def _maybe_fit_projection(self):
+        """
+        文档数达到阈值后在后台线程拟合PCA投影并计算新的检索矩阵，
+        完成后由下一次写入或检索在调用线程上安装
+        """
+        if self._projection is None:
+            return
+        self._install_fitted_projection()
+        if self._projection_fitting or not self._projection.needs_fit(self._matrix_size):
+            return
+            
+        current = self._projection
+        rows = self._matrix_size
+        layout = self._matrix_layout
+        source = self._projection_source(slice(0, rows))
+        self._projection_dirty_rows = set()
+        self._projection_fitting = True
+        
+        def _run():
+            try:
+                projection = VectorProjection(current.path, mode=current.mode, dim=current.dim,
+                                              min_fit_documents=current.min_fit_documents,
+                                              fit_samples=current.fit_samples)
+                if projection.fit(self._source_vectors(source)):
+                    self._projection_fit = (projection, self._project_source(projection, source), rows, layout)
+                else:
+                    # 拟合失败时不再重复尝试，继续使用截断
+                    current.min_fit_documents = float("inf")
+            except Exception as e:
+                logger.error(f"后台拟合PCA投影失败: {str(e)}")
+                current.min_fit_documents = float("inf")
+            finally:
+                self._projection_fitting = False
+                
+        threading.Thread(target=_run, daemon=True, name="projection-fit").start()
+        
+    def _install_fitted_projection(self):
+        """安装后台拟合完成的投影：补算拟合期间新增和更新的行，行布局已变化时整体重建"""
+        pending = self._projection_fit
+        if pending is None:
+            return
+        self._projection_fit = None
+        projection, matrix, rows, layout = pending
+        dirty = self._projection_dirty_rows
+        self._projection_dirty_rows = set()
+        self._projection = projection
+        
+        if layout != self._matrix_layout:
+            logger.info("投影拟合期间存储已重排，用新投影整体重建检索矩阵")
+            self._rebuild_matrix()
+            return
+            
+        capacity = max(16, self._matrix_size, matrix.shape[0])
+        if capacity > matrix.shape[0]:
+            grown = np.zeros((max(capacity, matrix.shape[0] * 2), projection.dim), dtype=np.float32)
+            grown[:rows] = matrix[:rows]
+            matrix = grown
+        fresh = sorted(set(range(rows, self._matrix_size)) | {row for row in dirty if row < self._matrix_size})
+        if fresh:
+            matrix[fresh] = self._project_source(projection, self._projection_source(fresh))
+        self._matrix = matrix
+        logger.info(f"已安装PCA投影，补算 {len(fresh)} 行")
+        self._on_matrix_rebuilt()
+        
+    def _rebuild_matrix(self):
+        """
+        根据当前文档重建嵌入矩阵及行索引
+        """
+        self._matrix_layout += 1
+        try:
+            docs = [doc for doc in self.data.get("documents", []) if doc.get("embedding")]
+            if self._projection is not None:
+                dim = self._projection.dim
+            else:
+                dim = max((len(doc["embedding"]) for doc in docs), default=0)
+            
+            matrix = np.zeros((max(len(docs), 16), dim), dtype=np.float32)
+            for row, doc in enumerate(docs):
+                matrix[row] = self._project_row(doc["embedding"], dim)
+                
+            self._matrix = matrix
+            self._matrix_size = len(docs)
+            self._row_docs = docs
+            self._row_owners = [doc.get("metadata", {}).get("user_id") for doc in docs]
+            self._row_by_id = {doc.get("id"): row for row, doc in enumerate(docs)}
+            self._owner_masks = {}
+            
+            if docs:
+                logger.debug(f"嵌入矩阵已重建: {self._matrix_size} 行, 维度 {dim}")
+            self._on_matrix_rebuilt()
+        except Exception as e:
+            logger.error(f"重建嵌入矩阵失败: {str(e)}")
+            self._matrix = np.zeros((0, 0), dtype=np.float32)
+            self._matrix_size = 0
+            self._row_docs = []
+            self._row_owners = []
+            self._row_by_id = {}
+            self._owner_masks = {}
+            
+    def _update_matrix_row(self, document: Dict):
+        """
+        在文档新增或更新后同步嵌入矩阵
+        
+        Args:
+            document: 已写入data的文档字典
+        """
+        try:
+            embedding = document.get("embedding")
+            doc_id = document.get("id")
+            row = self._row_by_id.get(doc_id)
+            
+            # 维度变化或嵌入被移除时无法原地更新，直接重建
+            if self._projection is not None:
+                dim_changed = self._matrix.shape[1] != self._projection.dim
+            else:
+                dim_changed = len(embedding or []) > self._matrix.shape[1]
+            if not embedding or dim_changed:
+                if embedding or row is not None:
+                    self._rebuild_matrix()
+                return
+                
+            vec = self._project_row(embedding, self._matrix.shape[1])
+            owner = document.get("metadata", {}).get("user_id")
+            
+            if row is None:
+                # 追加新行，容量不足时按倍数扩容
+                row = self._matrix_size
+                if row >= self._matrix.shape[0]:
+                    grown = np.zeros((max(16, self._matrix.shape[0] * 2), self._matrix.shape[1]), dtype=np.float32)
+                    grown[:row] = self._matrix[:row]
+                    self._matrix = grown
+                self._matrix_size += 1
+                self._row_docs.append(document)
+                self._row_owners.append(owner)
+                self._row_by_id[doc_id] = row
+            else:
+                self._row_docs[row] = document
+                self._row_owners[row] = owner
+                
+            self._matrix[row] = vec
+            self._owner_masks = {}
+            self._on_matrix_row_updated(row)
+        except Exception as e:
+            logger.error(f"更新嵌入矩阵失败: {str(e)}")
+            self._rebuild_matrix()
+            
+    def get_keyword_index(self) -> "KeywordIndex":
+        """
+        获取关键词倒排索引，首次调用时从磁盘加载并与当前文档对齐
+        
+        Returns:
+            KeywordIndex: 关键词索引
+        """
+        if self._keyword_index is None:
+            index = KeywordIndex(os.path.splitext(self.file_path)[0] + ".keywords.jsonl")
+            index.load(self.data.get("documents", []))
+            self._keyword_index = index
+        return self._keyword_index
+        
+    def get_dedup_index(self) -> "SimHashIndex":
+        """
+        获取近似重复指纹索引，首次调用时根据当前文档构建
+        
+        Returns:
+            SimHashIndex: 指纹索引
+        """
+        if self._dedup_index is None:
+            index = SimHashIndex()
+            index.reset(self.data.get("documents", []))
+            self._dedup_index = index
+        return self._dedup_index
+        
+    def _stamp_fingerprint(self, document: Dict):
+        """
+        为带内容和元数据的文档写入simhash指纹，避免加载时重新计算
+        
+        Args:
+            document: 待写入的文档字典
+        """
+        if "content" in document and isinstance(document.get("metadata"), dict):
+            document["metadata"]["simhash"] = f"{SimHashIndex.fingerprint(document['content']):016x}"
+            
+    def _stamp_epoch(self, document: Dict):
+        """
+        根据时间戳写入规范化的epoch秒（metadata.epoch），检索时不再解析时间字符串
+        
+        Args:
+            document: 待写入的文档字典
+        """
+        metadata = document.get("metadata")
+        if not isinstance(metadata, dict):
+            return
+        epoch = parse_timestamp(self._time_key(document))
+        if epoch:
+            metadata["epoch"] = epoch
+            
+    def _migrate_epochs(self) -> int:
+        """
+        一次性迁移：为缺少metadata.epoch的旧文档补充该字段并持久化
+        
+        Returns:
+            int: 迁移的文档数
+        """
+        try:
+            migrated = 0
+            for doc in self.data.get("documents", []):
+                metadata = doc.get("metadata")
+                if isinstance(metadata, dict) and "epoch" not in metadata:
+                    self._stamp_epoch(doc)
+                    # 无法解析的时间记为0，避免每次启动重复迁移
+                    metadata.setdefault("epoch", 0.0)
+                    migrated += 1
+                    
+            if migrated:
+                self._replace_documents(self.data.get("documents", []))
+                logger.info(f"已为 {migrated} 个旧文档补充epoch时间字段")
+            return migrated
+        except Exception as e:
+            logger.error(f"迁移文档时间字段失败: {str(e)}")
+            return 0
+            
+    def _index_fingerprint(self, document: Dict):
+        """
+        文档写入后同步指纹索引（索引尚未构建时跳过）
+        
+        Args:
+            document: 已写入data的文档字典
+        """
+        if self._dedup_index is None:
+            return
+        metadata = document.get("metadata", {})
+        fingerprint = metadata.get("simhash")
+        fingerprint = int(fingerprint, 16) if fingerprint else SimHashIndex.fingerprint(document.get("content", ""))
+        self._dedup_index.add(document.get("id"), SimHashIndex.owner_key(metadata), fingerprint)
+        
+    def find_near_duplicate(self, content: str, owner: str = None, max_distance: int = 3) -> Optional[Dict]:
+        """
+        查找同一所有者下内容近似重复的文档
+        
+        Args:
+            content: 文档内容
+            owner: 所有者（metadata.user_id，群聊消息为"group:群ID"）
+            max_distance: 视为重复的最大汉明距离
+            
+        Returns:
+            Optional[Dict]: 重复的文档，没有时返回None
+        """
+        index = self.get_dedup_index()
+        index.max_distance = max_distance
+        doc_id = index.find(owner, SimHashIndex.fingerprint(content))
+        return self.get_document(doc_id) if doc_id else None
+        
+    def merge_duplicate(self, doc_id: str, timestamp: str = None) -> bool:
+        """
+        将重复内容合并到已有文档：增加命中次数并更新最近出现时间
+        
+        Args:
+            doc_id: 已有文档ID
+            timestamp: 本次出现的时间
+            
+        Returns:
+            bool: 是否成功合并
+        """
+        doc = self.get_document(doc_id)
+        if doc is None:
+            return False
+        metadata = dict(doc.get("metadata", {}))
+        metadata["hit_count"] = metadata.get("hit_count", 1) + 1
+        metadata["last_seen"] = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return self.add_document({"id": doc_id, "metadata": metadata})
+
+    def get_group_store(self, group_id: str, create: bool = False) -> Optional[GroupMessageStore]:
+        """
+        获取群聊消息索引，首次调用时根据group_chats和已有文档构建
+
+        Args:
+            group_id: 群聊ID
+            create: 群聊不存在时是否创建
+
+        Returns:
+            Optional[GroupMessageStore]: 群聊消息索引，不存在且不创建时返回None
+        """
+        store = self._group_stores.get(group_id)
+        if store is not None:
+            return store
+
+        group_chats = self.data.setdefault("group_chats", {})
+        if group_id not in group_chats:
+            if not create:
+                return None
+            group_chats[group_id] = []
+
+        store = GroupMessageStore(group_chats[group_id])
+        # 记录已有群聊文档的ID，后续更新直接按ID定位
+        for doc in self.data.get("documents", []):
+            metadata = doc.get("metadata", {})
+            if metadata.get("type") == "group_chat_message" and metadata.get("group_id") == group_id:
+                store.doc_ids[metadata.get("timestamp", "")] = doc.get("id")
+        self._group_stores[group_id] = store
+        return store
+
+    def get_document(self, doc_id: str) -> Optional[Dict]:
+        """
+        按ID获取文档
+
+        Args:
+            doc_id: 文档ID
+
+        Returns:
+            Optional[Dict]: 文档字典，不存在时返回None
+        """
+        row = self._row_by_id.get(doc_id)
+        if row is not None and row < len(self._row_docs) and self._row_docs[row] is not None:
+            return self._row_docs[row]
+        # 没有嵌入向量的文档不在矩阵索引中
+        pos = self._doc_pos.get(doc_id)
+        return self.data["documents"][pos] if pos is not None else None
+
+    def enable_ann_index(self, ann_config: Dict):
+        """
+        启用近似最近邻索引，索引文件与存储文件同目录
+        
+        Args:
+            ann_config: ann_index配置，支持nlist、nprobe、min_documents、recall_threshold、check_interval
+        """
+        try:
+            index_path = os.path.splitext(self.file_path)[0] + ".ivf.npz"
+            self._ann_index = IvfIndex(
+                index_path,
+                nlist=ann_config.get("nlist", 0),
+                nprobe=ann_config.get("nprobe", 8),
+                min_documents=ann_config.get("min_documents", 5000),
+                recall_threshold=ann_config.get("recall_threshold", 0.9),
+                check_interval=ann_config.get("check_interval", 2000)
+            )
+            if not self._ann_index.load(self):
+                self._on_matrix_rebuilt()
+            else:
+                # 索引保存后追加的行
+                for row in range(self._ann_index.row_assign.shape[0], self._matrix_size):
+                    self._ann_index.add(row, self._matrix[row])
+        except Exception as e:
+            logger.error(f"启用ANN索引失败: {str(e)}")
+            self._ann_index = None
+            
+    def _float32_resident(self) -> bool:
+        """
+        float32检索矩阵是否常驻内存
+        
+        JSON存储的矩阵和文档中的向量列表都常驻内存，量化矩阵只会再增加一份副本
+        
+        Returns:
+            bool: 是否常驻内存
+        """
+        return True
+        
+    def enable_quantization(self, quant_config: Dict):
+        """
+        启用量化检索：检索时扫描量化矩阵，float32矩阵只用于重排
+        
+        只在float32向量通过内存映射读取时启用（二进制存储且未启用降维投影），
+        否则量化矩阵是额外的副本，反而增加内存占用。int8同时减少内存和扫描时间；
+        float16只减少内存，扫描比float32慢
+        
+        Args:
+            quant_config: quantization配置，支持mode、rescore、rescore_factor
+        """
+        if self._float32_resident():
+            logger.warning("量化检索需要二进制存储（storage.type: binary）且未启用降维投影："
+                           "当前float32向量常驻内存，量化副本只会增加内存占用，已忽略quantization配置")
+            self._quantized = None
+            return
+        mode = quant_config.get("mode", "int8")
+        if mode == "float16":
+            logger.warning("float16量化只节省内存，扫描比float32慢数倍；需要更快的检索请使用int8")
+        try:
+            self._quantized = QuantizedMatrix(
+                mode=mode,
+                rescore=quant_config.get("rescore", True),
+                rescore_factor=quant_config.get("rescore_factor", 4)
+            )
+            self._quantized.rebuild(self._matrix, self._matrix_size)
+            logger.info(f"已启用{self._quantized.mode}量化检索，量化数据 {self._quantized.nbytes / 1024 / 1024:.1f} MB")
+        except Exception as e:
+            logger.error(f"启用量化检索失败: {str(e)}")
+            self._quantized = None
+            
+    def _quantized_scores(self, query_vec: np.ndarray, candidates: Optional[np.ndarray],
+                          top_k: int) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """
+        用量化矩阵粗排，并按配置用float32向量精确重排
+        
+        Args:
+            query_vec: 归一化查询向量
+            candidates: 候选行号，None表示全部行
+            top_k: 需要的结果数量
+            
+        Returns:
+            Tuple[Optional[np.ndarray], np.ndarray]: 得分对应的行号（None表示全部行）和得分
+        """
+        scores = self._quantized.scores(query_vec, candidates)
+        if not self._quantized.rescore:
+            return candidates, scores
+            
+        k = min(scores.shape[0], top_k * self._quantized.rescore_factor)
+        if k < scores.shape[0]:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(scores.shape[0])
+        rows = candidates[top] if candidates is not None else top
+        # 按行号顺序读取，memmap时访问更连续
+        rows = np.sort(rows)
+        return rows, np.asarray(self._matrix[rows], dtype=np.float32) @ query_vec
+        
+    def _row_fingerprint(self, n: int) -> str:
+        """
+        计算前n行对应文档ID的指纹，用于校验持久化的索引
+        
+        Args:
+            n: 行数
+            
+        Returns:
+            str: 指纹
+        """
+        ids = "\x1f".join(str(doc.get("id")) if doc else "" for doc in self._row_docs[:n])
+        return hashlib.md5(ids.encode("utf-8")).hexdigest()
+        
+    def _on_matrix_rebuilt(self):
+        """嵌入矩阵整体重建后，重建量化矩阵，并使ANN索引失效并在后台重建"""
+        if self._quantized is not None:
+            self._quantized.rebuild(self._matrix, self._matrix_size)
+        if self._ann_index is None:
+            return
+        self._ann_index.invalidate()
+        if self._matrix_size >= self._ann_index.min_documents:
+            self._ann_index.build_async(self)
+            
+    def _on_matrix_row_updated(self, row: int):
         """
-        添加文档
+        嵌入矩阵单行变化后同步ANN索引
         
         Args:
-            document: 文档字典
+            row: 行号
+        """
+        if self._projection_fitting or self._projection_fit is not None:
+            self._projection_dirty_rows.add(row)
+        if self._quantized is not None:
+            if self._quantized.data.shape[1] != self._matrix.shape[1]:
+                self._quantized.rebuild(self._matrix, self._matrix_size)
+            else:
+                self._quantized.set_row(row, self._matrix[row])
+        if self._ann_index is None:
+            return
+        if self._ann_index.ready:
+            self._ann_index.add(row, self._matrix[row])
+            self._ann_index.maybe_check(self)
+        elif self._matrix_size >= self._ann_index.min_documents:
+            self._ann_index.build_async(self)
+            
+    def _get_owner_mask(self, avatar_name: str) -> np.ndarray:
+        """
+        获取指定角色的行掩码（带缓存）
+        
+        Args:
+            avatar_name: 角色名
             
         Returns:
-            bool: 是否成功添加
+            np.ndarray: 布尔行掩码
         """
-        try:
-            # 检查文档ID是否已存在
-            doc_id = document.get("id")
-            
-            for existing_doc in self.data["documents"]:
-                if existing_doc.get("id") == doc_id:
-                    # 更新现有文档
-                    existing_doc.update(document)
-                    self._save_data()
-                    return True
-                    
-            # 添加新文档
-            self.data["documents"].append(document)
-            self._save_data()
-            return True
-        except Exception as e:
-            logger.error(f"添加文档失败: {str(e)}")
-            return False
+        mask = self._owner_masks.get(avatar_name)
+        if mask is None or mask.shape[0] != self._matrix_size:
+            mask = np.fromiter((owner == avatar_name for owner in self._row_owners),
+                               dtype=bool, count=self._matrix_size)
+            self._owner_masks[avatar_name] = mask
+        return mask
             
     def search(self, query_embedding: List[float], top_k: int = 5, avatar_name: str = None) -> List[Dict]:
         """
@@ -1604,38 +4697,67 @@ class JsonStorage:
             List[Dict]: 相关文档列表
         """
         try:
-            if not self.data["documents"]:
+            self._install_fitted_projection()
+            if not self.data["documents"] or self._matrix_size == 0 or top_k <= 0:
                 return []
                 
-            # 计算余弦相似度
-            results = []
-            
-            for doc in self.data["documents"]:
-                # 如果指定了角色名，则只检索该角色的记忆
-                if avatar_name and doc.get("metadata", {}).get("user_id") != avatar_name:
-                    continue
+            dim = self._matrix.shape[1]
+            if query_embedding is None or len(query_embedding) == 0:
+                return []
+            if self._projection is None and len(query_embedding) != dim:
+                cache_key = f"{len(query_embedding)}_{dim}"
+                if cache_key not in self.dimension_cache:
+                    logger.debug(f"向量维度不匹配: 查询向量 {len(query_embedding)} vs 记忆向量 {dim}，已调整查询向量")
+                    self.dimension_cache[cache_key] = True
                     
-                doc_embedding = doc.get("embedding")
-                
-                if not doc_embedding:
-                    continue
+            query_vec = self._project_row(query_embedding, dim)
+            
+            # 启用ANN索引且文档足够多时，只对索引给出的候选行打分
+            candidates = None
+            if self._ann_index is not None and self._ann_index.ready \
+                    and self._matrix_size >= self._ann_index.min_documents:
+                candidates = self._ann_index.candidates(query_vec)
+                if candidates is not None:
+                    candidates = candidates[candidates < self._matrix_size]
+                    if avatar_name:
+                        candidates = candidates[self._get_owner_mask(avatar_name)[candidates]]
+                    # 候选不足时退回精确检索
+                    if candidates.shape[0] < top_k:
+                        candidates = None
+                        
+            # 如果指定了角色名，则只检索该角色的记忆
+            if candidates is None and avatar_name:
+                candidates = np.flatnonzero(self._get_owner_mask(avatar_name))
+                if candidates.size == 0:
+                    return []
                     
-                # 计算相似度
-                similarity = self._cosine_similarity(query_embedding, doc_embedding)
+            if self._quantized is not None:
+                candidates, scores = self._quantized_scores(query_vec, candidates, top_k)
+            elif candidates is not None:
+                scores = self._matrix[candidates] @ query_vec
+            else:
+                scores = self._matrix[:self._matrix_size] @ query_vec
                 
-                # 添加到结果列表
+            # 取前top_k个结果并按相似度降序排序
+            k = min(top_k, scores.shape[0])
+            if k < scores.shape[0]:
+                top = np.argpartition(-scores, k - 1)[:k]
+            else:
+                top = np.arange(scores.shape[0])
+            top = top[np.argsort(-scores[top], kind="stable")]
+            
+            results = []
+            for idx in top:
+                row = int(candidates[idx]) if candidates is not None else int(idx)
+                doc = self._row_docs[row]
                 results.append({
                     "id": doc.get("id"),
                     "content": doc.get("content"),
                     "metadata": doc.get("metadata", {}),
-                    "score": similarity
+                    "score": float(scores[idx])
                 })
                 
-            # 按相似度降序排序
-            results.sort(key=lambda x: x["score"], reverse=True)
-            
-            # 返回前top_k个结果
-            return results[:top_k]
+            return results
         except Exception as e:
             logger.error(f"搜索文档失败: {str(e)}")
             return []
@@ -1715,8 +4837,7 @@ class JsonStorage:
             int: 文档数量
         """
         if avatar_name:
-            return len([doc for doc in self.data.get("documents", []) 
-                       if doc.get("metadata", {}).get("user_id") == avatar_name])
+            return len(self._owner_times.get(avatar_name, []))
         return len(self.data.get("documents", []))
         
     def get_latest_documents(self, limit: int = 20, avatar_name: str = None) -> List[Dict]:
@@ -1733,45 +4854,95 @@ class JsonStorage:
         try:
             documents = self.data.get("documents", [])
             
-            # 如果指定了角色名，只获取该角色的文档
-            if avatar_name:
-                documents = [doc for doc in documents 
-                           if doc.get("metadata", {}).get("user_id") == avatar_name]
+            # 从按时间排序的索引尾部取最新的文档（指定角色名时只取该角色的文档）
+            entries = self._owner_times.get(avatar_name if avatar_name else None, [])
+            if limit <= 0:
+                return []
+            return [documents[-neg_pos] for _, neg_pos in reversed(entries[-limit:])]
+        except Exception as e:
+            logger.error(f"获取最新文档失败: {str(e)}")
+            return []
             
-            # 如果数据中包含创建时间，按时间排序
-            try:
-                documents_with_time = []
+    @property
+    def archive_path(self) -> str:
+        """归档段路径：压缩的JSON行文件，不参与检索"""
+        return os.path.splitext(self.file_path)[0] + ".archive.jsonl.gz"
+        
+    def archive_documents(self, doc_ids: List[str]) -> int:
+        """
+        将文档移出可检索集合，追加写入压缩归档段
+        
+        Args:
+            doc_ids: 要归档的文档ID列表
+            
+        Returns:
+            int: 归档的文档数
+        """
+        try:
+            doc_ids = set(doc_ids)
+            documents = self.data.get("documents", [])
+            archived = [doc for doc in documents if doc.get("id") in doc_ids]
+            if not archived:
+                return 0
                 
-                for doc in documents:
-                    # 尝试从元数据中获取时间
-                    metadata = doc.get("metadata", {})
-                    timestamp = metadata.get("timestamp", "")
-                    
-                    # 如果没有时间信息，尝试从ID中提取
-                    if not timestamp and "memory_" in doc.get("id", ""):
-                        try:
-                            time_part = doc.get("id", "").split("memory_")[1]
-                            timestamp = time_part
-                        except:
-                            pass
-                            
-                    # 添加到列表
-                    documents_with_time.append((doc, timestamp))
+            # 先写归档再移除，中途失败最多留下重复，不会丢失记忆
+            os.makedirs(os.path.dirname(self.archive_path) or ".", exist_ok=True)
+            with gzip.open(self.archive_path, "at", encoding="utf-8") as f:
+                for doc in archived:
+                    record = {key: value for key, value in doc.items() if key != "embedding"}
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
                     
-                # 按时间戳降序排序（最新的在前面）
-                documents_with_time.sort(key=lambda x: x[1], reverse=True)
-                
-                # 提取文档
-                sorted_documents = [doc for doc, _ in documents_with_time]
-                return sorted_documents[:limit]
-            except Exception as e:
-                logger.error(f"排序文档失败: {str(e)}")
-                
-            # 如果排序失败，直接返回最新的文档
-            return documents[-limit:]
+            self._replace_documents([doc for doc in documents if doc.get("id") not in doc_ids])
+            return len(archived)
         except Exception as e:
-            logger.error(f"获取最新文档失败: {str(e)}")
-            return []
+            logger.error(f"归档文档失败: {str(e)}")
+            return 0
+            
+    def load_archived_documents(self, avatar_name: str = None) -> List[Dict]:
+        """
+        读取归档段中的文档（不含嵌入向量）
+        
+        Args:
+            avatar_name: 角色名，如果提供则只返回该角色的文档
+            
+        Returns:
+            List[Dict]: 文档列表
+        """
+        documents = []
+        if not os.path.exists(self.archive_path):
+            return documents
+        try:
+            with gzip.open(self.archive_path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        doc = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if avatar_name and doc.get("metadata", {}).get("user_id") != avatar_name:
+                        continue
+                    documents.append(doc)
+        except (OSError, EOFError) as e:
+            # 写入中途崩溃会留下截断的压缩段，保留已读出的部分
+            logger.warning(f"读取归档段不完整: {str(e)}")
+        return documents
+        
+    def _replace_documents(self, documents: List[Dict]):
+        """
+        替换全部文档，重建索引和嵌入矩阵后保存
+        
+        Args:
+            documents: 新的文档列表
+        """
+        self.version += 1
+        self.data["documents"] = documents
+        self._rebuild_doc_index()
+        self._rebuild_matrix()
+        if self._keyword_index is not None:
+            self._keyword_index.reset(documents)
+        if self._dedup_index is not None:
+            self._dedup_index.reset(documents)
+        self._group_stores = {}
+        self._save_data()
             
     def clear(self, avatar_name: str = None) -> bool:
         """
@@ -1785,19 +4956,500 @@ class JsonStorage:
         """
         try:
             if avatar_name:
+                # 该角色没有记忆时无需重建
+                if avatar_name not in self._owner_times:
+                    return True
                 # 只清空指定角色的记忆
-                self.data["documents"] = [doc for doc in self.data.get("documents", [])
-                                        if doc.get("metadata", {}).get("user_id") != avatar_name]
+                kept = [doc for doc in self.data.get("documents", [])
+                        if doc.get("metadata", {}).get("user_id") != avatar_name]
             else:
                 # 清空所有记忆
                 self.data = {"documents": []}
+                kept = []
             
-            self._save_data()
+            self._replace_documents(kept)
+            return True
+        except Exception as e:
+            logger.error(f"清空存储失败: {str(e)}")
+            return False
+
+class BinaryStorage(JsonStorage):
+    """
+    追加写二进制存储
+    
+    元数据以JSON行追加到记录日志，嵌入向量以float32原始行追加到向量文件，
+    启动时通过np.memmap映射向量文件，无需解析完整的JSON
+    """
+    
+    def __init__(self, file_path):
+        """
+        初始化二进制存储
+        
+        Args:
+            file_path: 原JSON存储路径（如rag_storage.json），数据文件与其同目录
+        """
+        self.file_path = file_path
+        base_path = os.path.splitext(file_path)[0]
+        self.records_path = base_path + ".records.jsonl"
+        self.vectors_path = base_path + ".vectors.f32"
+        self.groups_path = base_path + ".groups.json"
+        
+        self.dimension_cache = {}
+        self.dimension = 0
+        self._ann_index = None
+        self._quantized = None
+        self._projection = None
+        self._projection_fitting = False
+        self._projection_fit = None
+        self._projection_dirty_rows = set()
+        self._matrix_layout = 0
+        self._raw_matrix = np.zeros((0, 0), dtype=np.float32)
+        self._keyword_index = None
+        self._dedup_index = None
+        self._group_stores = {}
+        self.version = 0
+        
+        # 首次启用时从旧的JSON存储迁移
+        if not os.path.exists(self.records_path) and os.path.exists(file_path):
+            migrate_json_to_binary(file_path)
+            
+        self.data = self._load_data()
+        self._rebuild_doc_index()
+        self._rebuild_matrix()
+        self._migrate_epochs()
+        
+    def _load_data(self) -> Dict:
+        """
+        回放记录日志加载数据
+        
+        Returns:
+            Dict: 数据字典，documents中不包含嵌入向量
+        """
+        documents = {}
+        self._doc_rows = {}
+        
+        try:
+            if os.path.exists(self.records_path):
+                with open(self.records_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # 崩溃时可能残留半行，忽略即可
+                            logger.warning(f"跳过损坏的存储记录: {line[:50]}")
+                            continue
+                            
+                        op = record.get("op")
+                        if op == "header":
+                            self.dimension = int(record.get("dim", 0))
+                        elif op == "put":
+                            doc = record.get("doc", {})
+                            doc_id = doc.get("id")
+                            if doc_id in documents:
+                                documents[doc_id].update(doc)
+                            else:
+                                documents[doc_id] = doc
+                            if record.get("row") is not None:
+                                self._doc_rows[doc_id] = record["row"]
+                                
+            group_chats = {}
+            if os.path.exists(self.groups_path):
+                with open(self.groups_path, "r", encoding="utf-8") as f:
+                    group_chats = json.load(f)
+                    
+            return {"documents": list(documents.values()), "group_chats": group_chats}
+        except Exception as e:
+            logger.error(f"加载二进制存储失败: {str(e)}")
+            return {"documents": [], "group_chats": {}}
+            
+    def _save_data(self, data: Dict = None):
+        """
+        保存群聊数据
+        
+        文档通过记录日志追加写入，这里只需持久化group_chats
+        
+        Args:
+            data: 要保存的数据字典
+        """
+        try:
+            if data is None:
+                data = self.data
+                
+            os.makedirs(os.path.dirname(self.groups_path) or ".", exist_ok=True)
+            tmp_path = self.groups_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data.get("group_chats", {}), f, ensure_ascii=False)
+            os.replace(tmp_path, self.groups_path)
+        except Exception as e:
+            logger.error(f"保存群聊数据失败: {str(e)}")
+            
+    def _append_record(self, record: Dict):
+        """
+        追加一条记录到记录日志
+        
+        Args:
+            record: 记录字典
+        """
+        os.makedirs(os.path.dirname(self.records_path) or ".", exist_ok=True)
+        with open(self.records_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            
+    def _float32_resident(self) -> bool:
+        """
+        float32检索矩阵是否常驻内存：未启用投影时检索矩阵是向量文件的内存映射
+        
+        Returns:
+            bool: 是否常驻内存
+        """
+        return self._projection is not None
+        
+    def _raw_vectors(self) -> np.ndarray:
+        """
+        获取用于拟合投影的原始向量
+        
+        Returns:
+            np.ndarray: 向量文件的内存映射
+        """
+        return self._raw_matrix[:self._matrix_size]
+        
+    def _projection_source(self, rows):
+        """
+        获取指定行的投影来源
+        
+        Args:
+            rows: 行号切片或行号列表
+            
+        Returns:
+            np.ndarray: 对应行的原始向量（切片时为内存映射视图）
+        """
+        return self._raw_matrix[rows]
+        
+    def _source_vectors(self, source) -> np.ndarray:
+        """
+        投影来源本身就是同一维度的原始向量
+        
+        Args:
+            source: 原始向量
+            
+        Returns:
+            np.ndarray: 原始向量
+        """
+        return source
+        
+    def _project_source(self, projection: "VectorProjection", source) -> np.ndarray:
+        """
+        分块投影原始向量
+        
+        Args:
+            projection: 投影
+            source: 原始向量
+            
+        Returns:
+            np.ndarray: (len(source), dim) float32单位向量
+        """
+        matrix = np.zeros((source.shape[0], projection.dim), dtype=np.float32)
+        for start in range(0, source.shape[0], 8192):
+            end = min(source.shape[0], start + 8192)
+            matrix[start:end] = projection.project_rows(source[start:end])
+        return matrix
+        
+    def _write_vector(self, row: int, embedding) -> None:
+        """
+        写入一行嵌入向量（追加或原地覆盖）
+        
+        Args:
+            row: 行号
+            embedding: 嵌入向量
+        """
+        vec = self._normalize_row(embedding, self.dimension)
+        mode = "r+b" if os.path.exists(self.vectors_path) else "wb"
+        with open(self.vectors_path, mode) as f:
+            f.seek(row * self.dimension * 4)
+            f.write(vec.tobytes())
+            
+    def _release_vectors(self) -> bool:
+        """
+        释放对向量文件的内存映射
+        
+        Returns:
+            bool: 映射是否已关闭（仍被后台线程持有时返回False）
+        """
+        mapped = self._raw_matrix
+        self._matrix = np.zeros((0, self.dimension), dtype=np.float32)
+        self._raw_matrix = self._matrix
+        if not isinstance(mapped, np.memmap):
+            return True
+        # 最后一个引用释放时映射随之关闭；不主动close，避免后台线程仍持有的视图失效
+        released = weakref.ref(mapped)
+        del mapped
+        if released() is not None:
+            gc.collect()
+        return released() is None
+        
+    @staticmethod
+    def _replace_file(src: str, dst: str, attempts: int = 50):
+        """
+        替换文件，目标仍被映射（如后台ANN构建尚未结束）时短暂重试
+        
+        Args:
+            src: 新文件路径
+            dst: 目标文件路径
+            attempts: 最多尝试次数，每次间隔0.1秒
+        """
+        for attempt in range(attempts):
+            try:
+                os.replace(src, dst)
+                return
+            except PermissionError:
+                if attempt == attempts - 1:
+                    raise
+                gc.collect()
+                time.sleep(0.1)
+                
+    def _rebuild_matrix(self):
+        """
+        映射向量文件并重建行索引
+        """
+        self._matrix_layout += 1
+        try:
+            rows = 0
+            if self.dimension and os.path.exists(self.vectors_path):
+                rows = os.path.getsize(self.vectors_path) // (self.dimension * 4)
+                
+            if rows:
+                self._raw_matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                                             shape=(rows, self.dimension))
+            else:
+                self._raw_matrix = np.zeros((0, self.dimension), dtype=np.float32)
+                
+            if self._projection is not None:
+                # 启用投影时检索矩阵为内存中的投影结果，原始向量文件只用于拟合
+                self._matrix = np.zeros((max(rows, 16), self._projection.dim), dtype=np.float32)
+                self._matrix[:rows] = self._project_source(self._projection, self._raw_matrix[:rows])
+            else:
+                self._matrix = self._raw_matrix
+                
+            self._row_docs = [None] * rows
+            self._row_owners = [None] * rows
+            self._row_by_id = {}
+            for doc in self.data.get("documents", []):
+                row = self._doc_rows.get(doc.get("id"))
+                if row is None or row >= rows:
+                    continue
+                self._row_docs[row] = doc
+                self._row_owners[row] = doc.get("metadata", {}).get("user_id")
+                self._row_by_id[doc.get("id")] = row
+                
+            self._matrix_size = rows
+            self._owner_masks = {}
+            self._on_matrix_rebuilt()
+        except Exception as e:
+            logger.error(f"映射向量文件失败: {str(e)}")
+            self._matrix = np.zeros((0, self.dimension), dtype=np.float32)
+            self._raw_matrix = self._matrix
+            self._matrix_size = 0
+            self._row_docs = []
+            self._row_owners = []
+            self._row_by_id = {}
+            self._owner_masks = {}
+            
+    def add_document(self, document: Dict) -> bool:
+        """
+        添加文档（O(1)追加写）
+        
+        Args:
+            document: 文档字典
+            
+        Returns:
+            bool: 是否成功添加
+        """
+        try:
+            self.version += 1
+            doc_id = document.get("id")
+            embedding = document.get("embedding")
+            self._stamp_fingerprint(document)
+            self._stamp_epoch(document)
+            doc = {k: v for k, v in document.items() if k != "embedding"}
+            keyword_index = self.get_keyword_index()
+            
+            # 首个向量决定存储维度
+            if embedding and not self.dimension:
+                self.dimension = len(embedding)
+                self._append_record({"op": "header", "dim": self.dimension})
+                
+            row = self._doc_rows.get(doc_id)
+            if embedding and row is None:
+                row = self._matrix_size
+                
+            if embedding:
+                self._write_vector(row, embedding)
+                
+            pos = self._doc_pos.get(doc_id)
+            if pos is not None:
+                existing_doc = self.data["documents"][pos]
+                existing_doc.update(doc)
+            else:
+                existing_doc = doc
+                self.data["documents"].append(doc)
+                pos = len(self.data["documents"]) - 1
+            self._index_document(pos, existing_doc)
+                
+            self._append_record({"op": "put", "row": row, "doc": doc})
+            keyword_index.add(existing_doc)
+            self._index_fingerprint(existing_doc)
+            
+            if row is not None:
+                self._doc_rows[doc_id] = row
+                if row >= self._matrix_size:
+                    # 重新映射以包含新追加的行
+                    self._matrix_size = row + 1
+                    self._raw_matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                                                 shape=(self._matrix_size, self.dimension))
+                    if self._projection is None:
+                        self._matrix = self._raw_matrix
+                    elif row >= self._matrix.shape[0]:
+                        grown = np.zeros((max(16, self._matrix.shape[0] * 2), self._projection.dim), dtype=np.float32)
+                        grown[:row] = self._matrix[:row]
+                        self._matrix = grown
+                    self._row_docs.append(existing_doc)
+                    self._row_owners.append(None)
+                if embedding and self._projection is not None:
+                    self._matrix[row] = self._projection.project(embedding)
+                self._row_docs[row] = existing_doc
+                self._row_owners[row] = existing_doc.get("metadata", {}).get("user_id")
+                self._row_by_id[doc_id] = row
+                self._owner_masks = {}
+                self._on_matrix_row_updated(row)
+                self._maybe_fit_projection()
+                
+            return True
+        except Exception as e:
+            logger.error(f"添加文档失败: {str(e)}")
+            return False
+            
+    def _replace_documents(self, documents: List[Dict]):
+        """
+        替换全部文档，并压缩记录日志和向量文件（只保留给定文档的向量行）
+        
+        Args:
+            documents: 新的文档列表
+        """
+        self.version += 1
+        records_tmp = self.records_path + ".tmp"
+        vectors_tmp = self.vectors_path + ".tmp"
+        new_rows = {}
+        with open(records_tmp, "w", encoding="utf-8") as rf, open(vectors_tmp, "wb") as vf:
+            if self.dimension:
+                rf.write(json.dumps({"op": "header", "dim": self.dimension}) + "\n")
+            for doc in documents:
+                row = self._row_by_id.get(doc.get("id"))
+                new_row = None
+                if row is not None:
+                    new_row = len(new_rows)
+                    vf.write(np.asarray(self._raw_matrix[row], dtype=np.float32).tobytes())
+                    new_rows[doc.get("id")] = new_row
+                rf.write(json.dumps({"op": "put", "row": new_row, "doc": doc}, ensure_ascii=False) + "\n")
+                
+        # 先释放旧映射再替换文件（Windows下文件仍被映射时无法替换）
+        self._release_vectors()
+        self._replace_file(vectors_tmp, self.vectors_path)
+        self._replace_file(records_tmp, self.records_path)
+        
+        self.data["documents"] = documents
+        self._doc_rows = new_rows
+        self._rebuild_doc_index()
+        self._rebuild_matrix()
+        if self._keyword_index is not None:
+            self._keyword_index.reset(documents)
+        if self._dedup_index is not None:
+            self._dedup_index.reset(documents)
+        self._group_stores = {}
+        
+    def clear(self, avatar_name: str = None) -> bool:
+        """
+        清空存储，并压缩记录日志和向量文件
+        
+        Args:
+            avatar_name: 角色名，如果提供则只清空该角色的记忆
+            
+        Returns:
+            bool: 是否成功清空
+        """
+        try:
+            if avatar_name:
+                kept = [doc for doc in self.data.get("documents", [])
+                        if doc.get("metadata", {}).get("user_id") != avatar_name]
+            else:
+                kept = []
+                
+            self._replace_documents(kept)
+            if not avatar_name:
+                self.data["group_chats"] = {}
+                self._save_data()
             return True
         except Exception as e:
             logger.error(f"清空存储失败: {str(e)}")
             return False
 
+def migrate_json_to_binary(json_path: str) -> bool:
+    """
+    将rag_storage.json一次性迁移为二进制存储格式
+    
+    Args:
+        json_path: rag_storage.json路径
+        
+    Returns:
+        bool: 是否迁移成功
+    """
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            
+        documents = data.get("documents", [])
+        dim = max((len(doc["embedding"]) for doc in documents if doc.get("embedding")), default=0)
+        
+        base_path = os.path.splitext(json_path)[0]
+        records_path = base_path + ".records.jsonl"
+        vectors_path = base_path + ".vectors.f32"
+        groups_path = base_path + ".groups.json"
+        
+        row = 0
+        with open(records_path + ".tmp", "w", encoding="utf-8") as rf, open(vectors_path + ".tmp", "wb") as vf:
+            if dim:
+                rf.write(json.dumps({"op": "header", "dim": dim}) + "\n")
+            for doc in documents:
+                embedding = doc.get("embedding")
+                doc_row = None
+                if embedding:
+                    vec = np.asarray(embedding, dtype=np.float32).ravel()
+                    if vec.shape[0] < dim:
+                        vec = np.concatenate([vec, np.zeros(dim - vec.shape[0], dtype=np.float32)])
+                    norm = np.linalg.norm(vec)
+                    if norm > 0:
+                        vec = vec / norm
+                    vf.write(vec.astype(np.float32).tobytes())
+                    doc_row = row
+                    row += 1
+                record_doc = {k: v for k, v in doc.items() if k != "embedding"}
+                rf.write(json.dumps({"op": "put", "row": doc_row, "doc": record_doc}, ensure_ascii=False) + "\n")
+                
+        with open(groups_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data.get("group_chats", {}), f, ensure_ascii=False)
+            
+        os.replace(vectors_path + ".tmp", vectors_path)
+        os.replace(groups_path + ".tmp", groups_path)
+        # 记录日志最后落盘，作为迁移完成的标志
+        os.replace(records_path + ".tmp", records_path)
+        
+        logger.info(f"已将 {len(documents)} 条文档从 {json_path} 迁移到二进制存储（向量 {row} 行，维度 {dim}）")
+        return True
+    except Exception as e:
+        logger.error(f"迁移JSON存储到二进制存储失败: {str(e)}")
+        return False
+
 def create_default_config(config_path: str):
     """
     创建默认RAG配置文件
@@ -1816,13 +5468,61 @@ def create_default_config(config_path: str):
             },
             "storage": {
                 "type": "json",
-                "path": "./data/rag_storage.json"
+                "path": "./data/rag_storage.json",
+                "ann_index": {
+                    "enabled": False,
+                    "nprobe": 8,
+                    "min_documents": 5000
+                },
+                "quantization": {
+                    # none、int8（推荐：内存为1/4，扫描更快）或float16（只节省内存，扫描比float32慢）
+                    "mode": "none",
+                    "rescore": True,
+                    "rescore_factor": 4
+                },
+                "projection": {
+                    "mode": "none",
+                    "dim": 256,
+                    "min_fit_documents": 1000
+                }
+            },
+            "embedding_cache": {
+                "path": "./data/cache/embedding_cache.db",
+                "memory_size": 1000,
+                "disk_max_mb": 256
+            },
+            "dedup": {
+                "enabled": True,
+                "max_distance": 3
+            },
+            "compaction": {
+                "enabled": True,
+                "interval_hours": 6,
+                "session_gap_minutes": 120,
+                "cold_after_days": 7,
+                "min_session_documents": 3,
+                "max_hot_documents": 500,
+                "max_sessions_per_run": 20
+            },
+            "query_cache": {
+                "enabled": True,
+                "max_size": 256,
+                "ttl": 300
             },
             "top_k": 5,
             "is_rerank": False,
             "reranker": {
-                "type": "api",
-                "name": "rerank-large"
+                "type": "local",
+                "name": "rerank-large",
+                "weights": {
+                    "embedding": 0.5,
+                    "bm25": 0.2,
+                    "recency": 0.15,
+                    "entity": 0.15
+                },
+                "half_life_days": 30,
+                "cache_size": 1024,
+                "cache_ttl": 600
             },
             "local_model": {
                 "enabled": False,
@@ -11,7 +11,8 @@ from datetime import datetime
 import re
 from typing import Dict, List, Optional, Any
 
-from src.handlers.memories.core.rag import RagManager
+from src.handlers.memories.core.rag import RagManager, RagNamespacePool
+from src.handlers.memories.core.async_runner import run_sync, submit
 from src.utils.logger import get_logger
 
 logger = logging.getLogger('main')
@@ -32,59 +33,87 @@ class GroupChatMemory:
         self.group_chats = group_chats
         self.api_wrapper = api_wrapper
         
-        # 为每个群聊创建独立的 RAG 管理器
-        self.rag_managers: Dict[str, RagManager] = {}
+        # 所有群聊共用一个 RAG 引擎（嵌入模型、缓存、HTTP客户端），
+        # 每个群聊的存储在首次使用时打开，空闲后自动关闭
+        self.rag_pool = RagNamespacePool(
+            config_path=os.path.join(self.root_dir, "src", "config", "config.yaml"),
+            api_wrapper=self.api_wrapper
+        )
         self._init_group_memories()
         
     def _init_group_memories(self):
-        """初始化所有群聊的记忆存储"""
+        """初始化所有群聊的记忆目录"""
         try:
-            # 获取 RAG 配置文件路径
-            rag_config_path = os.path.join(self.root_dir, "src", "config", "config.yaml")
-            
-            # 初始化每个群聊的 RAG 系统
             for group_id in self.group_chats:
-                # 清理群聊ID，移除非法字符
-                safe_group_id = self._get_safe_group_id(group_id)
-                
-                # 构建群聊专属的存储路径
-                group_storage_dir = os.path.join(
-                    self.root_dir,
-                    "data",
-                    "avatars",
-                    self.avatar_name,
-                    "groups",
-                    safe_group_id
-                )
-                
-                # 确保目录存在
-                os.makedirs(group_storage_dir, exist_ok=True)
-
-                # 创建标准的memory.json文件，与私聊保持一致
-                memory_json_path = os.path.join(group_storage_dir, "memory.json")
-                if not os.path.exists(memory_json_path):
-                    # 初始化空的memory.json，使用新的格式
-                    with open(memory_json_path, "w", encoding="utf-8") as f:
-                        json.dump({
-                            group_id: []
-                        }, f, ensure_ascii=False, indent=2)
-                    logger.info(f"为群聊 {group_id} 创建了memory.json文件")
-                
-                try:
-                    # 为每个群聊创建独立的 RAG 管理器
-                    rag_manager = RagManager(
-                        config_path=rag_config_path,
-                        api_wrapper=self.api_wrapper,
-                        storage_dir=group_storage_dir  # 使用群聊专属的存储目录
-                    )
-                    self.rag_managers[group_id] = rag_manager
-                    logger.info(f"初始化群聊 {group_id} 的 RAG 系统成功")
-                except Exception as e:
-                    logger.error(f"初始化群聊 {group_id} 的 RAG 系统失败: {str(e)}")
-                    
+                self._ensure_group_storage(group_id)
         except Exception as e:
             logger.error(f"初始化群聊记忆失败: {str(e)}")
             
+    def _get_group_storage_dir(self, group_id: str) -> str:
+        """
+        获取群聊专属的存储目录
+        
+        Args:
+            group_id: 群聊ID
+            
+        Returns:
+            str: 存储目录路径
+        """
+        return os.path.join(
+            self.root_dir,
+            "data",
+            "avatars",
+            self.avatar_name,
+            "groups",
+            self._get_safe_group_id(group_id)
+        )
+        
+    def _ensure_group_storage(self, group_id: str) -> str:
+        """
+        确保群聊存储目录和memory.json存在
+        
+        Args:
+            group_id: 群聊ID
+            
+        Returns:
+            str: 存储目录路径
+        """
+        group_storage_dir = self._get_group_storage_dir(group_id)
+        
+        # 确保目录存在
+        os.makedirs(group_storage_dir, exist_ok=True)
+
+        # 创建标准的memory.json文件，与私聊保持一致
+        memory_json_path = os.path.join(group_storage_dir, "memory.json")
+        if not os.path.exists(memory_json_path):
+            # 初始化空的memory.json，使用新的格式
+            with open(memory_json_path, "w", encoding="utf-8") as f:
+                json.dump({
+                    group_id: []
+                }, f, ensure_ascii=False, indent=2)
+            logger.info(f"为群聊 {group_id} 创建了memory.json文件")
+            
+        return group_storage_dir
+        
+    def _get_rag_manager(self, group_id: str) -> Optional[RagManager]:
+        """
+        获取群聊的 RAG 管理器，存储未打开时按需打开
+        
+        Args:
+            group_id: 群聊ID
+            
+        Returns:
+            Optional[RagManager]: RAG管理器，失败时返回None
+        """
+        if group_id not in self.group_chats:
+            logger.warning(f"群聊 {group_id} 未初始化 RAG 系统")
+            return None
+        try:
+            return self.rag_pool.get(group_id, self._get_group_storage_dir(group_id))
+        except Exception as e:
+            logger.error(f"打开群聊 {group_id} 的 RAG 存储失败: {str(e)}")
+            return None
+            
     def _get_safe_group_id(self, group_id: str) -> str:
         """
         生成安全的群聊ID作为目录名
@@ -101,6 +130,19 @@ class GroupChatMemory:
             safe_id = "default_group"
         return safe_id
             
+    @staticmethod
+    def _log_background_error(future):
+        """
+        记录后台RAG任务的异常
+        
+        Args:
+            future: 后台任务的Future
+        """
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"群聊RAG后台任务失败: {str(e)}")
+            
     def add_message(self, group_id: str, sender_name: str, message: str, is_at: bool = False) -> str:
         """
         添加群聊消息到记忆
@@ -115,55 +157,15 @@ class GroupChatMemory:
             str: 消息时间戳
         """
         try:
-            # 如果群聊未初始化，尝试动态初始化
-            if group_id not in self.rag_managers:
+            # 如果群聊首次出现，创建存储目录并加入群聊列表
+            if group_id not in self.group_chats:
                 logger.info(f"群聊 {group_id} 首次出现，正在初始化 RAG 系统")
+                self._ensure_group_storage(group_id)
+                self.group_chats.append(group_id)
                 
-                # 添加到群聊列表
-                if group_id not in self.group_chats:
-                    self.group_chats.append(group_id)
-                
-                # 清理群聊ID，移除非法字符
-                safe_group_id = self._get_safe_group_id(group_id)
-                
-                # 构建群聊专属的存储路径
-                group_storage_dir = os.path.join(
-                    self.root_dir,
-                    "data",
-                    "avatars",
-                    self.avatar_name,
-                    "groups",
-                    safe_group_id
-                )
-                
-                # 确保目录存在
-                os.makedirs(group_storage_dir, exist_ok=True)
-
-                # 检查memory.json是否存在，如果不存在则创建
-                memory_json_path = os.path.join(group_storage_dir, "memory.json")
-                if not os.path.exists(memory_json_path):
-                    # 初始化空的memory.json，使用新的格式
-                    with open(memory_json_path, "w", encoding="utf-8") as f:
-                        json.dump({
-                            group_id: []
-                        }, f, ensure_ascii=False, indent=2)
-                    logger.info(f"为群聊 {group_id} 创建了memory.json文件")
-                
-                try:
-                    # 获取 RAG 配置文件路径
-                    rag_config_path = os.path.join(self.root_dir, "src", "config", "config.yaml")
-                    
-                    # 为群聊创建独立的 RAG 管理器
-                    rag_manager = RagManager(
-                        config_path=rag_config_path,
-                        api_wrapper=self.api_wrapper,
-                        storage_dir=group_storage_dir  # 使用群聊专属的存储目录
-                    )
-                    self.rag_managers[group_id] = rag_manager
-                    logger.info(f"动态初始化群聊 {group_id} 的 RAG 系统成功")
-                except Exception as e:
-                    logger.error(f"动态初始化群聊 {group_id} 的 RAG 系统失败: {str(e)}")
-                    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            rag_manager = self._get_rag_manager(group_id)
+            if rag_manager is None:
+                return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 
             # 创建记忆条目
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -212,22 +214,11 @@ class GroupChatMemory:
                 except Exception as e:
                     logger.error(f"更新群聊 {group_id} 的memory.json文件失败: {str(e)}")
             
-            # 异步添加到RAG系统
-            import asyncio
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
-            if loop.is_running():
-                future = asyncio.run_coroutine_threadsafe(
-                    self.rag_managers[group_id].add_group_chat_message(group_id, message_data),
-                    loop
-                )
-                future.result()
-            else:
-                loop.run_until_complete(self.rag_managers[group_id].add_group_chat_message(group_id, message_data))
+            # 异步添加到RAG系统：群聊存储按提交顺序立即更新；文档在嵌入向量返回后入库，
+            # 期间到达的助手回复由add_group_chat_message在入库时合并进文档
+            submit(
+                rag_manager.add_group_chat_message(group_id, message_data)
+            ).add_done_callback(self._log_background_error)
                 
             return timestamp
             
@@ -248,8 +239,8 @@ class GroupChatMemory:
             bool: 是否成功更新
         """
         try:
-            if group_id not in self.rag_managers:
-                logger.warning(f"群聊 {group_id} 未初始化 RAG 系统")
+            rag_manager = self._get_rag_manager(group_id)
+            if rag_manager is None:
                 return False
             
             # 更新memory.json文件
@@ -305,21 +296,9 @@ class GroupChatMemory:
                     logger.error(f"更新群聊 {group_id} 的memory.json文件失败: {str(e)}")
             
             # 异步更新RAG系统
-            import asyncio
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
-            if loop.is_running():
-                future = asyncio.run_coroutine_threadsafe(
-                    self.rag_managers[group_id].update_group_chat_response(group_id, timestamp, response),
-                    loop
-                )
-                future.result()
-            else:
-                loop.run_until_complete(self.rag_managers[group_id].update_group_chat_response(group_id, timestamp, response))
+            submit(
+                rag_manager.update_group_chat_response(group_id, timestamp, response)
+            ).add_done_callback(self._log_background_error)
             
             return True
             
@@ -391,28 +370,14 @@ class GroupChatMemory:
         """
         try:
             # 检查是否初始化了RAG系统
-            if group_id not in self.rag_managers:
-                logger.warning(f"群聊 {group_id} 未初始化 RAG 系统")
+            rag_manager = self._get_rag_manager(group_id)
+            if rag_manager is None:
                 return []
             
             # 使用RAG钩子获取最近的消息
-            import asyncio
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
-            if loop.is_running():
-                future = asyncio.run_coroutine_threadsafe(
-                    self.rag_managers[group_id].group_chat_query(group_id, current_timestamp, context_size),
-                    loop
-                )
-                context_messages = future.result()
-            else:
-                context_messages = loop.run_until_complete(
-                    self.rag_managers[group_id].group_chat_query(group_id, current_timestamp, context_size)
-                )
+            context_messages = run_sync(
+                rag_manager.group_chat_query(group_id, current_timestamp, context_size)
+            )
             
             # 如果找到上下文，直接返回
             if context_messages:
@@ -451,26 +416,12 @@ class GroupChatMemory:
             bool: 是否成功清空
         """
         try:
-            if group_id not in self.rag_managers:
-                logger.warning(f"群聊 {group_id} 未初始化 RAG 系统")
+            rag_manager = self._get_rag_manager(group_id)
+            if rag_manager is None:
                 return False
                 
             # 清空 RAG 存储
-            import asyncio
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
-            if loop.is_running():
-                future = asyncio.run_coroutine_threadsafe(
-                    self.rag_managers[group_id].clear_storage(),
-                    loop
-                )
-                future.result()
-            else:
-                loop.run_until_complete(self.rag_managers[group_id].clear_storage())
+            rag_manager.clear_storage()
             
             return True
             
@@ -7,13 +7,17 @@ import logging
 import json
 import time
 import asyncio
+import atexit
 import re
+import gzip
+import threading
 from typing import Dict, List, Any, Optional, Tuple, Union, Callable
 from datetime import datetime
 
 # 导入底层核心
-from src.handlers.memories.core.memory_utils import clean_memory_content, get_memory_path
+from src.handlers.memories.core.memory_utils import clean_memory_content, get_memory_path, parse_timestamp, RetrievedMemory
 from src.handlers.memories.core.rag import RagManager
+from src.handlers.memories.core.async_runner import run_sync, submit
 from src.api_client.wrapper import APIWrapper
 from src.utils.logger import get_logger
 
@@ -70,6 +74,20 @@ class MemoryProcessor:
         self.memory_path = get_memory_path(self.root_dir)
         logger.info(f"记忆文件路径: {self.memory_path}")
         
+        # 写后日志：变更先追加到日志，再由后台定时合并到记忆文件
+        self.journal_path = self.memory_path + ".journal"
+        self.flush_interval = 30  # 合并间隔（秒）
+        self.flush_threshold = 50  # 未合并的变更数达到该值时立即合并
+        self._journal_records = []  # 自上次合并以来的变更
+        self._journal_seq = 0  # 最后一条日志记录的序号，随记忆文件一起保存，回放时跳过已合并的记录
+        self._flush_timer = None
+        self._data_lock = threading.RLock()
+        atexit.register(self.flush)
+        
+        # 冷数据归档：超过保留期的对话移入压缩归档文件，记忆文件只保留热数据
+        self.archive_path = os.path.splitext(self.memory_path)[0] + ".archive.jsonl.gz"
+        self._last_archive = 0.0
+        
         # 初始化组件
         logger.info("初始化记忆处理器")
         self._load_memory()
@@ -91,6 +109,10 @@ class MemoryProcessor:
                     data = json.load(f)
                     self.memory_data = data.get("memories", {})
                     self.embedding_data = data.get("embeddings", {})
+                    self._journal_seq = int(data.get("journal_seq", 0) or 0)
+                    
+                # 回放上次退出前未合并的变更
+                replayed = self._replay_journal()
                     
                 # 确保每个用户的记忆是列表格式，并且记忆条目格式正确
                 memory_format_corrected = False
@@ -214,11 +236,25 @@ class MemoryProcessor:
                                         "human_message": "格式错误的记忆",
                                         "assistant_message": str(memory)
                                     }
+                                    
+                # 一次性迁移：为旧条目补充epoch秒时间字段
+                migrated = 0
+                for memories in self.memory_data.values():
+                    if isinstance(memories, list):
+                        for memory in memories:
+                            if isinstance(memory, dict) and "epoch" not in memory:
+                                memory["epoch"] = parse_timestamp(memory.get("timestamp"))
+                                migrated += 1
+                if migrated:
+                    logger.info(f"已为 {migrated} 条旧记忆补充epoch时间字段")
+                    memory_format_corrected = True
                 
                 # 如果有修正，保存更新后的数据
                 if memory_format_corrected:
                     logger.info("检测到并修复了记忆格式问题，将保存修复后的格式")
                     self.save()
+                elif replayed:
+                    self.save()
                         
                 self.memory_count = sum(len(memories) for memories in self.memory_data.values())
                 self.embedding_count = len(self.embedding_data)
@@ -227,6 +263,8 @@ class MemoryProcessor:
                 logger.info(f"记忆文件 {self.memory_path} 不存在，将创建新文件")
                 self.memory_data = {}
                 self.embedding_data = {}
+                self._replay_journal()
+                self.memory_count = sum(len(memories) for memories in self.memory_data.values())
                 self.save()
         except Exception as e:
             logger.error(f"加载记忆数据失败: {str(e)}")
@@ -264,27 +302,210 @@ class MemoryProcessor:
     
     def save(self):
         """
-        保存记忆数据
+        保存记忆数据（立即将全部数据合并到记忆文件，并清空写后日志）
         
         Returns:
             bool: 是否成功保存
         """
-        try:
-            # 确保目录存在
-            os.makedirs(os.path.dirname(self.memory_path), exist_ok=True)
-            
-            # 保存数据
-            with open(self.memory_path, "w", encoding="utf-8") as f:
-                json.dump({
-                    "memories": self.memory_data,
-                    "embeddings": self.embedding_data,
-                }, f, ensure_ascii=False, indent=2)
+        with self._data_lock:
+            try:
+                self._cancel_flush_timer()
                 
-            logger.info(f"记忆数据已保存到 {self.memory_path}")
-            return True
+                # 确保目录存在
+                os.makedirs(os.path.dirname(self.memory_path), exist_ok=True)
+                
+                # 先写临时文件再原子替换，避免写入中途崩溃损坏记忆文件
+                tmp_path = self.memory_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({
+                        "memories": self.memory_data,
+                        "embeddings": self.embedding_data,
+                        "journal_seq": self._journal_seq,
+                    }, f, ensure_ascii=False, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.memory_path)
+                
+                # 记忆文件已包含全部变更，清空写后日志
+                # （替换后、删除前崩溃时，日志中的记录序号不大于journal_seq，回放时会被跳过）
+                self._journal_records = []
+                if os.path.exists(self.journal_path):
+                    os.remove(self.journal_path)
+                    
+                logger.info(f"记忆数据已保存到 {self.memory_path}")
+                return True
+            except Exception as e:
+                logger.error(f"保存记忆数据失败: {str(e)}")
+                return False
+                
+    def flush(self):
+        """
+        如有未合并的变更，立即合并到记忆文件（退出时自动调用）
+        
+        Returns:
+            bool: 是否成功
+        """
+        with self._data_lock:
+            if not self._journal_records:
+                self._cancel_flush_timer()
+                return True
+            self._maybe_archive_memories()
+            return self.save()
+            
+    def _maybe_archive_memories(self):
+        """距上次归档超过RAG压缩配置的间隔时，归档冷数据（调用方持有锁，随后保存）"""
+        compaction_config = self.rag_manager.config.get("compaction", {}) if self.rag_manager else {}
+        if not compaction_config.get("enabled", True):
+            return
+        if time.time() - self._last_archive < compaction_config.get("interval_hours", 6) * 3600:
+            return
+        self._last_archive = time.time()
+        self.archive_memories(
+            compaction_config.get("cold_after_days", 7),
+            compaction_config.get("max_hot_documents", 500)
+        )
+        
+    def archive_memories(self, cold_after_days: float = 7, max_hot: int = 500) -> int:
+        """
+        将每个用户超过保留期或超出数量上限的旧对话移入压缩归档文件
+        
+        Args:
+            cold_after_days: 早于该天数的对话视为冷数据
+            max_hot: 每个用户在记忆文件中保留的对话上限
+            
+        Returns:
+            int: 归档的对话条数（需随后调用save持久化）
+        """
+        with self._data_lock:
+            try:
+                cold_before = time.time() - cold_after_days * 86400
+                archived = []
+                splits = {}
+                for user_id, memories in self.memory_data.items():
+                    if not isinstance(memories, list):
+                        continue
+                    # 记忆按时间追加，从头部找出冷数据；无法解析时间的条目保留
+                    split = 0
+                    while split < len(memories):
+                        memory = memories[split] if isinstance(memories[split], dict) else {}
+                        epoch = memory.get("epoch") or parse_timestamp(memory.get("timestamp"))
+                        if not epoch or epoch >= cold_before:
+                            break
+                        split += 1
+                    split = max(split, len(memories) - max_hot)
+                    if split > 0:
+                        archived.extend({"user_id": user_id, "entry": entry} for entry in memories[:split])
+                        splits[user_id] = split
+                        
+                if not archived:
+                    return 0
+                    
+                # 先写归档再从记忆中移除，写入失败时不丢数据
+                with gzip.open(self.archive_path, "at", encoding="utf-8") as f:
+                    for record in archived:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                for user_id, split in splits.items():
+                    self.memory_data[user_id] = self.memory_data[user_id][split:]
+                self.memory_count = sum(len(memories) if isinstance(memories, list) else 1 for memories in self.memory_data.values())
+                logger.info(f"已归档 {len(archived)} 条冷记忆到 {self.archive_path}")
+                return len(archived)
+            except Exception as e:
+                logger.error(f"归档冷记忆失败: {str(e)}")
+                return 0
+            
+    def _journal_append(self, record: Dict):
+        """
+        追加一条变更到写后日志，并安排后台合并
+        
+        Args:
+            record: 变更记录
+        """
+        with self._data_lock:
+            try:
+                self._journal_seq += 1
+                record = dict(record, seq=self._journal_seq)
+                os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+                with open(self.journal_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._journal_records.append(record)
+            except Exception as e:
+                # 日志写入失败时退回到直接保存，保证不丢数据
+                logger.error(f"写入记忆日志失败: {str(e)}，直接保存记忆文件")
+                self.save()
+                return
+                
+            if len(self._journal_records) >= self.flush_threshold:
+                self._schedule_flush(0)
+            elif self._flush_timer is None:
+                self._schedule_flush(self.flush_interval)
+                
+    def _schedule_flush(self, delay: float):
+        """
+        安排后台合并（调用方持有锁）
+        
+        Args:
+            delay: 延迟秒数
+        """
+        self._cancel_flush_timer()
+        self._flush_timer = threading.Timer(delay, self.flush)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+        
+    def _cancel_flush_timer(self):
+        """取消已安排的后台合并（调用方持有锁）"""
+        if self._flush_timer is not None:
+            if self._flush_timer is not threading.current_thread():
+                self._flush_timer.cancel()
+            self._flush_timer = None
+            
+    def _replay_journal(self) -> int:
+        """
+        回放写后日志中的变更到内存数据
+        
+        Returns:
+            int: 回放的变更数
+        """
+        if not os.path.exists(self.journal_path):
+            return 0
+            
+        replayed = 0
+        skipped = 0
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时可能残留半行，忽略
+                        logger.warning(f"跳过损坏的记忆日志记录: {line[:50]}")
+                        continue
+                        
+                    # 已合并到记忆文件的记录（保存后、删除日志前崩溃）不再重复回放
+                    seq = record.get("seq")
+                    if seq is not None and seq <= self._journal_seq:
+                        skipped += 1
+                        continue
+                        
+                    if record.get("op") == "append":
+                        user_memories = self.memory_data.setdefault(record["user_id"], [])
+                        if isinstance(user_memories, list):
+                            user_memories.append(record["entry"])
+                    if seq is not None:
+                        self._journal_seq = max(self._journal_seq, seq)
+                    replayed += 1
+                    
+            if replayed:
+                logger.info(f"从记忆日志回放了 {replayed} 条未合并的变更")
+            if skipped:
+                logger.info(f"跳过了 {skipped} 条已合并到记忆文件的日志记录")
         except Exception as e:
-            logger.error(f"保存记忆数据失败: {str(e)}")
-            return False
+            logger.error(f"回放记忆日志失败: {str(e)}")
+        return replayed
             
     def clear_memories(self):
         """
@@ -425,8 +646,10 @@ class MemoryProcessor:
                 return text.strip()
             
             # 创建记忆条目
+            now = datetime.now()
             memory_entry = {
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M"),
+                "timestamp": now.strftime("%Y-%m-%d %H:%M"),
+                "epoch": now.timestamp(),
                 "human_message": "None" if is_auto_message else clean_user_msg.replace('$', ' '),  # 替换$为空格
                 "assistant_message": clean_assistant_msg.replace('$', ' ')  # 替换$为空格
             }
@@ -447,8 +670,9 @@ class MemoryProcessor:
                         })
             
             # 添加到记忆数据 - 以数组形式存储
-            self.memory_data[clean_user_id].append(memory_entry)
-            self.memory_count = sum(len(memories) if isinstance(memories, list) else 1 for memories in self.memory_data.values())
+            with self._data_lock:
+                self.memory_data[clean_user_id].append(memory_entry)
+                self.memory_count = sum(len(memories) if isinstance(memories, list) else 1 for memories in self.memory_data.values())
             
             # 添加到RAG系统
             if self.rag_manager and not is_auto_message:  # 主动消息不添加到RAG
@@ -473,31 +697,25 @@ class MemoryProcessor:
                 
                 # 预处理过滤 - 检查内容质量
                 if self._is_valid_for_rag(clean_user_msg, clean_assistant_msg):
-                    # 使用线程池异步处理RAG添加操作
-                    import threading
-                    rag_thread = threading.Thread(
-                        target=self._add_to_rag_thread,
-                        args=(memory_doc,)
-                    )
-                    rag_thread.daemon = True
-                    rag_thread.start()
-                    logger.debug(f"启动线程添加记忆到RAG: {clean_user_msg[:30]}...，角色: {avatar_name}")
+                    # 提交到后台事件循环异步处理RAG添加操作
+                    self._add_to_rag_async(memory_doc)
+                    logger.debug(f"提交记忆到RAG: {clean_user_msg[:30]}...，角色: {avatar_name}")
             
             # 调用钩子
             for hook in self.memory_hooks:
                 hook(clean_user_id, memory_entry)
             
-            # 保存到文件
-            self.save()
+            # 追加到写后日志，由后台合并到文件
+            self._journal_append({"op": "append", "user_id": clean_user_id, "entry": memory_entry})
             logger.info(f"成功记住对话，当前记忆数量: {self.memory_count}")
             return True
         except Exception as e:
             logger.error(f"记住对话失败: {str(e)}")
             return False
     
-    def _add_to_rag_thread(self, memory_doc):
+    def _add_to_rag_async(self, memory_doc):
         """
-        在线程中添加记忆到RAG系统
+        在后台事件循环中添加记忆到RAG系统，不阻塞调用方
         
         Args:
             memory_doc: 记忆文档
@@ -506,18 +724,14 @@ class MemoryProcessor:
             if not self.rag_manager:
                 return
                 
-            # 创建事件循环
-            try:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
-                # 在事件循环中运行异步方法
-                loop.run_until_complete(self.rag_manager.add_document(memory_doc))
-                loop.close()
-                
-                logger.debug(f"成功添加记忆到RAG系统: {memory_doc['id']}")
-            except Exception as e:
-                logger.error(f"在线程中添加记忆到RAG系统失败: {str(e)}")
+            def _on_done(future):
+                try:
+                    if future.result():
+                        logger.debug(f"成功添加记忆到RAG系统: {memory_doc['id']}")
+                except Exception as e:
+                    logger.error(f"在后台添加记忆到RAG系统失败: {str(e)}")
+                    
+            submit(self.rag_manager.add_document(memory_doc)).add_done_callback(_on_done)
         except Exception as e:
             logger.error(f"添加记忆到RAG系统失败: {str(e)}")
     
@@ -564,57 +778,47 @@ class MemoryProcessor:
             
         return True
         
-    def retrieve(self, query: str, top_k: int = 5) -> str:
+    def retrieve_memories(self, query: str, top_k: int = 5) -> List[RetrievedMemory]:
         """
-        检索相关记忆（同步方法）
+        检索相关记忆，返回结构化结果（同步方法）
         
         Args:
             query: 查询文本
             top_k: 返回结果数量
             
         Returns:
-            str: 格式化的记忆文本
+            List[RetrievedMemory]: 记忆列表
         """
         try:
             if not self.rag_manager:
                 logger.warning("RAG系统未初始化，无法检索记忆")
-                return ""
+                return []
             
-            # 创建事件循环来运行异步查询
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                # 如果没有事件循环，创建一个新的
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
-            # 在事件循环中运行异步查询
-            if loop.is_running():
-                # 使用future来异步运行协程
-                future = asyncio.run_coroutine_threadsafe(self.rag_manager.query(query, top_k), loop)
-                results = future.result()
-            else:
-                # 直接运行协程
-                results = loop.run_until_complete(self.rag_manager.query(query, top_k))
+            # 在后台事件循环中运行异步查询
+            results = run_sync(self.rag_manager.query(query, top_k))
             
-            if not results or len(results) == 0:
+            if not results:
                 logger.info(f"未找到与查询 '{query}' 相关的记忆")
-                return ""
-                
-            # 格式化结果
-            formatted_results = []
-            for i, result in enumerate(results):
-                content = result.get('content', '')
-                metadata = result.get('metadata', {})
-                score = result.get('score', 0)
-                
-                timestamp = metadata.get('timestamp', '未知时间')
-                formatted_results.append(f"记忆 {i+1} [{timestamp}] (相关度: {score:.2f}):\n{content}\n")
+                return []
                 
-            return "\n".join(formatted_results)
+            return [RetrievedMemory.from_result(result) for result in results]
         except Exception as e:
             logger.error(f"检索记忆失败: {str(e)}")
-            return ""
+            return []
+            
+    def retrieve(self, query: str, top_k: int = 5) -> str:
+        """
+        检索相关记忆（同步方法）
+        
+        Args:
+            query: 查询文本
+            top_k: 返回结果数量
+            
+        Returns:
+            str: 格式化的记忆文本
+        """
+        memories = self.retrieve_memories(query, top_k)
+        return "\n".join(memory.render(i + 1) for i, memory in enumerate(memories))
     
     def is_important(self, text: str) -> bool:
         """
@@ -629,22 +833,8 @@ class MemoryProcessor:
         try:
             # 如果有RAG管理器，使用它的方法判断
             if self.rag_manager:
-                # 创建事件循环来运行异步查询
-                try:
-                    loop = asyncio.get_event_loop()
-                except RuntimeError:
-                    # 如果没有事件循环，创建一个新的
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    
-                # 在事件循环中运行异步查询
-                if loop.is_running():
-                    # 使用future来异步运行协程
-                    future = asyncio.run_coroutine_threadsafe(self.rag_manager.is_important(text), loop)
-                    return future.result()
-                else:
-                    # 直接运行协程
-                    return loop.run_until_complete(self.rag_manager.is_important(text))
+                # 在后台事件循环中运行异步判断
+                return run_sync(self.rag_manager.is_important(text))
                 
             # 否则使用简单的规则判断
             # 1. 长度判断
@@ -741,6 +931,8 @@ class MemoryProcessor:
                         stats["cache_hits"] = cache_stats.get("hits", 0)
                         stats["cache_misses"] = cache_stats.get("misses", 0)
                         stats["cache_size"] = cache_stats.get("size", 0)
+                        stats["cache_evictions"] = cache_stats.get("evictions", 0)
+                        stats["cache_disk_hits"] = cache_stats.get("disk_hits", 0)
                         stats["cache_hit_rate_percent"] = 0
                         
                         # 计算命中率
@@ -766,45 +958,17 @@ class MemoryProcessor:
             top_k: 返回的记忆条数
             
         Returns:
-            list: 相关记忆内容列表，每项包含message和reply
+            list: 相关记忆内容列表，每项包含message、reply、timestamp、epoch和score
         """
         try:
-            # 使用同步方式获取记忆文本
-            memories_text = self.retrieve(query, top_k)
+            memories = self.retrieve_memories(query, top_k)
             
-            # 检查结果
-            if not memories_text or memories_text == "没有找到相关记忆":
+            if not memories:
                 logger.info("没有找到相关记忆")
                 return []
             
-            # 解析记忆文本并转换格式
-            memories = []
-            lines = memories_text.split('\n\n')
-            
-            for line in lines:
-                if not line.strip():
-                    continue
-                    
-                if line.startswith('相关记忆:'):
-                    continue
-                    
-                parts = line.split('\n')
-                if len(parts) >= 2:
-                    user_part = parts[0].strip()
-                    ai_part = parts[1].strip()
-                    
-                    # 提取用户消息和AI回复
-                    user_msg = user_part[user_part.find(': ')+2:] if ': ' in user_part else user_part
-                    ai_msg = ai_part[ai_part.find(': ')+2:] if ': ' in ai_part else ai_part
-                    
-                    # 添加到记忆列表
-                    memories.append({
-                        'message': user_msg,
-                        'reply': ai_msg
-                    })
-            
-            logger.info(f"解析出 {len(memories)} 条相关记忆")
-            return memories
+            logger.info(f"检索到 {len(memories)} 条相关记忆")
+            return [memory.to_dict() for memory in memories]
         except Exception as e:
             logger.error(f"获取相关记忆失败: {str(e)}")
             return []
@@ -825,21 +989,24 @@ class MemoryProcessor:
             if user_id not in self.memory_data:
                 self.memory_data[user_id] = []
             
+            now = datetime.now()
             memory_entry = {
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M"),
+                "timestamp": now.strftime("%Y-%m-%d %H:%M"),
+                "epoch": now.timestamp(),
                 "human_message": human_message,
                 "assistant_message": assistant_message
             }
             
-            self.memory_data[user_id].append(memory_entry)
-            self.memory_count += 1
+            with self._data_lock:
+                self.memory_data[user_id].append(memory_entry)
+                self.memory_count += 1
             
             # 调用记忆钩子
             for hook in self.memory_hooks:
                 hook(user_id, memory_entry)
             
-            # 保存到文件
-            self.save()
+            # 追加到写后日志，由后台合并到文件
+            self._journal_append({"op": "append", "user_id": user_id, "entry": memory_entry})
             return True
         except Exception as e:
             logger.error(f"添加记忆失败: {str(e)}")
@@ -860,5 +1027,6 @@ class MemoryProcessor:
         重新加载记忆数据
         """
         logger.info("重新加载记忆数据")
+        self.flush()
         self.clear_memory()
         self._load_memory() 
\ No newline at end of file
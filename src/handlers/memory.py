@@ -14,9 +14,10 @@ from src.handlers.handler_init import (
     setup_memory, remember, retrieve, is_important, 
     get_memory_handler, get_memory_stats, 
     clear_memories, save_memories, init_rag_from_config,
-    setup_rag, get_rag
+    setup_rag, get_rag, get_relevant_memories
 )
 from src.api_client.wrapper import APIWrapper
+from src.handlers.memories.core.async_runner import run_sync
 
 # 设置日志
 logger = logging.getLogger('main')
@@ -91,20 +92,8 @@ def _run_async(coro):
     Returns:
         协程运行结果
     """
-    try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        # 如果没有事件循环，创建一个新的
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-    if loop.is_running():
-        # 使用future来异步运行协程
-        future = asyncio.run_coroutine_threadsafe(coro, loop)
-        return future.result()
-    else:
-        # 直接运行协程
-        return loop.run_until_complete(coro)
+    # 统一交给记忆系统的后台事件循环执行，避免每次调用创建事件循环
+    return run_sync(coro)
 
 def init_memory(root_dir, api_wrapper=None):
     """
@@ -331,8 +320,8 @@ class MemoryHandler:
             if not self._initialized:
                 self._initialize()
                 
-            # 运行异步函数
-            return _run_async(retrieve(query, top_k))
+            # retrieve已是同步接口，直接调用
+            return retrieve(query, top_k)
         except Exception as e:
             logger.error(f"检索记忆失败: {str(e)}")
             return ""
@@ -396,7 +385,7 @@ class MemoryHandler:
             top_k: 返回的记忆条数
             
         Returns:
-            list: 相关记忆内容列表，包含message和reply
+            list: 相关记忆内容列表，包含message、reply、timestamp、epoch和score
         """
         try:
             # 打印调试信息
@@ -407,59 +396,14 @@ class MemoryHandler:
                 logger.info("记忆处理器未初始化，尝试初始化")
                 self._initialize()
             
-            # 检查当前实例是否可用
-            if not hasattr(self, 'retrieve') or not callable(getattr(self, 'retrieve', None)):
-                logger.warning("当前记忆处理器没有可用的retrieve方法，尝试使用全局记忆系统")
-                
-                # 尝试使用全局记忆系统
-                global _memory_handler
-                if _memory_handler and hasattr(_memory_handler, 'retrieve') and callable(_memory_handler.retrieve):
-                    logger.info("使用全局记忆处理器的retrieve方法")
-                    memories_text = _memory_handler.retrieve(query, top_k)
-                else:
-                    logger.error("全局记忆处理器也没有可用的retrieve方法")
-                    return []
-            else:
-                # 使用当前实例的retrieve方法
-                logger.info("使用当前记忆处理器的retrieve方法")
-                memories_text = self.retrieve(query, top_k)
+            # 直接获取结构化的检索结果，无需再解析格式化文本
+            memories = get_relevant_memories(query, username, top_k)
             
-            # 检查结果
-            if not memories_text or memories_text == "没有找到相关记忆":
+            if not memories:
                 logger.info("没有找到相关记忆")
                 return []
             
-            # 记录原始返回内容
-            logger.info(f"原始记忆文本: {memories_text[:100]}...")
-                
-            # 尝试解析格式为列表字典
-            memories = []
-            
-            # 解析记忆文本并转换格式
-            lines = memories_text.split('\n\n')
-            for line in lines:
-                if not line.strip():
-                    continue
-                    
-                if line.startswith('相关记忆:'):
-                    continue
-                    
-                parts = line.split('\n')
-                if len(parts) >= 2:
-                    user_part = parts[0].strip()
-                    ai_part = parts[1].strip()
-                    
-                    # 提取用户消息和AI回复
-                    user_msg = user_part[user_part.find(': ')+2:] if ': ' in user_part else user_part
-                    ai_msg = ai_part[ai_part.find(': ')+2:] if ': ' in ai_part else ai_part
-                    
-                    # 添加到记忆列表
-                    memories.append({
-                        'message': user_msg,
-                        'reply': ai_msg
-                    })
-            
-            logger.info(f"解析出 {len(memories)} 条相关记忆")
+            logger.info(f"获取到 {len(memories)} 条相关记忆")
             return memories
         except Exception as e:
             logger.error(f"获取记忆失败: {str(e)}", exc_info=True)
@@ -9,6 +9,7 @@ from typing import Dict, List, Any, Optional, Tuple, Union, Callable
 
 # 导入中层记忆处理器
 from src.handlers.memories.memory_processor import MemoryProcessor
+from src.handlers.memories.core.async_runner import run_sync
 from src.api_client.wrapper import APIWrapper
 
 # 设置日志
@@ -28,20 +29,8 @@ def _run_async(coro):
     Returns:
         协程运行结果
     """
-    try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        # 如果没有事件循环，创建一个新的
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-    if loop.is_running():
-        # 使用future来异步运行协程
-        future = asyncio.run_coroutine_threadsafe(coro, loop)
-        return future.result()
-    else:
-        # 直接运行协程
-        return loop.run_until_complete(coro)
+    # 统一交给记忆系统的后台事件循环执行，避免每次调用创建事件循环
+    return run_sync(coro)
 
 def init_memory(root_dir, api_wrapper=None):
     """
@@ -174,6 +163,30 @@ def retrieve(query, top_k=5):
         logger.error(f"检索记忆失败: {str(e)}")
         return ""
 
+# 结构化检索API - 同步版本
+def retrieve_memories(query, top_k=5):
+    """
+    检索相关记忆，返回结构化结果 - 同步版本
+    
+    Args:
+        query: 查询文本
+        top_k: 返回结果数量
+        
+    Returns:
+        List[RetrievedMemory]: 记忆列表
+    """
+    global _memory_processor
+    
+    if not _memory_processor:
+        logger.error("记忆处理器未初始化")
+        return []
+        
+    try:
+        return _memory_processor.retrieve_memories(query, top_k)
+    except Exception as e:
+        logger.error(f"检索记忆失败: {str(e)}")
+        return []
+
 # 重要性判断API - 同步版本
 def is_important(text):
     """
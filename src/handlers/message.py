@@ -15,14 +15,18 @@ import time
 from wxauto import WeChat
 import random
 import os
-from src.services.ai.llm_service import LLMService
+from src.services.ai.llm_service import LLMService, StreamSegmenter
 from src.config import config
 import re
 import jieba
 import asyncio
 import math
 import difflib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from src.handlers.file import FileHandler
+from src.handlers.memories.core.async_runner import run_sync
+from src.handlers.memories.core.memory_utils import parse_timestamp, time_decay_weights
 from typing import List, Dict
 
 # 修改logger获取方式，确保与main模块一致
@@ -91,8 +95,11 @@ class MessageHandler:
         self.group_at_cache = {}  # 群聊@消息缓存，格式: {group_id: [{'sender_name': name, 'content': content, 'timestamp': time}, ...]}
         self.group_at_timer = {}  # 群聊@消息定时器
         
-        # 添加消息发送锁，确保消息发送的顺序性
-        self.send_message_lock = threading.Lock()
+        # 添加消息发送锁，确保消息发送的顺序性（可重入）
+        self.send_message_lock = threading.RLock()
+        # 每个聊天的发送顺序锁：流式回复生成期间只占用本聊天的锁，不阻塞其他聊天的发送
+        self.chat_send_locks = {}
+        self.chat_send_locks_lock = threading.Lock()
         
         # 添加全局消息处理队列和队列锁
         self.global_message_queue = []  # 全局消息队列，包含所有群组的待处理消息
@@ -158,6 +165,16 @@ class MessageHandler:
         # 添加衰减相关参数
         self.decay_method = 'exponential'  # 或 'linear'
         self.decay_rate = 0.1  # 可以根据需要调整衰减率
+        
+        # 记忆预取：在消息合并等待期间提前检索上下文
+        self.prefetch_enabled = True
+        self.prefetch_similarity = 0.8  # 合并后的文本与预取查询的相似度不低于该值时复用预取结果
+        self.context_prefetch = {}  # 用户 -> (预取时的消息内容, Future)
+        self.prefetch_lock = threading.Lock()
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="context-prefetch")
+        
+        # 流式回复：私聊回复边生成边发送，每得到一个完整的句子或$分段就立即发送
+        self.stream_reply_enabled = True
 
     def _get_config_value(self, key, default_value):
         """从配置文件获取特定值，如果不存在则返回默认值"""
@@ -642,6 +659,12 @@ class MessageHandler:
     def _handle_uncached_message(self, content: str, chat_id: str, sender_name: str, username: str, is_group: bool, is_image_recognition: bool):
         """处理未缓存的消息，直接调用API获取回复"""
         try:
+            # 私聊优先使用流式回复，失败时回退到一次性获取完整回复
+            if self.stream_reply_enabled and not is_group and not self.is_debug:
+                response = self._stream_and_send_response(content, chat_id, username)
+                if response is not None:
+                    return response
+                    
             # 获取API回复
             response = self.get_api_response(content, username)
             
@@ -656,6 +679,58 @@ class MessageHandler:
             logger.error(f"处理未缓存消息失败: {str(e)}", exc_info=True)
             return None
 
+    def _stream_and_send_response(self, content: str, chat_id: str, username: str):
+        """
+        流式获取API回复，分段器每释放一个完整的句子或$分段就立即发送
+        
+        Args:
+            content: 发送给模型的消息
+            chat_id: 接收回复的聊天ID
+            username: 用户ID
+            
+        Returns:
+            str: 完整的回复内容；发送任何分段之前失败时返回None，由调用方回退到非流式请求
+        """
+        segmenter = StreamSegmenter()
+        chunks = []
+        chat_lock = None
+        
+        def send_segment(segment):
+            nonlocal chat_lock
+            segment = re.sub(r'\s*\[memory_number:.*?\]$', '', segment)
+            if not segment:
+                return
+            # 首个分段发送前获取本聊天的发送锁，保证整条回复的各分段在该聊天中连续发送；
+            # 全局发送锁只在每次实际发送时由_send_split_messages持有
+            if chat_lock is None:
+                chat_lock = self._get_chat_send_lock(chat_id)
+                chat_lock.acquire()
+            self._send_split_messages(self._split_message_for_sending(segment), chat_id)
+            
+        try:
+            try:
+                for chunk in self.deepseek.stream_response(content, username):
+                    chunks.append(chunk)
+                    for segment in segmenter.feed(chunk):
+                        send_segment(segment)
+            except Exception as e:
+                if chat_lock is None:
+                    logger.warning(f"流式回复失败，回退到普通请求: {str(e)}")
+                    return None
+                logger.error(f"流式回复中断，发送已收到的剩余内容: {str(e)}")
+            # 正常结束或中途中断时都发送分段器中剩余的文本，返回的回复与已发送的内容一致
+            send_segment(segmenter.flush())
+        finally:
+            if chat_lock is not None:
+                chat_lock.release()
+                
+        if not chunks:
+            return None
+            
+        response = re.sub(r'\s*\[memory_number:.*?\]$', '', "".join(chunks).strip())
+        logger.info(f"流式API响应: {len(response)}字符")
+        return response
+
     def _cache_group_at_message(self, content: str, group_id: str, sender_name: str, username: str, timestamp: str):
         """缓存群聊@消息，并将其添加到全局消息处理队列"""
         current_time = time.time()
@@ -855,14 +930,7 @@ class MessageHandler:
             if self.use_semantic_search and self.rag_manager:
                 # 调用异步方法获取语义相似消息
                 try:
-                    try:
-                        loop = asyncio.get_event_loop()
-                    except RuntimeError:
-                        # 如果当前线程没有事件循环，创建一个新的
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                        
-                    semantic_messages = loop.run_until_complete(
+                    semantic_messages = run_sync(
                         self._get_semantic_similar_messages(content, group_id=group_id, top_k=self.group_context_turns * 2)
                     )
                     # 过滤掉当前消息
@@ -1023,6 +1091,9 @@ class MessageHandler:
             'timestamp': current_time
         })
         
+        # 利用等待窗口预取记忆上下文
+        self._prefetch_context(username)
+        
         # 设置新的定时器
         wait_time = self._calculate_wait_time(username, len(self.message_cache[username]))
         timer = threading.Timer(wait_time, self._process_cached_messages, args=[username])
@@ -1060,9 +1131,6 @@ class MessageHandler:
             messages = self.message_cache[username]
             messages.sort(key=lambda x: x.get('timestamp', 0))
             
-            # 获取最近的对话记录作为上下文
-            context = self._get_conversation_context(username)
-            
             # 合并消息内容
             raw_contents = []
             first_timestamp = None
@@ -1083,6 +1151,9 @@ class MessageHandler:
             # 使用 \ 作为句子分隔符合并消息
             content_text = ' $ '.join(raw_contents)
             
+            # 获取最近的对话记录作为上下文（优先复用等待期间的预取结果）
+            context = self._take_prefetched_context(username, content_text)
+            
             # 格式化最终消息
             first_timestamp = first_timestamp or datetime.now().strftime('%Y-%m-%d %H:%M')
             merged_content = f"[{first_timestamp}]ta 私聊对你说：{content_text}"
@@ -1113,12 +1184,87 @@ class MessageHandler:
             logger.error(f"处理缓存消息失败: {str(e)}", exc_info=True)
             return None
             
-    def _get_conversation_context(self, username: str) -> str:
+    def _build_context_query(self, username: str, content_text: str = "") -> str:
+        """构建检索上下文的查询文本，包含用户ID和用户本次发送的内容"""
+        return f"与用户 {username} 相关的最近重要对话 {content_text}".strip()
+        
+    def _cached_content_text(self, username: str) -> str:
+        """合并当前缓存中的消息内容（与_process_cached_messages的合并方式一致）"""
+        messages = sorted(self.message_cache.get(username, []), key=lambda x: x.get('timestamp', 0))
+        raw_contents = [self._clean_message_content(msg['content']) for msg in messages]
+        return ' $ '.join(content for content in raw_contents if content)
+        
+    def _is_similar_query(self, prefetched: str, content_text: str) -> bool:
+        """
+        判断预取时的消息内容与合并后的内容是否足够相似，可以复用预取结果
+        
+        只比较用户发送的内容，不含查询文本中固定的前缀，避免前缀抬高相似度
+        """
+        if prefetched == content_text:
+            return True
+        return difflib.SequenceMatcher(None, prefetched, content_text).ratio() >= self.prefetch_similarity
+        
+    def _prefetch_context(self, username: str):
+        """
+        在消息合并等待期间异步预取对话上下文
+        
+        首条缓存消息触发预取；后续消息使合并文本与预取查询不再相似时，取消旧的预取并重新开始
+        """
+        if not self.prefetch_enabled:
+            return
+        try:
+            content_text = self._cached_content_text(username)
+            query = self._build_context_query(username, content_text)
+            with self.prefetch_lock:
+                entry = self.context_prefetch.get(username)
+                if entry is not None:
+                    if self._is_similar_query(entry[0], content_text):
+                        return
+                    entry[1].cancel()
+                future = self.prefetch_executor.submit(self._get_conversation_context, username, query)
+                self.context_prefetch[username] = (content_text, future)
+            logger.debug(f"开始预取用户 {username} 的记忆上下文")
+        except Exception as e:
+            logger.error(f"预取记忆上下文失败: {str(e)}")
+            
+    def _take_prefetched_context(self, username: str, content_text: str) -> str:
+        """
+        取出预取的上下文：合并后的文本与预取时的内容足够相似且预取已经开始时复用，
+        否则取消预取并直接检索（尚未开始的预取排队等待只会更慢）
+        
+        Args:
+            username: 用户ID
+            content_text: 合并后的消息内容
+            
+        Returns:
+            str: 对话上下文
+        """
+        query = self._build_context_query(username, content_text)
+        with self.prefetch_lock:
+            entry = self.context_prefetch.pop(username, None)
+            
+        if entry is not None:
+            prefetched_content, future = entry
+            if future.cancel():
+                # 预取仍在排队，直接用最终的内容检索
+                logger.debug(f"预取尚未开始，直接检索记忆上下文，用户: {username}")
+            elif self._is_similar_query(prefetched_content, content_text):
+                try:
+                    # 预取仍在进行时等待其完成，通常已在等待窗口内结束
+                    context = future.result(timeout=30)
+                    logger.info(f"复用预取的记忆上下文，用户: {username}")
+                    return context
+                except Exception as e:
+                    logger.warning(f"预取的记忆上下文不可用: {str(e)}，重新检索")
+                
+        return self._get_conversation_context(username, query)
+            
+    def _get_conversation_context(self, username: str, query: str = None) -> str:
         """获取对话上下文"""
         try:
-            # 构建更精确的查询，包含用户ID和当前时间信息，以获取更相关的记忆
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            query = f"与用户 {username} 相关的最近重要对话 {current_time}"
+            # 构建更精确的查询，包含用户ID和用户本次发送的内容，以获取更相关的记忆
+            if query is None:
+                query = self._build_context_query(username)
             
             # 结合语义检索和传统检索
             memories = []
@@ -1127,15 +1273,8 @@ class MessageHandler:
             # 1. 使用基于向量的语义检索
             if self.use_semantic_search and self.rag_manager:
                 try:
-                    # 异步调用需要在协程中或通过事件循环执行
-                    try:
-                        loop = asyncio.get_event_loop()
-                    except RuntimeError:
-                        # 如果当前线程没有事件循环，创建一个新的
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                    
-                    semantic_results = loop.run_until_complete(
+                    # 异步调用交给记忆系统的后台事件循环执行
+                    semantic_results = run_sync(
                         self._get_semantic_similar_messages(query, user_id=username, top_k=self.private_context_turns * 2)
                     )
                     
@@ -1180,23 +1319,24 @@ class MessageHandler:
                     memories.append(memory)
             
             if memories:
-                # 为记忆计算权重
-                weighted_memories = []
+                # 收集每条记忆的时间，没有时间戳时尝试从消息内容中提取
+                stamps = []
                 for memory in memories:
-                    # 尝试从记忆中提取时间戳
                     timestamp = memory.get('timestamp', '')
-                    if not timestamp:
-                        # 尝试从消息内容中提取时间戳
+                    if not timestamp and not memory.get('epoch'):
                         timestamp_match = re.search(r'\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}(?::\d{2})?', memory.get('message', ''))
                         if timestamp_match:
                             timestamp = timestamp_match.group()
+                    stamps.append({"epoch": memory.get('epoch'), "timestamp": timestamp})
                     
+                # 一次性计算全部记忆的时间衰减权重，没有时间的记忆使用中等权重
+                time_weights = self._time_decay_weights(stamps, missing_weight=0.5)
+                
+                # 为记忆计算权重
+                weighted_memories = []
+                for i, memory in enumerate(memories):
                     # 计算时间权重
-                    if not timestamp:
-                        time_weight = 0.5  # 默认中等权重
-                    else:
-                        # 计算时间衰减权重
-                        time_weight = self._calculate_time_decay_weight(timestamp)
+                    time_weight = float(time_weights[i])
                     
                     # 计算质量权重
                     quality_score = self._memory_quality_score(memory, username)
@@ -1678,6 +1818,23 @@ class MessageHandler:
             'memory_content': processed['memory_content']
         }
 
+    def _get_chat_send_lock(self, chat_id: str) -> threading.RLock:
+        """
+        获取（必要时创建）单个聊天的发送顺序锁
+        
+        Args:
+            chat_id: 聊天ID
+            
+        Returns:
+            threading.RLock: 可重入锁
+        """
+        with self.chat_send_locks_lock:
+            lock = self.chat_send_locks.get(chat_id)
+            if lock is None:
+                lock = threading.RLock()
+                self.chat_send_locks[chat_id] = lock
+            return lock
+            
     def _send_split_messages(self, messages, chat_id):
         """发送分割后的消息，不进行重试和失败检查"""
         if not messages or not isinstance(messages, dict):
@@ -1685,10 +1842,10 @@ class MessageHandler:
         
         # 添加发送锁，确保一个消息的所有部分发送完毕后才能发送下一个消息
         if not hasattr(self, 'send_message_lock'):
-            self.send_message_lock = threading.Lock()
+            self.send_message_lock = threading.RLock()
         
-        # 使用锁确保消息发送的原子性
-        with self.send_message_lock:
+        # 先取本聊天的顺序锁再取全局发送锁，确保消息发送的原子性（加锁顺序固定，避免死锁）
+        with self._get_chat_send_lock(chat_id), self.send_message_lock:
             # 记录已发送的消息，防止重复发送
             sent_messages = set()
             
@@ -2007,9 +2164,9 @@ class MessageHandler:
         计算基于时间衰减的权重
         
         Args:
-            timestamp: 消息时间戳字符串
+            timestamp: 消息时间戳字符串或epoch秒
             current_time: 当前时间，如果为None则使用当前系统时间
-            time_format: 时间格式
+            time_format: 时间格式（保留以兼容旧调用，时间戳格式自动识别）
             
         Returns:
             float: 时间衰减权重，范围[0, 1]
@@ -2017,41 +2174,28 @@ class MessageHandler:
         try:
             if not timestamp:
                 return 0.0
-                
-            # 如果未提供当前时间，使用当前系统时间
-            if current_time is None:
-                current_time = datetime.now()
-            elif isinstance(current_time, str):
-                current_time = datetime.strptime(current_time, time_format)
-                
-            # 将时间戳转换为datetime对象
-            msg_time = datetime.strptime(timestamp, time_format)
-            
-            # 计算时间差（秒）
-            time_diff_seconds = (current_time - msg_time).total_seconds()
-            
-            # 确保时间差非负
-            time_diff_seconds = max(0, time_diff_seconds)
-            
-            # 将时间差转换为小时
-            time_diff_hours = time_diff_seconds / 3600.0
-            
-            # 根据配置的衰减方法计算权重
-            if self.decay_method == 'exponential':
-                # 指数衰减: weight = exp(-λ * t)
-                weight = math.exp(-self.decay_rate * time_diff_hours)
-            else:
-                # 线性衰减: weight = max(0, 1 - λ * t)
-                weight = max(0.0, 1.0 - self.decay_rate * time_diff_hours)
-                
-            # 确保权重在[0, 1]范围内
-            weight = max(0.0, min(1.0, weight))
-            
-            return weight
-            
+            return float(self._time_decay_weights([{"timestamp": timestamp}], current_time)[0])
         except Exception as e:
             logger.error(f"计算时间衰减权重失败: {str(e)}")
             return 0.5  # 出错时返回中等权重作为默认值
+            
+    def _time_decay_weights(self, messages, current_time=None, missing_weight=0.0):
+        """
+        批量计算消息的时间衰减权重
+        
+        Args:
+            messages: 消息列表，优先使用epoch字段，否则解析timestamp字段
+            current_time: 当前时间，如果为None则使用当前系统时间
+            missing_weight: 没有时间信息的消息的权重
+            
+        Returns:
+            np.ndarray: 时间衰减权重，范围[0, 1]，时间无法解析时为0.5
+        """
+        epochs = [msg.get("epoch") or parse_timestamp(msg.get("timestamp", "")) for msg in messages]
+        weights = time_decay_weights(epochs, current_time, decay_rate=self.decay_rate,
+                                     method=self.decay_method, default=0.5)
+        missing = np.array([not (msg.get("epoch") or msg.get("timestamp")) for msg in messages], dtype=bool)
+        return np.where(missing, missing_weight, weights)
 
     def _apply_weights_and_filter_context(self, context_messages, current_time=None, max_turns=None, current_user=None):
         """
@@ -2084,11 +2228,14 @@ class MessageHandler:
         if current_time is None:
             current_time = datetime.now()
             
+        # 一次性计算全部消息的时间衰减权重
+        time_weights = self._time_decay_weights(context_messages, current_time)
+        
         # 为每条消息计算权重
         weighted_msgs = []
-        for msg in context_messages:
+        for i, msg in enumerate(context_messages):
             # 1. 基础权重 - 时间衰减
-            time_weight = self._calculate_time_decay_weight(msg.get("timestamp", ""), current_time)
+            time_weight = float(time_weights[i])
             
             # 2. 用户相关性权重
             user_weight = 1.0  # 默认权重
@@ -2390,7 +2537,7 @@ class MessageHandler:
             # 实际应用中可能需要更复杂的机制确保线程安全
             if hasattr(self, 'send_message_lock_time') and current_time - self.send_message_lock_time > 300:
                 logger.warning("检测到消息发送锁可能已死锁，强制重置")
-                self.send_message_lock = threading.Lock()
+                self.send_message_lock = threading.RLock()
             
             # 记录当前时间作为下次检查的参考
             self.send_message_lock_time = current_time
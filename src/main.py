@@ -1371,12 +1371,14 @@ def main(debug_mode=True):
         
         deepseek = LLMService(
             sys_prompt=f.read(),
+            sys_prompt_path=prompt_path,
             api_key=config.llm.api_key,
             base_url=config.llm.base_url,
             model=config.llm.model,
             max_token=int(config.llm.max_tokens),  # 确保转换为整数
             temperature=float(config.llm.temperature),  # 同时也确保temperature是浮点数
             max_groups=int(config.behavior.context.max_groups),  # 确保max_groups也是整数
+            n_ctx=int(config.llm.context_length),  # 模型上下文长度，决定提示词的token预算
             )
     
     # 在初始化memory_handler前添加此日志
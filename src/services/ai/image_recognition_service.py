@@ -11,6 +11,8 @@ import base64
 import logging
 import requests
 from typing import Optional, List, Dict, Callable
+from src.api_client.client_pool import client_registry
+from src.api_client.retry_policy import RETRYABLE_STATUS_CODES, CircuitOpenError, retry_policy
 import os
 import threading
 import queue
@@ -35,6 +37,9 @@ class ImageRecognitionService:
             'Content-Type': 'application/json'
         }
         self.model = model  # "moonshot-v1-8k-vision-preview"
+        # 复用进程内共享的长连接会话，避免每次识别都重新建立TCP/TLS连接
+        self.session = client_registry.get_session(base_url, api_key, purpose="image_recognition")
+        self.retry_endpoint = f"image_recognition@{base_url}"
         
         # 替换锁机制为任务队列
         self.task_queue = queue.Queue()
@@ -76,6 +81,31 @@ class ImageRecognitionService:
                     pass
                 time.sleep(0.1)  # 防止CPU占用过高
 
+    def _post_completion(self, data: dict, timeout: Optional[float] = None) -> requests.Response:
+        """
+        按统一重试策略发送聊天补全请求
+
+        Args:
+            data: 请求数据
+            timeout: 单次请求超时（秒）
+
+        Returns:
+            requests.Response: 最后一次请求的响应
+        """
+        def post():
+            response = self.session.post(
+                f"{self.base_url}/chat/completions",
+                headers=self.headers,
+                json=data,
+                timeout=timeout
+            )
+            # 限流和服务端错误交给重试策略处理（会读取Retry-After）
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                response.raise_for_status()
+            return response
+
+        return retry_policy.call(post, endpoint=self.retry_endpoint)
+
     def _recognize_image_impl(self, image_path: str, is_emoji: bool = False) -> str:
         """实际执行图片识别的内部方法"""
         try:
@@ -126,12 +156,7 @@ class ImageRecognitionService:
 
             # 发送请求
             try:
-                response = requests.post(
-                    f"{self.base_url}/chat/completions",
-                    headers=self.headers,
-                    json=data,
-                    timeout=30  # 添加超时设置
-                )
+                response = self._post_completion(data, timeout=30)  # 添加超时设置
                 
                 # 检查响应状态
                 if response.status_code != 200:
@@ -157,6 +182,9 @@ class ImageRecognitionService:
                 logger.info(f"Moonshot AI图片识别结果: {recognized_text}")
                 return recognized_text
 
+            except CircuitOpenError as e:
+                logger.error(f"图片识别服务熔断中: {str(e)}")
+                return "抱歉，图片识别服务暂时不可用"
             except requests.exceptions.Timeout:
                 logger.error("API请求超时")
                 return "抱歉，图片识别服务响应超时"
@@ -196,11 +224,7 @@ class ImageRecognitionService:
                 "temperature": kwargs.get('temperature', self.temperature)
             }
 
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=self.headers,
-                json=data
-            )
+            response = self._post_completion(data)
             response.raise_for_status()
             
             result = response.json()
@@ -11,17 +11,100 @@ import logging
 import re
 import os
 import random
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 from openai import APIError, APITimeoutError
 from src.services.ai.llms.openai_llm import OpenAILLM
+from src.services.ai.llms.prompt_composer import PromptComposer
 
 # 修改logger获取方式，确保与main模块一致
 logger = logging.getLogger('main')
 
+class StreamSegmenter:
+    """
+    流式回复分段器
+    持续接收模型输出的文本片段，每当出现以单个$分隔的完整段落就立即释放；
+    连续多个$视为普通字符。回复中出现$之前，按句末标点释放完整的句子；
+    英文标点只有后面跟空白时才视为句末，避免拆开小数和网址
+    """
+    ASCII_ENDINGS = '.!?'
+    SENTENCE_ENDINGS = '。！？' + ASCII_ENDINGS
+    
+    def __init__(self):
+        self.buffer = ""
+        self.dollar_mode = False
+        
+    def feed(self, text: str) -> List[str]:
+        """
+        追加文本片段
+        
+        Args:
+            text: 新到达的文本
+            
+        Returns:
+            List[str]: 已经完整、可以立即发送的分段
+        """
+        if not text:
+            return []
+        self.buffer += text
+        buffer = self.buffer
+        length = len(buffer)
+        segments = []
+        start = 0
+        i = 0
+        
+        while i < length:
+            char = buffer[i]
+            if char == '$':
+                end = i
+                while end < length and buffer[end] == '$':
+                    end += 1
+                # $位于末尾时还无法判断是分隔符还是连续的$，等待后续文本
+                if end == length:
+                    break
+                if end - i == 1:
+                    self.dollar_mode = True
+                    segments.append(buffer[start:i])
+                    start = end
+                i = end
+                continue
+                
+            if not self.dollar_mode and char in self.SENTENCE_ENDINGS:
+                end = i
+                while end < length and buffer[end] in self.SENTENCE_ENDINGS:
+                    end += 1
+                # 连续的句末标点（如省略号、？！）保持在同一句中
+                if end == length:
+                    break
+                if all(c in self.ASCII_ENDINGS for c in buffer[i:end]) and not buffer[end].isspace():
+                    i = end
+                    continue
+                segments.append(buffer[start:end])
+                start = end
+                i = end
+                continue
+                
+            i += 1
+            
+        self.buffer = buffer[start:]
+        return [segment.strip() for segment in segments if segment.strip()]
+        
+    def flush(self) -> str:
+        """
+        回复结束时取出剩余的文本
+        
+        Returns:
+            str: 最后一个分段，可能为空
+        """
+        remaining = self.buffer
+        self.buffer = ""
+        if remaining.endswith('$') and not remaining.endswith('$$'):
+            remaining = remaining[:-1]
+        return remaining.strip()
+
 class LLMService:
     def __init__(self, api_key: str, base_url: str, model: str,
                  max_token: int, temperature: float, max_groups: int, 
-                 sys_prompt: str = None):
+                 sys_prompt: str = None, sys_prompt_path: str = None, n_ctx: int = 8192):
         """
         强化版AI服务初始化
 
@@ -31,6 +114,9 @@ class LLMService:
         :param max_token: 最大token限制
         :param temperature: 创造性参数(0~2)
         :param max_groups: 最大对话轮次记忆
+        :param sys_prompt: 系统提示词
+        :param sys_prompt_path: 系统提示词文件（avatar.md），设置后按文件修改时间自动刷新
+        :param n_ctx: 模型的上下文长度，决定提示词的token预算
         """
         # 记录配置信息
         logger.info(f"LLMService初始化 - 模型: {model}, URL: {base_url}")
@@ -44,11 +130,24 @@ class LLMService:
             temperature=temperature,
             max_tokens=max_token,
             max_context_messages=max_groups,
-            n_ctx=4096,  # 默认上下文长度
+            n_ctx=n_ctx,  # 上下文长度，决定提示词的token预算
             system_prompt=sys_prompt,
             singleton=True  # 使用单例模式
         )
         
+        # 提示词组合器：静态前缀为人设，内容不变时保持字节稳定，便于服务端复用前缀缓存
+        self.prompt_composer = PromptComposer()
+        if sys_prompt_path:
+            self.prompt_composer.add_file(sys_prompt_path)
+        else:
+            self.prompt_composer.add_text(sys_prompt)
+        self.llm.prompt_composer = self.prompt_composer
+        
+        # 基础Prompt（data/base/base.md），从当前文件位置(llm_service.py)向上导航到项目根目录
+        current_dir = os.path.dirname(os.path.abspath(__file__))  # src/services/ai
+        project_root = os.path.dirname(os.path.dirname(os.path.dirname(current_dir)))  # 项目根目录
+        self.base_prompt_path = os.path.join(project_root, "data", "base", "base.md")
+        
         self.config = {
             "model": model,
             "max_token": max_token,
@@ -84,32 +183,13 @@ class LLMService:
                 return "嗯...我好像收到了空白消息呢（歪头）"
 
             # —— 阶段2：构建请求参数 ——
-            # 拼接基础Prompt
-            try:
-                # 从当前文件位置(llm_service.py)向上导航到项目根目录
-                current_dir = os.path.dirname(os.path.abspath(__file__))  # src/services/ai
-                project_root = os.path.dirname(os.path.dirname(os.path.dirname(current_dir)))  # 项目根目录
-                base_prompt_path = os.path.join(project_root, "data", "base", "base.md")
-                
-                with open(base_prompt_path, "r", encoding="utf-8") as f:
-                    base_content = f.read()
-            except Exception as e:
-                logger.error(f"基础Prompt文件读取失败: {str(e)}")
-                base_content = ""
-            
-            # 合并系统提示词
-            full_system_prompt = f"{system_prompt}\n{base_content}"
-            
-            # 设置系统提示词
-            if self.llm.system_prompt != full_system_prompt:
-                # 重置上下文并设置新的系统提示词
-                self.llm.context = []
-                if full_system_prompt:
-                    self.llm.context.append({"role": "system", "content": full_system_prompt})
-                    self.llm.system_prompt = full_system_prompt
+            # 基础Prompt是静态内容，按文件修改时间缓存，紧跟人设之后发送以便复用前缀缓存；
+            # 本次的系统提示词每次可能不同，放在对话历史之后
+            base_content = self.prompt_composer.read_file(self.base_prompt_path)
             
             # 使用OpenAILLM处理请求
-            response = self.llm.handel_prompt(message)
+            response = self.llm.handel_prompt(message, user_id, volatile_prompt=system_prompt,
+                                              static_prompt=base_content or None)
             
             # 清理响应内容
             clean_content = self._sanitize_response(response)
@@ -136,6 +216,25 @@ class LLMService:
                 "思考被打断了，请再说一次好吗？"
             ])
 
+    def stream_response(self, message: str, user_id: str = None) -> Iterator[str]:
+        """
+        流式请求处理，按生成顺序逐块返回经过安全处理的回复文本
+        
+        Args:
+            message: 用户消息
+            user_id: 用户ID，用于上下文识别
+            
+        Yields:
+            str: 回复片段
+            
+        Raises:
+            Exception: 流式请求失败时抛出，由调用方决定是否回退到非流式请求
+        """
+        for chunk in self.llm.handel_prompt_stream(message, user_id):
+            clean_chunk = self._sanitize_response(chunk)
+            if clean_chunk:
+                yield clean_chunk
+
     def clear_history(self, user_id: str) -> bool:
         """
         清空指定用户的对话历史
@@ -194,23 +293,8 @@ class LLMService:
         :return: AI回复内容
         """
         try:
-            # 构建完整的系统提示词
-            full_system_prompt = ""
-            if self.llm.system_prompt:
-                full_system_prompt = self.llm.system_prompt
-            if system_prompt:
-                full_system_prompt = full_system_prompt + "\n" + system_prompt if full_system_prompt else system_prompt
-            
-            # 设置系统提示词
-            if self.llm.system_prompt != full_system_prompt:
-                # 重置上下文并设置新的系统提示词
-                self.llm.context = []
-                if full_system_prompt:
-                    self.llm.context.append({"role": "system", "content": full_system_prompt})
-                    self.llm.system_prompt = full_system_prompt
-            
-            # 使用OpenAILLM处理请求
-            response = self.llm.handel_prompt(message)
+            # 静态前缀（默认系统提示词）保持不变，附加的系统提示词放在对话历史之后
+            response = self.llm.handel_prompt(message, user_id, volatile_prompt=system_prompt)
             
             # 清理响应内容
             clean_content = self._sanitize_response(response)
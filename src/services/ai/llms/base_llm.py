@@ -1,8 +1,10 @@
 import logging
 from abc import ABC, abstractmethod
-from typing import Callable, List, Dict, Optional, Tuple
+from typing import Callable, Iterator, List, Dict, Optional, Tuple
 from logging import Logger
 from .llm import online_llm
+from .prompt_composer import PrefixCacheStats, PromptComposer
+from .token_budget import PromptBudgeter, TokenCounter
 from datetime import datetime
 import re
 
@@ -71,6 +73,21 @@ class BaseLLM(online_llm):
         
         # 2025-03-17 修复适配获取最近时间
         self.user_recent_chat_time = {}
+        
+        # 提示词组合：设置后由其提供静态前缀（按文件修改时间刷新），否则使用system_prompt
+        self.prompt_composer: Optional[PromptComposer] = None
+        if not hasattr(self, 'prefix_cache_stats'):
+            self.prefix_cache_stats = PrefixCacheStats()
+        
+        # 提示词token预算：按n_ctx分配系统提示词、记忆、滚动上下文和当前输入
+        if not hasattr(self, 'token_counter'):
+            self.token_counter = TokenCounter()
+        self.prompt_budgeter = PromptBudgeter(
+            self.token_counter,
+            max_prompt_tokens=self._prompt_token_budget(),
+            pair_scorer=self._score_conversation_pair,
+            summarizer=self._generate_context_summary
+        )
     
     def context_handler(self, func: Callable[[str, str, str], None]):
         """
@@ -159,13 +176,16 @@ class BaseLLM(online_llm):
                         except Exception as e:
                             self.logger.error(f"上下文处理函数执行失败: {str(e)}")
     
-    def handel_prompt(self, prompt: str, user_id: str = None) -> str:
+    def handel_prompt(self, prompt: str, user_id: str = None, volatile_prompt: str = None,
+                      static_prompt: str = None) -> str:
         """
         处理用户输入并返回响应
         
         Args:
             prompt: 用户输入
             user_id: 用户ID
+            volatile_prompt: 本次调用附加的系统内容，放在对话历史之后，不影响静态前缀
+            static_prompt: 本次调用附加的静态系统内容，紧跟在静态前缀之后，可参与前缀缓存
             
         Returns:
             str: 助手回复
@@ -175,97 +195,157 @@ class BaseLLM(online_llm):
             
             # 使用用户ID构建上下文键
             context_key = user_id if user_id else "default"
+            current_context = self._prepare_user_context(context_key, prompt, volatile_prompt, static_prompt)
             
-            # 如果没有为此用户初始化上下文，则创建
-            if not hasattr(self, 'user_contexts'):
-                self.user_contexts = {}
-            
-            # 获取或创建此用户的上下文
-            if context_key not in self.user_contexts:
-                # 新用户，初始化上下文
-                if self.system_prompt:
-                    self.user_contexts[context_key] = [{"role": "system", "content": self.system_prompt}]
-                else:
-                    self.user_contexts[context_key] = []
-            
-            # 获取当前用户的上下文
-            current_context = self.user_contexts[context_key].copy()
-            
-            # 添加用户请求前的识别标记，帮助模型区分新旧内容
-            prompt_with_marker = f"[当前用户问题] {prompt}"
-            current_context.append({"role": "user", "content": prompt_with_marker})
-            
-            # 构建完整提示
-            self.logger.info(f"[上下文跟踪] 构建提示，当前上下文消息数: {len(current_context)}")
-            for idx, msg in enumerate(current_context):
-                content_preview = msg["content"][:100] + "..." if len(msg["content"]) > 100 else msg["content"]
-                self.logger.info(f"[上下文消息 {idx}] 角色: {msg['role']}, 内容: {content_preview}")
-            
-            # 添加重试逻辑
-            max_retries = 3
-            retry_count = 0
-            response = None
-            last_error = None
-            
-            while retry_count < max_retries:
-                try:
-                    # 这里需要子类实现具体的API调用逻辑
-                    response = self.generate_response(current_context)
-                    
-                    # 检查返回是否为错误信息
-                    if any(error_text in response for error_text in ["API调用失败", "Connection error", "服务暂时不可用"]):
-                        self.logger.warning(f"API返回错误信息: {response[:100]}...")
-                        last_error = response
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            self.logger.info(f"进行第 {retry_count+1} 次重试...")
-                            continue
-                    else:
-                        # 成功获取响应，跳出循环
-                        break
-                        
-                except Exception as e:
-                    self.logger.error(f"API调用错误: {str(e)}")
-                    last_error = str(e)
-                    retry_count += 1
-                    if retry_count < max_retries:
-                        self.logger.info(f"进行第 {retry_count+1} 次重试...")
-                        continue
-                    else:
-                        response = f"API调用失败: {str(e)}"
-                        break
-            
-            # 如果所有重试都失败，返回最后的错误
-            if response is None and last_error:
-                response = f"多次尝试后仍然失败: {last_error}"
-            
-            # 只有在成功获取有效响应时才更新上下文
-            if not any(error_text in response for error_text in ["API调用失败", "Connection error", "服务暂时不可用"]):
-                # 更新用户上下文，用原始prompt而不是带标记的
-                self.user_contexts[context_key].append({"role": "user", "content": prompt})
-                self.user_contexts[context_key].append({"role": "assistant", "content": response})
-                
-                # 关键修复点：立即调用上下文管理，确保每次对话后检查并截断上下文
-                self.logger.info(f"[上下文管理] 开始管理上下文长度，最大允许对话对数: {self.max_context_messages}")
-                self._manage_context_length(context_key)
-                
-                # 打印更新后的上下文信息
-                post_manage_context = self.user_contexts[context_key]
-                self.logger.info(f"[上下文管理后] 更新后的上下文消息数: {len(post_manage_context)}")
-            else:
-                self.logger.warning(f"检测到API错误响应，不更新上下文: {response[:100]}...")
-            
-            self.logger.info(f"[API响应] 最终回复: {response[:100]}...")
+            # 重试、退避和熔断由子类调用的统一重试策略负责，这里只调用一次，避免重试次数叠加
+            try:
+                response = self.generate_response(current_context)
+            except Exception as e:
+                self.logger.error(f"API调用错误: {str(e)}")
+                response = f"API调用失败: {str(e)}"
             
-            # 更新最近交互时间
-            if hasattr(self, 'user_recent_chat_time'):
-                self.user_recent_chat_time[user_id if user_id else "default"] = datetime.now()
-                
+            self._record_response(context_key, prompt, response, user_id)
             return response
             
         except Exception as e:
             self.logger.error(f"处理提示时出错: {str(e)}")
             return f"处理您的请求时出现错误: {str(e)}"
+            
+    def handel_prompt_stream(self, prompt: str, user_id: str = None) -> Iterator[str]:
+        """
+        流式处理用户输入，按生成顺序逐块返回回复；完整回复结束后再更新上下文
+        
+        Args:
+            prompt: 用户输入
+            user_id: 用户ID
+            
+        Yields:
+            str: 回复文本片段
+            
+        Raises:
+            Exception: 请求失败时抛出，调用方可在尚未收到内容时回退到handel_prompt
+        """
+        self.logger.info(f"[流式处理提示] 收到输入: {prompt}")
+        context_key = user_id if user_id else "default"
+        current_context = self._prepare_user_context(context_key, prompt)
+        
+        chunks = []
+        for chunk in self.generate_response_stream(current_context):
+            chunks.append(chunk)
+            yield chunk
+            
+        response = "".join(chunks).strip()
+        self.logger.info(f"[流式API响应] 生成完成，长度: {len(response)}")
+        self._record_response(context_key, prompt, response, user_id)
+        
+    def _prepare_user_context(self, context_key: str, prompt: str, volatile_prompt: str = None,
+                              static_prompt: str = None) -> List[Dict[str, str]]:
+        """
+        获取（必要时创建）用户上下文，并按 静态前缀 → 对话历史 → 易变内容 → 当前输入 的顺序组织消息
+        
+        Args:
+            context_key: 上下文键
+            prompt: 用户输入
+            volatile_prompt: 本次调用附加的系统内容
+            static_prompt: 本次调用附加的静态系统内容
+            
+        Returns:
+            本次请求使用的消息列表
+        """
+        # 如果没有为此用户初始化上下文，则创建
+        if not hasattr(self, 'user_contexts'):
+            self.user_contexts = {}
+        
+        # 获取或创建此用户的上下文
+        static_prefix = self._static_prefix()
+        if context_key not in self.user_contexts:
+            # 新用户，初始化上下文
+            if static_prefix:
+                self.user_contexts[context_key] = [{"role": "system", "content": static_prefix}]
+            else:
+                self.user_contexts[context_key] = []
+        else:
+            # 静态提示词文件更新后，同步替换已保存上下文中的静态前缀
+            self._sync_static_prefix(self.user_contexts[context_key], static_prefix)
+        
+        # 获取当前用户的上下文，按token预算裁剪（只影响本次请求，不修改保存的上下文）
+        # 本次调用附加的系统内容和系统提示词一样计入固定开销
+        reserved_tokens = sum(self.token_counter.count_message({"content": extra})
+                              for extra in (static_prompt, volatile_prompt) if extra)
+        self.prompt_budgeter.max_prompt_tokens = self._prompt_token_budget()
+        current_context, prompt = self.prompt_budgeter.fit(self.user_contexts[context_key], prompt, reserved_tokens)
+        current_context = PromptComposer.layout(current_context, volatile_prompt, static_prompt)
+        
+        # 添加用户请求前的识别标记，帮助模型区分新旧内容
+        prompt_with_marker = f"[当前用户问题] {prompt}"
+        current_context.append({"role": "user", "content": prompt_with_marker})
+        
+        # 构建完整提示
+        self.logger.info(f"[上下文跟踪] 构建提示，当前上下文消息数: {len(current_context)}")
+        for idx, msg in enumerate(current_context):
+            content_preview = msg["content"][:100] + "..." if len(msg["content"]) > 100 else msg["content"]
+            self.logger.info(f"[上下文消息 {idx}] 角色: {msg['role']}, 内容: {content_preview}")
+            
+        return current_context
+        
+    def _static_prefix(self) -> Optional[str]:
+        """获取静态前缀：优先使用提示词组合器，否则使用system_prompt"""
+        if self.prompt_composer is not None:
+            return self.prompt_composer.static_prefix() or None
+        return self.system_prompt
+        
+    def _sync_static_prefix(self, context: List[Dict[str, str]], static_prefix: Optional[str]) -> None:
+        """
+        将上下文开头的系统消息同步为当前的静态前缀
+        
+        Args:
+            context: 已保存的上下文
+            static_prefix: 当前的静态前缀
+        """
+        if not static_prefix or self.prompt_composer is None:
+            return
+        if context and context[0]["role"] == "system":
+            if context[0]["content"] != static_prefix:
+                context[0] = {"role": "system", "content": static_prefix}
+        else:
+            context.insert(0, {"role": "system", "content": static_prefix})
+        
+    def _prompt_token_budget(self) -> int:
+        """提示词可用的token数：上下文长度减去为回复预留的token（最多预留一半）"""
+        reserve = min(int(getattr(self, 'max_tokens', 0) or 0), self.n_ctx // 2)
+        return self.n_ctx - reserve
+        
+    def _record_response(self, context_key: str, prompt: str, response: str, user_id: str = None) -> None:
+        """
+        记录一轮对话：回复有效时更新用户上下文并管理长度，同时更新最近交互时间
+        
+        Args:
+            context_key: 上下文键
+            prompt: 用户输入（不带标记）
+            response: 助手回复
+            user_id: 用户ID
+        """
+        # 只有在成功获取有效响应时才更新上下文
+        if not any(error_text in response for error_text in ["API调用失败", "Connection error", "服务暂时不可用"]):
+            # 更新用户上下文，用原始prompt而不是带标记的
+            self.user_contexts[context_key].append({"role": "user", "content": prompt})
+            self.user_contexts[context_key].append({"role": "assistant", "content": response})
+            
+            # 关键修复点：立即调用上下文管理，确保每次对话后检查并截断上下文
+            self.logger.info(f"[上下文管理] 开始管理上下文长度，最大允许对话对数: {self.max_context_messages}")
+            self._manage_context_length(context_key)
+            
+            # 打印更新后的上下文信息
+            post_manage_context = self.user_contexts[context_key]
+            self.logger.info(f"[上下文管理后] 更新后的上下文消息数: {len(post_manage_context)}")
+        else:
+            self.logger.warning(f"检测到API错误响应，不更新上下文: {response[:100]}...")
+        
+        self.logger.info(f"[API响应] 最终回复: {response[:100]}...")
+        
+        # 更新最近交互时间
+        if hasattr(self, 'user_recent_chat_time'):
+            self.user_recent_chat_time[user_id if user_id else "default"] = datetime.now()
     
     def _manage_context_length(self, context_key):
         """管理特定用户的上下文长度"""
@@ -283,48 +363,13 @@ class BaseLLM(online_llm):
         
         # 如果超出对话对数量限制，进行智能上下文管理
         if pair_count > self.max_context_messages:
-            # 1. 评分函数 - 计算每个对话对的重要性
-            def score_conversation_pair(user_msg, ai_msg):
-                score = 0
-                
-                # 关键词重要性
-                important_keywords = ['在实验室', '在家', '睡觉', '工作', '时间', '地点', 
-                                   '今天', '昨天', '明天', '早上', '下午', '晚上']
-                for keyword in important_keywords:
-                    if keyword in user_msg["content"] or keyword in ai_msg["content"]:
-                        score += 10
-                
-                # 时间相关性
-                time_patterns = [r'昨[天晚]', r'今[天晚]', r'(\d+)点', 
-                               r'早上|上午|中午|下午|晚上']
-                for pattern in time_patterns:
-                    if re.search(pattern, user_msg["content"]) or re.search(pattern, ai_msg["content"]):
-                        score += 15
-                
-                # 上下文转换标记
-                if "--- 场景转换 ---" in user_msg["content"]:
-                    score += 20
-                
-                # 问答对的完整性
-                if "?" in user_msg["content"] or "？" in user_msg["content"]:
-                    score += 5
-                
-                # 消息长度因素（较短的对话可能不太重要）
-                msg_length = len(user_msg["content"]) + len(ai_msg["content"])
-                if msg_length < 10:
-                    score -= 5
-                elif msg_length > 100:
-                    score += 5
-                
-                return score
-            
             # 2. 对对话对进行评分和排序
             conversation_pairs = []
             for i in range(system_offset, len(context), 2):
                 if i + 1 < len(context):
                     user_msg = context[i]
                     ai_msg = context[i + 1]
-                    score = score_conversation_pair(user_msg, ai_msg)
+                    score = self._score_conversation_pair(user_msg, ai_msg)
                     conversation_pairs.append({
                         'user_msg': user_msg,
                         'ai_msg': ai_msg,
@@ -373,6 +418,41 @@ class BaseLLM(online_llm):
                     {"role": "system", "content": f"当前对话要点：{summary}"}
                 )
     
+    def _score_conversation_pair(self, user_msg: Dict[str, str], ai_msg: Dict[str, str]) -> float:
+        """计算对话对的重要性评分，用于上下文截断和token预算裁剪"""
+        score = 0
+        
+        # 关键词重要性
+        important_keywords = ['在实验室', '在家', '睡觉', '工作', '时间', '地点', 
+                           '今天', '昨天', '明天', '早上', '下午', '晚上']
+        for keyword in important_keywords:
+            if keyword in user_msg["content"] or keyword in ai_msg["content"]:
+                score += 10
+        
+        # 时间相关性
+        time_patterns = [r'昨[天晚]', r'今[天晚]', r'(\d+)点', 
+                       r'早上|上午|中午|下午|晚上']
+        for pattern in time_patterns:
+            if re.search(pattern, user_msg["content"]) or re.search(pattern, ai_msg["content"]):
+                score += 15
+        
+        # 上下文转换标记
+        if "--- 场景转换 ---" in user_msg["content"]:
+            score += 20
+        
+        # 问答对的完整性
+        if "?" in user_msg["content"] or "？" in user_msg["content"]:
+            score += 5
+        
+        # 消息长度因素（较短的对话可能不太重要）
+        msg_length = len(user_msg["content"]) + len(ai_msg["content"])
+        if msg_length < 10:
+            score -= 5
+        elif msg_length > 100:
+            score += 5
+        
+        return score
+    
     def _generate_context_summary(self, context):
         """生成上下文摘要"""
         try:
@@ -443,3 +523,15 @@ class BaseLLM(online_llm):
             模型生成的回复
         """
         raise NotImplementedError("子类必须实现_generate_response方法")
+        
+    def generate_response_stream(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        """
+        流式调用API生成回复，默认一次性返回完整回复，支持流式输出的子类应覆盖
+        
+        Args:
+            messages: 完整的消息列表
+            
+        Yields:
+            模型生成的回复片段
+        """
+        yield self.generate_response(messages)
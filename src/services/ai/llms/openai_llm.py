@@ -1,6 +1,8 @@
-from typing import List, Dict
+from typing import Iterator, List, Dict
 import logging
 from openai import OpenAI
+from src.api_client.client_pool import client_registry
+from src.api_client.retry_policy import RetryableError, retry_policy
 from .base_llm import BaseLLM
 
 class OpenAILLM(BaseLLM):
@@ -52,12 +54,14 @@ class OpenAILLM(BaseLLM):
             # 添加超时配置和更多初始化参数
             timeout = httpx.Timeout(30.0, connect=10.0)  # 总超时30秒，连接超时10秒
             
-            # 无论是否已初始化，都重新设置客户端以使用最新的配置
-            self.client = OpenAI(
-                api_key=self.api_key,
-                base_url=self.url,
+            # 无论是否已初始化，都重新设置客户端以使用最新的配置（连接池由客户端注册表共享）
+            # 重试统一由retry_policy负责，关闭SDK自带的重试，避免重试次数叠加
+            self.client = client_registry.get_openai_client(
+                self.url,
+                self.api_key,
+                purpose="chat",
                 timeout=timeout,
-                max_retries=2  # 添加自动重试次数
+                max_retries=0
             )
             logger.info(f"OpenAI LLM 客户端初始化完成，模型: {self.model_name}")
             
@@ -73,6 +77,11 @@ class OpenAILLM(BaseLLM):
             logger.error(f"OpenAI LLM 客户端初始化失败: {str(e)}")
             self.client = None  # 初始化失败设为None
     
+    @property
+    def _retry_endpoint(self) -> str:
+        """重试策略中熔断器的端点名称"""
+        return f"chat@{self.url}"
+        
     def _test_connection(self):
         """测试API连接"""
         try:
@@ -82,26 +91,27 @@ class OpenAILLM(BaseLLM):
             # 确保已导入所需库
             import httpx
             
-            # 只测试连接，不执行实际请求
-            with httpx.Client(timeout=5.0, follow_redirects=True) as client:
-                try:
-                    response = client.get(
-                        f"{self.url}/models",
-                        headers={"Authorization": f"Bearer {self.api_key}"}
-                    )
-                    self.logger.info(f"API连接测试响应码: {response.status_code}")
-                    # 接受200和307状态码都视为连接成功
-                    return response.status_code in (200, 307)
-                except httpx.ConnectError as e:
-                    self.logger.error(f"API连接测试无法连接到服务器: {str(e)}")
-                    return False
-                except httpx.HTTPStatusError as e:
-                    self.logger.error(f"API连接测试收到HTTP错误: {e.response.status_code}")
-                    return False
-                except Exception as e:
-                    self.logger.error(f"API连接测试HTTP请求失败: {str(e)}")
-                    return False
-                
+            # 只测试连接，不执行实际请求；使用共享连接池，建立的连接可供后续请求复用
+            client = client_registry.get_http_client(self.url, self.api_key, purpose="chat")
+            try:
+                response = client.get(
+                    f"{self.url}/models",
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    timeout=5.0
+                )
+                self.logger.info(f"API连接测试响应码: {response.status_code}")
+                # 接受200和307状态码都视为连接成功
+                return response.status_code in (200, 307)
+            except httpx.ConnectError as e:
+                self.logger.error(f"API连接测试无法连接到服务器: {str(e)}")
+                return False
+            except httpx.HTTPStatusError as e:
+                self.logger.error(f"API连接测试收到HTTP错误: {e.response.status_code}")
+                return False
+            except Exception as e:
+                self.logger.error(f"API连接测试HTTP请求失败: {str(e)}")
+                return False
+            
         except ImportError as ie:
             self.logger.error(f"缺少httpx库: {str(ie)}")
             return False
@@ -109,6 +119,51 @@ class OpenAILLM(BaseLLM):
             self.logger.error(f"API连接测试失败: {str(e)}")
             return False
             
+    def generate_response_stream(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        """
+        以流式方式调用OpenAI API，按到达顺序逐块返回生成的文本
+        
+        Args:
+            messages: 完整的消息列表
+            
+        Yields:
+            模型生成的回复片段
+            
+        Raises:
+            Exception: 客户端未初始化或请求失败时抛出，由调用方决定是否回退到非流式调用
+        """
+        if self.client is None:
+            raise RuntimeError("API客户端未初始化")
+            
+        self.logger.info(f"[流式请求] 模型: {self.model_name}, 消息数量: {len(messages)}")
+        # 只在建立流之前重试，已经输出的片段无法撤回
+        stream = retry_policy.call(
+            self.client.chat.completions.create,
+            endpoint=self._retry_endpoint,
+            model=self.model_name,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            stream=True
+        )
+        
+        try:
+            for chunk in stream:
+                # 部分服务在最后一个数据块中返回token用量
+                if getattr(chunk, 'usage', None):
+                    self.prefix_cache_stats.record(chunk.usage)
+                if not getattr(chunk, 'choices', None):
+                    continue
+                delta = getattr(chunk.choices[0], 'delta', None)
+                content = getattr(delta, 'content', None) if delta is not None else None
+                if content:
+                    yield content
+        finally:
+            # 提前结束迭代时也要关闭连接
+            close = getattr(stream, 'close', None)
+            if callable(close):
+                close()
+    
     def generate_response(self, messages: List[Dict[str, str]]) -> str:
         """
         调用OpenAI API生成回复
@@ -133,63 +188,47 @@ class OpenAILLM(BaseLLM):
                 self.logger.error("API客户端未初始化")
                 return "API客户端未初始化，请检查日志获取详细错误信息"
                 
-            # 添加重试逻辑
-            max_retries = 2
-            retry_count = 0
-            last_error = None
+            def request_completion():
+                response = self.client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens
+                )
+                # 空响应通常是上游临时故障，按可重试错误处理
+                if not isinstance(response, str) and (not hasattr(response, 'choices') or not response.choices):
+                    self.logger.error(f"API返回无效响应: {response}")
+                    raise RetryableError("API返回空响应")
+                return response
             
-            while retry_count <= max_retries:
-                try:
-                    # 如果是重试，添加重试信息
-                    if retry_count > 0:
-                        self.logger.info(f"正在进行第 {retry_count} 次重试...")
-                    
-                    # 调用API
-                    response = self.client.chat.completions.create(
-                        model=self.model_name,
-                        messages=messages,
-                        temperature=self.temperature,
-                        max_tokens=self.max_tokens
-                    )
-                    
-                    # 检查响应类型
-                    if isinstance(response, str):
-                        self.logger.error(f"API返回了字符串而不是对象: {response[:100]}...")
-                        return f"API响应格式错误，请检查配置。"
-                    
-                    # 检查响应内容
-                    if not hasattr(response, 'choices') or not response.choices or len(response.choices) == 0:
-                        self.logger.error(f"API返回无效响应: {response}")
-                        raise ValueError("API返回空响应")
-                        
-                    assistant_response = response.choices[0].message.content.strip()
-                    
-                    # 移除[memory_number:...]标记
-                    import re
-                    assistant_response = re.sub(r'\s*\[memory_number:.*?\]$', '', assistant_response)
-                    
-                    self.logger.info("========= API响应信息 =========")
-                    self.logger.info(f"响应长度: {len(assistant_response)}")
-                    self.logger.info(f"响应前100字符: {assistant_response[:100]}")
-                    self.logger.info("===========================")
-                    
-                    return assistant_response
-                    
-                except Exception as e:
-                    last_error = str(e)
-                    self.logger.warning(f"API调用失败(尝试 {retry_count+1}/{max_retries+1}): {last_error}")
-                    retry_count += 1
+            try:
+                # 退避、总时间预算和熔断由统一的重试策略负责
+                response = retry_policy.call(request_completion, endpoint=self._retry_endpoint)
+            except Exception as e:
+                response = None
+                error_message = str(e)
+                
+            if response is not None:
+                # 检查响应类型
+                if isinstance(response, str):
+                    self.logger.error(f"API返回了字符串而不是对象: {response[:100]}...")
+                    return f"API响应格式错误，请检查配置。"
                     
-                    # 如果达到最大重试次数，跳出循环
-                    if retry_count > max_retries:
-                        break
-                        
-                    # 否则等待一段时间后重试
-                    import time
-                    time.sleep(1.0)  # 重试前等待1秒
+                assistant_response = response.choices[0].message.content.strip()
+                self.prefix_cache_stats.record(getattr(response, 'usage', None))
+                
+                # 移除[memory_number:...]标记
+                import re
+                assistant_response = re.sub(r'\s*\[memory_number:.*?\]$', '', assistant_response)
+                
+                self.logger.info("========= API响应信息 =========")
+                self.logger.info(f"响应长度: {len(assistant_response)}")
+                self.logger.info(f"响应前100字符: {assistant_response[:100]}")
+                self.logger.info("===========================")
+                
+                return assistant_response
             
             # 如果所有重试都失败，记录并返回错误
-            error_message = last_error
             self.logger.error(f"OpenAI API调用失败(所有重试均失败): {error_message}")
             
             # 增强错误日志和处理
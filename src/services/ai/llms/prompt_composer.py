@@ -0,0 +1,193 @@
+"""
+提示词组合模块
+- 缓存静态提示词文件（avatar.md、base.md），按文件修改时间失效
+- 以字节稳定的静态前缀开头组织消息，易变内容放在其后，便于服务端复用前缀缓存
+- 统计服务端返回的缓存token，计算前缀缓存命中率
+"""
+
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# 修改logger获取方式，确保与main模块一致
+logger = logging.getLogger('main')
+
+class PromptComposer:
+    """
+    提示词组合器
+
+    静态部分由文件或固定文本组成，文件内容按 (mtime, size) 缓存；
+    内容不变时static_prefix始终返回同一个字符串
+    """
+
+    def __init__(self):
+        self._sources: List[Tuple[str, str]] = []  # (类型, 路径或文本)
+        self._file_cache: Dict[str, Tuple[Tuple[int, int], str]] = {}
+        self._prefix_parts: Optional[Tuple[str, ...]] = None
+        self._prefix = ""
+        self._lock = threading.Lock()
+
+    def add_file(self, path: str) -> "PromptComposer":
+        """添加静态提示词文件"""
+        self._sources.append(("file", path))
+        return self
+
+    def add_text(self, text: str) -> "PromptComposer":
+        """添加固定的静态文本"""
+        if text:
+            self._sources.append(("text", text))
+        return self
+
+    def read_file(self, path: str) -> str:
+        """
+        读取静态文件，文件未修改时直接返回缓存内容
+
+        Args:
+            path: 文件路径
+
+        Returns:
+            str: 文件内容，读取失败时返回上一次成功读取的内容（没有则为空字符串）
+        """
+        cached = self._file_cache.get(path)
+        try:
+            stat = os.stat(path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if cached and cached[0] == signature:
+                return cached[1]
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read()
+            self._file_cache[path] = (signature, content)
+            if cached:
+                logger.info(f"静态提示词文件已更新，重新加载: {path}")
+            return content
+        except Exception as e:
+            logger.error(f"静态提示词文件读取失败: {path}, {str(e)}")
+            return cached[1] if cached else ""
+
+    def static_prefix(self) -> str:
+        """
+        获取静态前缀
+
+        Returns:
+            str: 各静态部分按顺序拼接的文本，内容不变时返回同一个字符串
+        """
+        with self._lock:
+            parts = tuple(
+                self.read_file(value) if kind == "file" else value
+                for kind, value in self._sources
+            )
+            if parts != self._prefix_parts:
+                self._prefix_parts = parts
+                self._prefix = "\n".join(part for part in parts if part)
+            return self._prefix
+
+    @staticmethod
+    def layout(context: List[Dict[str, str]], volatile_prompt: Optional[str] = None,
+               static_prompt: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        按稳定的顺序组织消息：静态前缀 → 本次调用的静态内容 → 对话历史 → 易变的系统内容
+
+        开头的系统消息视为静态前缀；其余系统消息（对话要点、裁剪摘要等）每轮都可能变化，
+        统一移到对话历史之后，避免破坏前面可复用的前缀
+
+        Args:
+            context: 上下文消息列表
+            volatile_prompt: 本次调用附加的系统内容
+            static_prompt: 本次调用附加的静态系统内容（如base.md），紧跟在静态前缀之后
+
+        Returns:
+            List[Dict[str, str]]: 组织后的消息列表
+        """
+        messages = []
+        volatile = []
+        for index, message in enumerate(context):
+            if message["role"] == "system" and index > 0:
+                volatile.append(message)
+            else:
+                messages.append(message)
+
+        if static_prompt:
+            position = 1 if messages and messages[0]["role"] == "system" else 0
+            messages.insert(position, {"role": "system", "content": static_prompt})
+        messages.extend(volatile)
+        if volatile_prompt:
+            messages.append({"role": "system", "content": volatile_prompt})
+        return messages
+
+class PrefixCacheStats:
+    """
+    前缀缓存命中统计
+    兼容OpenAI（usage.prompt_tokens_details.cached_tokens）和DeepSeek（usage.prompt_cache_hit_tokens）的返回格式
+    """
+
+    def __init__(self, log_interval: int = 20):
+        """
+        初始化统计
+
+        Args:
+            log_interval: 每记录多少次请求输出一次命中率日志
+        """
+        self.log_interval = log_interval
+        self.requests = 0
+        self.reported_requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get(obj: Any, name: str) -> Any:
+        """同时支持对象属性和字典键"""
+        if obj is None:
+            return None
+        if isinstance(obj, dict):
+            return obj.get(name)
+        return getattr(obj, name, None)
+
+    def record(self, usage: Any):
+        """
+        记录一次请求的token用量
+
+        Args:
+            usage: 响应中的usage字段
+        """
+        if usage is None:
+            return
+        prompt_tokens = self._get(usage, "prompt_tokens") or 0
+        cached_tokens = self._get(self._get(usage, "prompt_tokens_details"), "cached_tokens")
+        if cached_tokens is None:
+            cached_tokens = self._get(usage, "prompt_cache_hit_tokens")
+
+        with self._lock:
+            self.requests += 1
+            if cached_tokens is None:
+                return
+            self.reported_requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+            should_log = self.reported_requests % self.log_interval == 0
+
+        if should_log:
+            logger.info(f"[前缀缓存] 命中率: {self.hit_rate:.1%}，"
+                        f"缓存token: {self.cached_tokens}/{self.prompt_tokens}，请求数: {self.reported_requests}")
+
+    @property
+    def hit_rate(self) -> float:
+        """缓存token占提示词token的比例"""
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取统计信息
+
+        Returns:
+            Dict[str, Any]: 请求数、返回了缓存信息的请求数、token数和命中率
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "reported_requests": self.reported_requests,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "hit_rate": round(self.hit_rate, 4)
+            }
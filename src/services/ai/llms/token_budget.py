@@ -0,0 +1,281 @@
+"""
+提示词token预算模块
+使用本地分词器统计token数（按文本缓存），在固定预算内分配系统提示词、检索到的记忆、
+滚动上下文和当前输入，超出预算时优先丢弃或摘要价值最低的部分
+"""
+
+import logging
+import math
+import re
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger('main')
+
+# 每条消息的格式开销（角色、分隔标记等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 记忆块与当前输入之间的提示语，见MessageHandler中合并消息的格式
+MEMORY_NOTICE_PATTERN = re.compile(r'\n*\(以上是历史对话内容[^)]*\)\n*')
+
+# 估算token数时按单字计数的字符（中日韩文字和全角符号）
+_WIDE_CHAR_PATTERN = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+class TokenCounter:
+    """
+    本地token计数器
+    优先使用tiktoken分词；tiktoken不可用（未安装或无法加载编码文件）时按字符估算
+    """
+
+    def __init__(self, encoding_name: str = "cl100k_base", cache_size: int = 4096):
+        """
+        初始化计数器
+
+        Args:
+            encoding_name: tiktoken编码名称
+            cache_size: 缓存的文本数量，同一条消息在多轮对话中只计数一次
+        """
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._encoding_loaded = False
+        self.count = lru_cache(maxsize=cache_size)(self._count)
+
+    def _get_encoding(self):
+        """延迟加载tiktoken编码，只尝试一次"""
+        if not self._encoding_loaded:
+            self._encoding_loaded = True
+            try:
+                import tiktoken
+                self._encoding = tiktoken.get_encoding(self.encoding_name)
+            except Exception as e:
+                logger.warning(f"tiktoken不可用，使用字符估算token数: {str(e)}")
+                self._encoding = None
+        return self._encoding
+
+    def _count(self, text: str) -> int:
+        """统计文本的token数"""
+        if not text:
+            return 0
+        encoding = self._get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        wide_chars = len(_WIDE_CHAR_PATTERN.findall(text))
+        return wide_chars + math.ceil((len(text) - wide_chars) / 4)
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        """统计单条消息的token数（含格式开销）"""
+        return self.count(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        """统计消息列表的token数"""
+        return sum(self.count_message(message) for message in messages)
+
+    def truncate_head(self, text: str, max_tokens: int) -> str:
+        """
+        从开头截断文本，保留最后max_tokens个token
+
+        Args:
+            text: 原文本
+            max_tokens: 保留的token数
+
+        Returns:
+            str: 截断后的文本
+        """
+        if max_tokens <= 0:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        encoding = self._get_encoding()
+        if encoding is not None:
+            tokens = encoding.encode(text, disallowed_special=())
+            return encoding.decode(tokens[-max_tokens:])
+        # 估算模式下二分查找能保留的最长后缀
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(text[-middle:]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return text[-low:] if low else ""
+
+class PromptBudgeter:
+    """
+    提示词预算分配器
+
+    系统提示词是固定开销，不做裁剪；其余预算按比例分给检索到的记忆、滚动上下文和当前输入，
+    某部分用不完的预算按 当前输入 > 滚动上下文 > 记忆 的优先级分给其他部分。
+    超出分配时：记忆从排在最后（权重最低）的对话块开始丢弃；滚动上下文按对话对的价值
+    （重要性评分加新近程度）丢弃，被丢弃的对话生成摘要；当前输入只在最后才从开头截断
+    """
+
+    DEFAULT_SHARES = {"memories": 0.3, "history": 0.4, "input": 0.3}
+    PRIORITY = ("input", "history", "memories")
+
+    def __init__(self, counter: TokenCounter, max_prompt_tokens: int, shares: Optional[Dict[str, float]] = None,
+                 min_dynamic_tokens: int = 2048,
+                 pair_scorer: Optional[Callable[[Dict[str, str], Dict[str, str]], float]] = None,
+                 summarizer: Optional[Callable[[List[Dict[str, str]]], Optional[str]]] = None):
+        """
+        初始化预算分配器
+
+        Args:
+            counter: token计数器
+            max_prompt_tokens: 整个提示词的token预算
+            shares: 记忆/滚动上下文/当前输入的预算比例
+            min_dynamic_tokens: 系统提示词之外应当至少留出的token数，不足时记录警告
+            pair_scorer: 对话对重要性评分函数
+            summarizer: 被丢弃对话的摘要函数
+        """
+        self.counter = counter
+        self.max_prompt_tokens = max_prompt_tokens
+        self.shares = dict(shares or self.DEFAULT_SHARES)
+        self.min_dynamic_tokens = min_dynamic_tokens
+        self.pair_scorer = pair_scorer
+        self.summarizer = summarizer
+        self._warned_system_tokens = None
+
+    @staticmethod
+    def split_memories(prompt: str) -> Tuple[str, str, str]:
+        """
+        拆分合并消息中的记忆块和当前输入
+
+        Returns:
+            Tuple[str, str, str]: (记忆块, 提示语, 当前输入)，没有记忆块时前两项为空
+        """
+        match = MEMORY_NOTICE_PATTERN.search(prompt)
+        if not match:
+            return "", "", prompt
+        return prompt[:match.start()], match.group(), prompt[match.end():]
+
+    def fit(self, context: List[Dict[str, str]], prompt: str,
+            reserved_tokens: int = 0) -> Tuple[List[Dict[str, str]], str]:
+        """
+        按预算裁剪上下文和当前输入
+
+        Args:
+            context: 系统提示词和滚动上下文
+            prompt: 当前输入（可能以检索到的记忆开头）
+            reserved_tokens: 不在context中、但会随本次请求发送的系统内容的token数，计入系统提示词
+
+        Returns:
+            Tuple[List[Dict[str, str]], str]: 裁剪后的上下文和当前输入
+        """
+        system = [message for message in context if message["role"] == "system"]
+        history = [message for message in context if message["role"] != "system"]
+        memories, notice, current = self.split_memories(prompt)
+
+        system_tokens = self.counter.count_messages(system) + reserved_tokens
+        # 其余部分的预算不能超过系统提示词之后剩下的部分，否则整个提示词会超出上下文长度
+        budget = max(0, self.max_prompt_tokens - system_tokens - MESSAGE_OVERHEAD_TOKENS - self.counter.count(notice))
+        if budget < self.min_dynamic_tokens and self._warned_system_tokens != system_tokens:
+            self._warned_system_tokens = system_tokens
+            logger.warning(
+                f"[token预算] 系统提示词占用 {system_tokens} token，预算 {self.max_prompt_tokens} 中只剩 {budget} "
+                f"token 给记忆、上下文和当前输入（建议至少 {self.min_dynamic_tokens}），请精简人设或增大上下文长度"
+            )
+        needs = {
+            "memories": self.counter.count(memories),
+            "history": self.counter.count_messages(history),
+            "input": self.counter.count(current)
+        }
+        if sum(needs.values()) <= budget:
+            return context, prompt
+
+        allocation = self._allocate(needs, budget)
+        fitted_memories = self._fit_memories(memories, allocation["memories"])
+        fitted_history = self._fit_history(history, allocation["history"])
+        fitted_current = current
+        if needs["input"] > allocation["input"]:
+            fitted_current = "…" + self.counter.truncate_head(current, allocation["input"] - 1)
+
+        logger.info(
+            f"[token预算] 预算 {self.max_prompt_tokens}，系统提示词 {system_tokens}，"
+            f"记忆 {needs['memories']}→{self.counter.count(fitted_memories)}，"
+            f"上下文 {needs['history']}→{self.counter.count_messages(fitted_history)}，"
+            f"输入 {needs['input']}→{self.counter.count(fitted_current)}"
+        )
+
+        fitted_prompt = f"{fitted_memories}{notice}{fitted_current}" if fitted_memories else fitted_current
+        return system + fitted_history, fitted_prompt
+
+    def _allocate(self, needs: Dict[str, int], budget: int) -> Dict[str, int]:
+        """按比例分配预算，未用完的部分按优先级分给仍然不足的部分"""
+        allocation = {name: min(need, int(budget * self.shares.get(name, 0))) for name, need in needs.items()}
+        leftover = budget - sum(allocation.values())
+        for name in self.PRIORITY:
+            extra = min(needs[name] - allocation[name], leftover)
+            if extra > 0:
+                allocation[name] += extra
+                leftover -= extra
+        return allocation
+
+    def _fit_memories(self, memories: str, budget: int) -> str:
+        """按顺序保留记忆块（已按权重从高到低排列），放不下的低权重块整块丢弃"""
+        if not memories or self.counter.count(memories) <= budget:
+            return memories
+        blocks = memories.split("\n\n")
+        kept = []
+        for block in blocks:
+            if self.counter.count("\n\n".join(kept + [block])) > budget:
+                break
+            kept.append(block)
+        # 只剩标题行时整体丢弃
+        if len(kept) <= 1 and len(blocks) > 1:
+            return ""
+        return "\n\n".join(kept)
+
+    def _fit_history(self, history: List[Dict[str, str]], budget: int) -> List[Dict[str, str]]:
+        """按价值保留对话对，被丢弃的对话在预算允许时替换为摘要"""
+        if self.counter.count_messages(history) <= budget:
+            return history
+
+        pairs = []
+        index = 0
+        while index < len(history):
+            if (index + 1 < len(history) and history[index]["role"] == "user"
+                    and history[index + 1]["role"] == "assistant"):
+                pairs.append(history[index:index + 2])
+                index += 2
+            else:
+                pairs.append(history[index:index + 1])
+                index += 1
+
+        def pair_value(position: int) -> float:
+            pair = pairs[position]
+            score = 0.0
+            if self.pair_scorer and len(pair) == 2:
+                try:
+                    score = self.pair_scorer(pair[0], pair[1])
+                except Exception as e:
+                    logger.debug(f"对话评分失败: {str(e)}")
+            # 越新的对话越重要，最近一轮额外加分以保证连贯
+            recency = 30.0 * (position + 1) / len(pairs)
+            if position == len(pairs) - 1:
+                recency += 100.0
+            return score + recency
+
+        ranked = sorted(range(len(pairs)), key=pair_value, reverse=True)
+        kept_positions = set()
+        used = 0
+        for position in ranked:
+            cost = self.counter.count_messages(pairs[position])
+            if used + cost <= budget:
+                kept_positions.add(position)
+                used += cost
+
+        kept = [message for position in sorted(kept_positions) for message in pairs[position]]
+        dropped = [message for position in range(len(pairs)) if position not in kept_positions
+                   for message in pairs[position]]
+
+        if dropped and self.summarizer:
+            summary = None
+            try:
+                summary = self.summarizer(dropped)
+            except Exception as e:
+                logger.debug(f"生成被裁剪对话的摘要失败: {str(e)}")
+            if summary:
+                note = {"role": "system", "content": f"更早的对话要点：{summary}"}
+                if used + self.counter.count_message(note) <= budget:
+                    kept.insert(0, note)
+        return kept
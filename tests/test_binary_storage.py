@@ -0,0 +1,169 @@
+"""
+二进制RAG存储测试文件
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+# 添加项目根目录到路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.handlers.memories.core.rag import BinaryStorage, JsonStorage, migrate_json_to_binary
+
+DIM = 8
+
+def make_document(index: int, user_id: str = "角色A", dim: int = DIM) -> dict:
+    """构造带嵌入向量的测试文档"""
+    rng = np.random.default_rng(index)
+    return {
+        "id": f"doc_{index}",
+        "content": f"第{index}条对话内容",
+        "embedding": rng.normal(size=dim).astype(float).tolist(),
+        "metadata": {"user_id": user_id, "timestamp": f"2024-01-01 00:00:{index:02d}"}
+    }
+
+def snapshot(storage) -> dict:
+    """文档ID -> (内容, 元数据)，用于比较两个存储的内容"""
+    return {doc["id"]: (doc.get("content"), doc.get("metadata")) for doc in storage.data["documents"]}
+
+def search_ids(storage, query, top_k: int = 5, avatar_name: str = None) -> list:
+    """检索结果的(ID, 得分)列表"""
+    return [(result["id"], round(result["score"], 5))
+            for result in storage.search(query, top_k=top_k, avatar_name=avatar_name)]
+
+def test_add_update_and_reload(tmp_path):
+    """新增、更新后重新加载，内容和检索结果保持一致"""
+    path = str(tmp_path / "rag_storage.json")
+    storage = BinaryStorage(path)
+    for i in range(6):
+        assert storage.add_document(make_document(i, "角色A" if i % 2 else "角色B"))
+
+    # 只更新元数据
+    metadata = dict(storage.get_document("doc_1")["metadata"], hit_count=2)
+    assert storage.add_document({"id": "doc_1", "metadata": metadata})
+    # 更新嵌入向量：原地覆盖原有的行
+    updated = make_document(2, "角色B")
+    updated["embedding"] = make_document(99)["embedding"]
+    assert storage.add_document(updated)
+    assert storage._matrix_size == 6
+
+    query = make_document(99)["embedding"]
+    assert search_ids(storage, query, top_k=1)[0][0] == "doc_2"
+
+    reloaded = BinaryStorage(path)
+    assert snapshot(reloaded) == snapshot(storage)
+    assert reloaded.get_document("doc_1")["metadata"]["hit_count"] == 2
+    assert search_ids(reloaded, query) == search_ids(storage, query)
+    assert search_ids(reloaded, query, avatar_name="角色A") == search_ids(storage, query, avatar_name="角色A")
+
+def test_replace_compacts_files(tmp_path):
+    """按角色清空和归档会压缩记录日志与向量文件，重新加载后一致"""
+    path = str(tmp_path / "rag_storage.json")
+    storage = BinaryStorage(path)
+    for i in range(6):
+        storage.add_document(make_document(i, "角色A" if i % 2 else "角色B"))
+
+    assert storage.clear("角色B")
+    assert storage.archive_documents(["doc_1"]) == 1
+    assert sorted(snapshot(storage)) == ["doc_3", "doc_5"]
+    assert os.path.getsize(storage.vectors_path) == 2 * DIM * 4
+
+    query = make_document(5)["embedding"]
+    assert search_ids(storage, query, top_k=1)[0][0] == "doc_5"
+
+    reloaded = BinaryStorage(path)
+    assert snapshot(reloaded) == snapshot(storage)
+    assert search_ids(reloaded, query) == search_ids(storage, query)
+    assert [doc["id"] for doc in reloaded.load_archived_documents()] == ["doc_1"]
+
+    # 压缩后继续追加
+    assert reloaded.add_document(make_document(7))
+    assert sorted(snapshot(BinaryStorage(path))) == ["doc_3", "doc_5", "doc_7"]
+
+def test_truncated_last_record_is_skipped(tmp_path):
+    """崩溃留下的半行记录在回放时被忽略，之前的记录完整保留"""
+    path = str(tmp_path / "rag_storage.json")
+    storage = BinaryStorage(path)
+    for i in range(3):
+        storage.add_document(make_document(i))
+    expected = snapshot(storage)
+    query = make_document(1)["embedding"]
+    expected_results = search_ids(storage, query)
+
+    with open(storage.records_path, "a", encoding="utf-8") as f:
+        f.write('{"op": "put", "row": 3, "doc": {"id": "doc_3", "cont')
+
+    reloaded = BinaryStorage(path)
+    assert snapshot(reloaded) == expected
+    assert search_ids(reloaded, query) == expected_results
+
+def test_migrate_then_load_matches_json_storage(tmp_path):
+    """从JSON存储迁移后加载，文档和检索结果与JsonStorage一致"""
+    path = str(tmp_path / "rag_storage.json")
+    json_storage = JsonStorage(path)
+    for i in range(8):
+        json_storage.add_document(make_document(i, "角色A" if i % 3 else "角色B"))
+    # 没有嵌入向量的文档也要迁移
+    json_storage.add_document({"id": "doc_text", "content": "纯文本记忆",
+                               "metadata": {"user_id": "角色A", "timestamp": "2024-01-02 00:00:00"}})
+    json_storage.data["group_chats"] = {"群1": [{"timestamp": "2024-01-01 00:00:00", "sender_name": "张三"}]}
+    json_storage._save_data()
+
+    assert migrate_json_to_binary(path)
+    binary_storage = BinaryStorage(path)
+
+    assert snapshot(binary_storage) == snapshot(JsonStorage(path))
+    assert binary_storage.data["group_chats"] == json_storage.data["group_chats"]
+    assert binary_storage.get_document_count("角色A") == json_storage.get_document_count("角色A")
+    for i in (0, 4, 7):
+        query = make_document(100 + i)["embedding"]
+        assert search_ids(binary_storage, query) == search_ids(json_storage, query)
+        assert search_ids(binary_storage, query, avatar_name="角色B") == \
+            search_ids(json_storage, query, avatar_name="角色B")
+
+def test_release_vectors_closes_mapping(tmp_path):
+    """替换向量文件前释放内存映射，没有其他引用时映射随之关闭"""
+    path = str(tmp_path / "rag_storage.json")
+    storage = BinaryStorage(path)
+    for i in range(3):
+        storage.add_document(make_document(i))
+    assert isinstance(storage._raw_matrix, np.memmap)
+    assert storage._release_vectors()
+    assert storage._matrix_size == 3
+    storage._rebuild_matrix()
+    assert search_ids(storage, make_document(0)["embedding"], top_k=1)[0][0] == "doc_0"
+
+def wait_for_projection_fit(storage, timeout: float = 10.0):
+    """等待后台投影拟合结束"""
+    deadline = time.monotonic() + timeout
+    while storage._projection_fitting and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not storage._projection_fitting
+
+@pytest.mark.parametrize("storage_cls", [JsonStorage, BinaryStorage])
+def test_projection_fit_runs_in_background(tmp_path, storage_cls):
+    """PCA投影在后台拟合，安装时补算拟合期间新增和更新的行，结果与整体重建一致"""
+    path = str(tmp_path / "rag_storage.json")
+    storage = storage_cls(path)
+    storage.enable_projection({"mode": "pca", "dim": 4, "min_fit_documents": 20})
+    for i in range(20):
+        storage.add_document(make_document(i, "角色A" if i % 2 else "角色B"))
+    # 阈值触发后写入不等待拟合
+    assert not storage._projection.fitted
+    wait_for_projection_fit(storage)
+    storage.add_document(make_document(20))
+    updated = make_document(3, "角色A")
+    updated["embedding"] = make_document(98)["embedding"]
+    storage.add_document(updated)
+    assert storage._projection.fitted
+    
+    query = make_document(98)["embedding"]
+    results = search_ids(storage, query)
+    assert results[0][0] == "doc_3"
+    installed = np.array(storage._matrix[:storage._matrix_size])
+    storage._rebuild_matrix()
+    assert np.allclose(installed, storage._matrix[:storage._matrix_size], atol=1e-5)
+    assert search_ids(storage, query) == results
@@ -0,0 +1,92 @@
+"""
+记忆写后日志测试文件
+"""
+import atexit
+import os
+import sys
+
+import pytest
+
+# 添加项目根目录到路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.handlers.memories.memory_processor import MemoryProcessor
+
+@pytest.fixture
+def open_processor(tmp_path):
+    """按同一根目录重新创建记忆处理器，模拟进程重启（绕过单例）"""
+    created = []
+
+    def factory() -> MemoryProcessor:
+        MemoryProcessor._instance = None
+        MemoryProcessor._initialized = False
+        processor = MemoryProcessor(root_dir=str(tmp_path))
+        atexit.unregister(processor.flush)
+        created.append(processor)
+        return processor
+
+    yield factory
+    for processor in created:
+        with processor._data_lock:
+            processor._cancel_flush_timer()
+    MemoryProcessor._instance = None
+    MemoryProcessor._initialized = False
+
+def add_memories(processor: MemoryProcessor, count: int, user_id: str = "用户A"):
+    """写入若干条对话，只追加到日志，不合并到记忆文件"""
+    for i in range(count):
+        assert processor.add_memory(user_id, f"问题{i}", f"回答{i}")
+    with processor._data_lock:
+        processor._cancel_flush_timer()
+
+def human_messages(processor: MemoryProcessor, user_id: str = "用户A") -> list:
+    """用户的全部对话问题，按写入顺序"""
+    return [memory["human_message"] for memory in processor.memory_data.get(user_id, [])]
+
+def test_reload_replays_unmerged_journal(open_processor):
+    """未合并的日志在重新加载时回放，并合并到记忆文件"""
+    processor = open_processor()
+    add_memories(processor, 3)
+    assert os.path.exists(processor.journal_path)
+
+    reloaded = open_processor()
+    assert human_messages(reloaded) == ["问题0", "问题1", "问题2"]
+    # 回放后已合并，日志被清空
+    assert not os.path.exists(reloaded.journal_path)
+    assert human_messages(open_processor()) == ["问题0", "问题1", "问题2"]
+
+def test_merged_records_are_not_replayed_twice(open_processor):
+    """保存后、删除日志前崩溃：日志中已合并的记录被跳过，不会重复"""
+    processor = open_processor()
+    add_memories(processor, 2)
+    with open(processor.journal_path, "r", encoding="utf-8") as f:
+        journal = f.read()
+    assert processor.save()
+    # 模拟删除日志之前崩溃，并在重启前追加一条尚未合并的记录
+    with open(processor.journal_path, "w", encoding="utf-8") as f:
+        f.write(journal)
+    add_memories(processor, 1, "用户B")
+
+    reloaded = open_processor()
+    assert human_messages(reloaded) == ["问题0", "问题1"]
+    assert human_messages(reloaded, "用户B") == ["问题0"]
+    assert reloaded._journal_seq == processor._journal_seq
+
+def test_truncated_last_line_is_skipped(open_processor):
+    """崩溃留下的半行日志被忽略，之前的记录完整回放"""
+    processor = open_processor()
+    add_memories(processor, 2)
+    with open(processor.journal_path, "a", encoding="utf-8") as f:
+        f.write('{"op": "append", "user_id": "用户A", "entry": {"human_mes')
+
+    assert human_messages(open_processor()) == ["问题0", "问题1"]
+
+def test_rebuild_from_journal_without_memory_file(open_processor):
+    """记忆文件丢失时从日志重建"""
+    processor = open_processor()
+    add_memories(processor, 2)
+    os.remove(processor.memory_path)
+
+    reloaded = open_processor()
+    assert human_messages(reloaded) == ["问题0", "问题1"]
+    assert os.path.exists(reloaded.memory_path)
@@ -0,0 +1,69 @@
+"""
+统一重试策略测试文件
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+# 添加项目根目录到路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.api_client.retry_policy import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+class ClientError(Exception):
+    """模拟参数错误等客户端错误"""
+    status_code = 400
+
+def make_half_open_policy() -> RetryPolicy:
+    """熔断器已打开且恢复时间已过，下一个请求即为试探请求"""
+    policy = RetryPolicy(max_attempts=1, failure_threshold=1, recovery_timeout=0.0)
+    policy.get_breaker("test").record_failure()
+    assert policy.get_breaker("test").state == CircuitBreaker.OPEN
+    return policy
+
+def test_cancelled_probe_releases_slot():
+    """半开状态下试探请求被取消后，后续请求仍可以重新试探"""
+    policy = make_half_open_policy()
+
+    async def cancelled():
+        raise asyncio.CancelledError()
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(policy.async_call(cancelled, endpoint="test"))
+    assert policy.get_breaker("test").state == CircuitBreaker.OPEN
+
+    async def ok():
+        return "ok"
+
+    assert asyncio.run(policy.async_call(ok, endpoint="test")) == "ok"
+    assert policy.get_breaker("test").state == CircuitBreaker.CLOSED
+
+def test_interrupted_sync_probe_releases_slot():
+    """同步调用被中断时同样释放试探名额"""
+    policy = make_half_open_policy()
+
+    def interrupted():
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        policy.call(interrupted, endpoint="test")
+    assert policy.call(lambda: "ok", endpoint="test") == "ok"
+
+def test_client_error_does_not_close_breaker():
+    """客户端错误只释放试探名额，不把熔断器判定为已恢复"""
+    policy = make_half_open_policy()
+
+    def bad_request():
+        raise ClientError("参数错误")
+
+    with pytest.raises(ClientError):
+        policy.call(bad_request, endpoint="test")
+    breaker = policy.get_breaker("test")
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # 恢复时间更长时，释放后的熔断器继续拒绝请求
+    breaker.recovery_timeout = 60.0
+    with pytest.raises(CircuitOpenError):
+        policy.call(lambda: "ok", endpoint="test")
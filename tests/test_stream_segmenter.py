@@ -0,0 +1,53 @@
+"""
+流式回复分段器测试文件
+"""
+import os
+import sys
+
+# 添加项目根目录到路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.services.ai.llm_service import StreamSegmenter
+
+def feed_all(chunks) -> list:
+    """依次输入文本片段，返回全部分段（包括结束时剩余的文本）"""
+    segmenter = StreamSegmenter()
+    segments = []
+    for chunk in chunks:
+        segments.extend(segmenter.feed(chunk))
+    remaining = segmenter.flush()
+    if remaining:
+        segments.append(remaining)
+    return segments
+
+def test_single_dollar_splits():
+    """单个$是分隔符，分段到达后立即释放"""
+    segmenter = StreamSegmenter()
+    assert segmenter.feed("你好呀$今天") == ["你好呀"]
+    assert segmenter.feed("天气不错$") == []
+    assert segmenter.feed("出去走走吗") == ["今天天气不错"]
+    assert segmenter.flush() == "出去走走吗"
+
+def test_dollar_runs_are_plain_text():
+    """连续多个$视为普通字符，跨片段到达时也不拆分"""
+    assert feed_all(["价格是$$100", "$$左右"]) == ["价格是$$100$$左右"]
+    assert feed_all(["美元符号$", "$", "$很常见"]) == ["美元符号$$$很常见"]
+
+def test_trailing_dollar_is_dropped():
+    """回复以单个$结尾时去掉该分隔符，以$$结尾时保留"""
+    segmenter = StreamSegmenter()
+    assert segmenter.feed("好的$") == []
+    assert segmenter.flush() == "好的"
+    assert feed_all(["记住$$"]) == ["记住$$"]
+
+def test_decimals_and_urls_are_not_split():
+    """小数点和网址中的英文句点不是句末"""
+    assert feed_all(["价格是3.5元，网址是example.com哦。", "还有别的吗"]) == \
+        ["价格是3.5元，网址是example.com哦。", "还有别的吗"]
+    assert feed_all(["版本号是v1.", "2.3，", "已经更新了！好的"]) == ["版本号是v1.2.3，已经更新了！", "好的"]
+
+def test_sentence_endings():
+    """中文句末标点直接分句，英文标点后跟空白时分句，连续标点保持在同一句"""
+    assert feed_all(["真的吗？！", "太好了。"]) == ["真的吗？！", "太好了。"]
+    assert feed_all(["Hello! How are you? ", "Fine."]) == ["Hello!", "How are you?", "Fine."]
+    assert feed_all(["嗯...", "我想想"]) == ["嗯...我想想"]
@@ -0,0 +1,90 @@
+"""
+提示词token预算测试文件
+"""
+import os
+import sys
+
+# 添加项目根目录到路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.services.ai.llms.token_budget import MESSAGE_OVERHEAD_TOKENS, PromptBudgeter, TokenCounter
+
+def make_counter() -> TokenCounter:
+    """按字符估算的计数器，结果不依赖是否安装了tiktoken"""
+    counter = TokenCounter()
+    counter._encoding_loaded = True
+    return counter
+
+def make_pair(index: int, length: int = 20) -> list:
+    """构造一轮对话"""
+    return [
+        {"role": "user", "content": f"问题{index}" + "问" * length},
+        {"role": "assistant", "content": f"回答{index}" + "答" * length}
+    ]
+
+def prompt_tokens(counter: TokenCounter, context: list, prompt: str) -> int:
+    """整个提示词的token数（含当前输入的消息开销）"""
+    return counter.count_messages(context) + counter.count(prompt) + MESSAGE_OVERHEAD_TOKENS
+
+def test_fit_keeps_prompt_within_budget():
+    """预算足够时原样返回"""
+    counter = make_counter()
+    budgeter = PromptBudgeter(counter, max_prompt_tokens=1000, min_dynamic_tokens=100)
+    context = [{"role": "system", "content": "你是一个助手"}] + make_pair(0)
+    assert budgeter.fit(context, "你好") == (context, "你好")
+
+def test_fit_never_exceeds_budget_with_long_system_prompt():
+    """系统提示词很长时，其余部分的预算不会超出系统提示词之后剩下的部分"""
+    counter = make_counter()
+    budgeter = PromptBudgeter(counter, max_prompt_tokens=500, min_dynamic_tokens=400)
+    system = {"role": "system", "content": "人" * 300}
+    context = [system] + make_pair(0) + make_pair(1) + make_pair(2)
+    prompt = "记忆1\n\n记忆2" + "(以上是历史对话内容，仅供参考，无需进行互动。请专注处理接下来的新内容)" + "输" * 200
+
+    fitted_context, fitted_prompt = budgeter.fit(context, prompt)
+    assert fitted_context[0] == system
+    assert prompt_tokens(counter, fitted_context, fitted_prompt) <= 500
+    assert fitted_prompt.endswith("输") and "…输" in fitted_prompt
+
+def test_allocate_gives_leftover_by_priority():
+    """按比例分配后，未用完的预算按 当前输入 > 滚动上下文 > 记忆 的顺序补给"""
+    budgeter = PromptBudgeter(make_counter(), max_prompt_tokens=1000)
+    allocation = budgeter._allocate({"memories": 100, "history": 10, "input": 500}, 300)
+    assert allocation == {"memories": 90, "history": 10, "input": 200}
+    allocation = budgeter._allocate({"memories": 500, "history": 500, "input": 10}, 300)
+    assert allocation == {"memories": 90, "history": 200, "input": 10}
+
+def test_fit_history_keeps_valuable_pairs_and_summarizes_dropped():
+    """预算不足时保留最近一轮和高分对话，被丢弃的对话替换为摘要"""
+    counter = make_counter()
+    history = make_pair(0) + make_pair(1) + make_pair(2) + make_pair(3)
+    dropped = []
+
+    def summarizer(messages):
+        dropped.extend(messages)
+        return "聊过天气"
+
+    budgeter = PromptBudgeter(
+        counter, max_prompt_tokens=1000,
+        pair_scorer=lambda user, assistant: 100.0 if "问题0" in user["content"] else 0.0,
+        summarizer=summarizer
+    )
+    budget = counter.count_messages(make_pair(0) + make_pair(3)) + 20
+    fitted = budgeter._fit_history(history, budget)
+
+    assert fitted[0] == {"role": "system", "content": "更早的对话要点：聊过天气"}
+    assert fitted[1:] == make_pair(0) + make_pair(3)
+    assert dropped == make_pair(1) + make_pair(2)
+    assert counter.count_messages(fitted) <= budget
+
+def test_fit_counts_reserved_system_content():
+    """随本次请求附加的系统内容计入固定开销"""
+    counter = make_counter()
+    budgeter = PromptBudgeter(counter, max_prompt_tokens=300, min_dynamic_tokens=0)
+    context = [{"role": "system", "content": "你是一个助手"}] + make_pair(0) + make_pair(1)
+    assert budgeter.fit(context, "你好") == (context, "你好")
+
+    volatile = {"role": "system", "content": "基" * 150}
+    fitted_context, fitted_prompt = budgeter.fit(context, "你好", counter.count_message(volatile))
+    assert prompt_tokens(counter, fitted_context + [volatile], fitted_prompt) <= 300
+    assert fitted_context[-2:] == make_pair(1)